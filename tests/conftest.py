@@ -15,6 +15,7 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import json
 import socket
 
 import pytest
@@ -24,6 +25,26 @@ def pytest_addoption(parser):
     parser.addoption(
         '--repeat', type=int, default=100,
         help="Number of repetitions in performance tests.")
+    parser.addoption(
+        '--benchmark-output', default=None,
+        help="Write the results of the benchmarks as JSON to this file.")
+    parser.addoption(
+        '--benchmarks', action='store_true', default=False,
+        help="Run the long running benchmarks marked with `benchmark`.")
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'benchmark: long running benchmark, needs --benchmarks')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmarks'):
+        return
+    skip = pytest.mark.skip(reason="needs --benchmarks")
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
 
 
 @pytest.fixture(scope='session')
@@ -37,6 +58,26 @@ def repeat(request):
     return request.config.getoption('--repeat')
 
 
+@pytest.fixture(scope='session')
+def benchmark_results(request):
+    """
+    List collecting the results of the benchmarks.
+
+    The results are written as JSON to the file given by `--benchmark-output`
+    at the end of the session.
+    """
+    results = []
+    output = request.config.getoption('--benchmark-output')
+
+    def write_results():
+        if output and results:
+            with open(output, 'w') as output_file:
+                json.dump(results, output_file, indent=2, sort_keys=True)
+
+    request.addfinalizer(write_results)
+    return results
+
+
 @pytest.fixture(scope='session')
 def vcsserver_port(request):
     port = get_available_port()
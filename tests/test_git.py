@@ -16,6 +16,8 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
 import inspect
+import os
+import subprocess
 
 import pytest
 import dulwich.errors
@@ -48,6 +50,116 @@ def test_discover_git_version(git_remote):
     assert version
 
 
+def _git_commit(path, message, date):
+    env = dict(os.environ, GIT_AUTHOR_NAME='tester',
+               GIT_AUTHOR_EMAIL='tester@example.com',
+               GIT_COMMITTER_NAME='tester',
+               GIT_COMMITTER_EMAIL='tester@example.com',
+               GIT_AUTHOR_DATE='%d +0000' % date,
+               GIT_COMMITTER_DATE='%d +0000' % date)
+    subprocess.check_call(
+        ['git', 'commit', '-q', '--allow-empty', '-m', message],
+        cwd=path, env=env)
+
+
+@pytest.fixture
+def git_repo_path(tmpdir):
+    """
+    Path of a git repository with three commits.
+    """
+    path = str(tmpdir)
+    subprocess.check_call(['git', 'init', '-q', path])
+    for index in range(3):
+        _git_commit(path, str(index), 1400000000 + index)
+    return path
+
+
+def _commit_ids(git_remote, wire):
+    output, __ = git_remote.run_git_command(
+        wire, ['rev-list', '--all', '--reverse', '--date-order'])
+    return output.split()
+
+
+def test_get_commit_ids_page(git_remote, git_repo_path):
+    wire = {'path': git_repo_path}
+    commit_ids = _commit_ids(git_remote, wire)
+
+    page = git_remote.get_commit_ids_page(wire, 1, 1)
+
+    assert page['commit_ids'] == commit_ids[1].decode('hex')
+    assert page['total'] == 3
+    assert page['token'] == '3:%s' % commit_ids[2]
+
+
+def test_get_commit_ids_page_since_token(git_remote, git_repo_path):
+    wire = {'path': git_repo_path}
+    page = git_remote.get_commit_ids_page(wire, 0, 0)
+
+    assert len(page['commit_ids']) == 3 * 20
+    assert git_remote.get_commit_ids_page(
+        wire, 0, 0, token=page['token'])['commit_ids'] == ''
+
+    stale = git_remote.get_commit_ids_page(wire, 0, 0, token='2:' + 'a' * 40)
+    assert stale['reset']
+    assert stale['commit_ids'] == page['commit_ids']
+
+
+def test_get_commit_ids_page_returns_new_commits(git_remote, git_repo_path):
+    wire = {'path': git_repo_path}
+    commit_ids = _commit_ids(git_remote, wire)
+    token = '1:%s' % commit_ids[0]
+
+    page = git_remote.get_commit_ids_page(wire, 1, 0, token=token)
+
+    assert page['commit_ids'] == commit_ids[2].decode('hex')
+    assert page['offset'] == 2
+    assert page['total'] == 3
+    assert page['token'] == '3:%s' % commit_ids[2]
+    assert not page['reset']
+
+
+def test_get_commit_ids_page_finds_backdated_branches(
+        git_remote, git_repo_path):
+    wire = {'path': git_repo_path}
+    token = git_remote.get_commit_ids_page(wire, 0, 0)['token']
+
+    subprocess.check_call(
+        ['git', 'checkout', '-q', '-b', 'old', 'HEAD~2'], cwd=git_repo_path)
+    _git_commit(git_repo_path, 'backdated', 1300000000)
+    page = git_remote.get_commit_ids_page(wire, 0, 0, token=token)
+
+    new_id = subprocess.check_output(
+        ['git', 'rev-parse', 'old'], cwd=git_repo_path).strip()
+    assert not page['reset']
+    assert page['total'] == 4
+    assert page['commit_ids'] == new_id.decode('hex')
+    assert git_remote.get_commit_ids_page(wire, 0, 0)['total'] == 4
+
+
+def test_get_commit_ids_page_resets_after_rewrite(git_remote, git_repo_path):
+    wire = {'path': git_repo_path}
+    page = git_remote.get_commit_ids_page(wire, 0, 0)
+
+    subprocess.check_call(
+        ['git', 'reset', '-q', '--hard', 'HEAD~1'], cwd=git_repo_path)
+    rewritten = git_remote.get_commit_ids_page(
+        wire, 0, 0, token=page['token'])
+
+    assert rewritten['reset']
+    assert rewritten['total'] == 2
+    assert rewritten['commit_ids'] == page['commit_ids'][:40]
+
+
+@pytest.mark.parametrize('token', [
+    '3', 'x:' + 'a' * 40, '3:abc', '3:' + 'a' * 80])
+def test_get_commit_ids_page_rejects_malformed_token(
+        git_remote, git_repo_path, token):
+    with pytest.raises(Exception) as exc_info:
+        git_remote.get_commit_ids_page(
+            {'path': git_repo_path}, 0, 0, token=token)
+    assert exc_info.value._vcs_kind == 'lookup'
+
+
 class TestGitFetch(object):
     def setup(self):
         self.mock_repo = Mock()
@@ -15,12 +15,20 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import hashlib
 import inspect
+import os
+import StringIO
 import sys
 import traceback
 
+import mercurial.commands
+import mercurial.hg
+import mercurial.unionrepo
+import mercurial.ui
 import pytest
 from mercurial.error import LookupError
+from mercurial.node import hex
 from mock import Mock, MagicMock, patch
 
 from vcsserver import exceptions, hg, hgcompat
@@ -62,6 +70,624 @@ class TestDiff(object):
             assert exc_info.value._vcs_kind == 'lookup'
 
 
+@pytest.fixture
+def hg_repo(tmpdir):
+    """
+    A Mercurial repository with a single commit.
+    """
+    baseui = mercurial.ui.ui()
+    baseui.setconfig('ui', 'quiet', 'true')
+    repo = mercurial.hg.repository(baseui, str(tmpdir), create=True)
+    tmpdir.join('file.txt').write('content\n')
+    repo[None].add(['file.txt'])
+    repo.commit(text='initial', user='tester')
+    return repo
+
+
+def _hg_remote(repo):
+    factory = Mock()
+    factory.repo = Mock(return_value=repo)
+    factory._create_config = Mock(return_value=repo.ui)
+    return hg.HgRemote(factory)
+
+
+class TestCreateCloneBundle(object):
+    def test_writes_bundle_and_manifest(self, hg_repo, tmpdir):
+        bundle_path = str(tmpdir.join('repo.hg'))
+        hg_remote = _hg_remote(hg_repo)
+
+        created = hg_remote.create_clone_bundle(
+            {'path': hg_repo.root}, bundle_path, 'http://host/bundles/repo.hg')
+
+        assert created
+        with open(bundle_path, 'rb') as bundle:
+            assert bundle.read(4) == 'HG20'
+        manifest = hg_repo.vfs.read('clonebundles.manifest')
+        assert manifest == (
+            'http://host/bundles/repo.hg BUNDLESPEC=gzip-v2\n')
+
+    def test_writes_stream_bundle(self, hg_repo, tmpdir):
+        bundle_path = str(tmpdir.join('repo.hg'))
+        hg_remote = _hg_remote(hg_repo)
+
+        hg_remote.create_clone_bundle(
+            {'path': hg_repo.root}, bundle_path, 'http://host/repo.hg',
+            stream=True)
+
+        with open(bundle_path, 'rb') as bundle:
+            assert bundle.read(4) == 'HGS1'
+        manifest = hg_repo.vfs.read('clonebundles.manifest')
+        assert 'BUNDLESPEC=none-packed1;requirements%3D' in manifest
+
+    def test_failure_keeps_previous_bundle(self, hg_repo, tmpdir):
+        bundle_path = tmpdir.join('bundles', 'repo.hg')
+        bundle_path.write('previous', ensure=True)
+        hg_remote = _hg_remote(hg_repo)
+
+        with patch('vcsserver.hg.commands.bundle',
+                   side_effect=Exception('disk full')):
+            with pytest.raises(Exception):
+                hg_remote.create_clone_bundle(
+                    {'path': hg_repo.root}, str(bundle_path), 'http://host')
+
+        assert bundle_path.read() == 'previous'
+        assert bundle_path.dirpath().listdir() == [bundle_path]
+
+    def test_empty_repo_removes_manifest(self, tmpdir):
+        repo = mercurial.hg.repository(
+            mercurial.ui.ui(), str(tmpdir.join('empty')), create=True)
+        repo.vfs.write('clonebundles.manifest', 'stale')
+        hg_remote = _hg_remote(repo)
+
+        created = hg_remote.create_clone_bundle(
+            {'path': repo.root}, str(tmpdir.join('repo.hg')), 'http://host')
+
+        assert not created
+        assert not repo.vfs.exists('clonebundles.manifest')
+
+
+class TestFileHistory(object):
+    @pytest.fixture
+    def history_repo(self, hg_repo, tmpdir):
+        """
+        Adds commits 1 to 5, commit 3 does not touch "file.txt".
+        """
+        for index in range(1, 6):
+            name = 'other.txt' if index == 3 else 'file.txt'
+            tmpdir.join(name).write('content %d\n' % index)
+            if index == 3:
+                hg_repo[None].add([name])
+            hg_repo.commit(text='commit %d' % index, user='tester')
+        return hg_repo
+
+    def _nodes(self, repo, revs):
+        return [repo[rev].hex() for rev in revs]
+
+    @pytest.mark.parametrize('revision, limit, expected', [
+        (5, 0, [5, 4, 2, 1, 0]),
+        (5, 2, [5, 4]),
+        (3, 0, [2, 1, 0]),
+        (3, 2, [2, 1]),
+        (0, 10, [0]),
+    ])
+    def test_file_history(self, history_repo, revision, limit, expected):
+        hg_remote = _hg_remote(history_repo)
+
+        history = hg_remote.file_history(
+            {'path': history_repo.root}, revision, 'file.txt', limit)
+
+        assert history == self._nodes(history_repo, expected)
+
+    def test_file_history_reads_only_requested_part_of_filelog(
+            self, history_repo):
+        hg_remote = _hg_remote(history_repo)
+        filelog = history_repo.file('file.txt')
+
+        with patch.object(filelog, 'linkrev',
+                          side_effect=filelog.linkrev) as linkrev_mock:
+            with patch.object(history_repo, 'file', return_value=filelog):
+                hg_remote.file_history(
+                    {'path': history_repo.root}, 5, 'file.txt', 1)
+
+        # bisection over 5 file revisions plus the yielded revision
+        assert linkrev_mock.call_count <= 5
+
+    @pytest.mark.parametrize('limit, expected', [
+        (0, [5, 4, 2, 1, 0]),
+        (2, [5, 4]),
+    ])
+    def test_file_history_untill(self, history_repo, limit, expected):
+        hg_remote = _hg_remote(history_repo)
+
+        history = hg_remote.file_history_untill(
+            {'path': history_repo.root}, 5, 'file.txt', limit)
+
+        assert history == self._nodes(history_repo, expected)
+
+
+class TestGetCommitIdsPage(object):
+    @pytest.fixture
+    def repo(self, hg_repo, tmpdir):
+        for index in range(1, 4):
+            tmpdir.join('file.txt').write('content %d\n' % index)
+            hg_repo.commit(text='commit %d' % index, user='tester')
+        return hg_repo
+
+    def test_returns_window_of_binary_nodes(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        page = hg_remote.get_commit_ids_page(
+            {'path': repo.root}, 'visible', 1, 2)
+
+        assert page['commit_ids'] == repo[1].node() + repo[2].node()
+        assert page['offset'] == 1
+        assert page['total'] == 4
+        assert page['token'] == '4:%s' % repo[3].hex()
+        assert not page['reset']
+
+    def test_fetches_only_new_nodes_since_token(self, repo, tmpdir):
+        hg_remote = _hg_remote(repo)
+        token = hg_remote.get_commit_ids_page(
+            {'path': repo.root}, 'visible', 0, 0)['token']
+
+        tmpdir.join('file.txt').write('new content\n')
+        repo.commit(text='new commit', user='tester')
+        page = hg_remote.get_commit_ids_page(
+            {'path': repo.root}, 'visible', 0, 0, token=token)
+
+        assert page['commit_ids'] == repo[4].node()
+        assert page['offset'] == 4
+
+    def test_skips_hidden_changesets(self, repo):
+        hg_remote = _hg_remote(repo)
+        with patch('mercurial.repoview.filterrevs',
+                   return_value=frozenset([1])):
+            page = hg_remote.get_commit_ids_page(
+                {'path': repo.root}, 'visible', 1, 0)
+
+        assert page['commit_ids'] == repo[2].node() + repo[3].node()
+        assert page['total'] == 3
+
+    def test_resets_on_unknown_token(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        page = hg_remote.get_commit_ids_page(
+            {'path': repo.root}, 'visible', 0, 1, token='2:' + 'a' * 40)
+
+        assert page['reset']
+        assert page['commit_ids'] == repo[0].node()
+
+    @pytest.mark.parametrize('token', ['2', 'x:' + 'a' * 40, '2:abc'])
+    def test_rejects_malformed_token(self, repo, token):
+        hg_remote = _hg_remote(repo)
+
+        with pytest.raises(Exception) as exc_info:
+            hg_remote.get_commit_ids_page(
+                {'path': repo.root}, 'visible', 0, 1, token=token)
+        assert exc_info.value._vcs_kind == 'lookup'
+
+
+class TestMercurialFactoryCreateConfig(object):
+    config = [
+        ['hooks', 'preoutgoing.pre_pull', 'python:hook'],
+        ['web', 'push_ssl', 'false'],
+    ]
+
+    def test_returns_independent_copies(self):
+        factory = hg.MercurialFactory(Mock())
+
+        baseui = factory._create_config(self.config)
+        baseui.setconfig('web', 'push_ssl', 'true')
+
+        assert factory._create_config(self.config).config(
+            'web', 'push_ssl') == 'false'
+
+    def test_builds_ui_once_per_config_and_hooks_flag(self):
+        factory = hg.MercurialFactory(Mock())
+
+        with patch.object(factory, '_make_ui',
+                          side_effect=factory._make_ui) as make_ui:
+            factory._create_config(self.config)
+            factory._create_config([list(item) for item in self.config])
+            without_hooks = factory._create_config(self.config, hooks=False)
+
+        assert make_ui.call_count == 2
+        assert not without_hooks.config('hooks', 'preoutgoing.pre_pull')
+
+
+class TestAnnotate(object):
+    @pytest.fixture
+    def repo(self, hg_repo, tmpdir):
+        contents = [
+            'a\nb\nc\n',
+            'a\nB\nc\nd\n',
+            'x\na\nB\nd\n',
+        ]
+        for index, content in enumerate(contents, 1):
+            tmpdir.join('file.txt').write(content)
+            hg_repo.commit(text='commit %d' % index, user='tester')
+        return hg_repo
+
+    def _expected(self, repo, revision):
+        fctx = repo[revision].filectx('file.txt')
+        return [(ln_no, hex(annotated.node()), line)
+                for ln_no, (annotated, line) in enumerate(fctx.annotate(), 1)]
+
+    def test_matches_mercurial_annotate(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        for revision in (3, 1, 2):
+            assert hg_remote.fctx_annotate(
+                {'path': repo.root}, revision, 'file.txt') == (
+                    self._expected(repo, revision))
+
+    def test_reuses_cached_ancestor_annotation(self, repo):
+        hg_remote = _hg_remote(repo)
+        hg_remote.fctx_annotate({'path': repo.root}, 1, 'file.txt')
+
+        with patch('mercurial.context.basefilectx.annotate') as annotate:
+            result = hg_remote.fctx_annotate(
+                {'path': repo.root}, 3, 'file.txt')
+
+        assert not annotate.called
+        assert result == self._expected(repo, 3)
+
+    def test_columnar_form(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        result = hg_remote.fctx_annotate_columnar(
+            {'path': repo.root}, 3, 'file.txt')
+
+        assert result['commit_ids'] == [repo[3].hex(), repo[1].hex(),
+                                        repo[2].hex()]
+        assert result['line_commits'] == [0, 1, 2, 2]
+        assert result['lines'] == ['x\n', 'a\n', 'B\n', 'd\n']
+
+
+class TestHeadsAndAncestors(object):
+    @pytest.fixture
+    def repo(self, hg_repo, tmpdir):
+        """
+        Two heads on "default" (1, 3) and one on branch "feature" (2).
+        """
+        tmpdir.join('file.txt').write('1\n')
+        hg_repo.commit(text='commit 1', user='tester')
+        mercurial.commands.update(hg_repo.ui, hg_repo, rev='0')
+        hg_repo.dirstate.setbranch('feature')
+        tmpdir.join('file.txt').write('2\n')
+        hg_repo.commit(text='commit 2', user='tester')
+        mercurial.commands.update(hg_repo.ui, hg_repo, rev='0')
+        tmpdir.join('file.txt').write('3\n')
+        hg_repo.commit(text='commit 3', user='tester')
+        return hg_repo
+
+    def _command_output(self, command, repo, *args, **kwargs):
+        repo.ui.pushbuffer()
+        command(repo.ui, repo, *args, **kwargs)
+        return repo.ui.popbuffer()
+
+    @pytest.mark.parametrize('branch', [None, 'default', 'feature', '2'])
+    def test_heads_matches_hg_heads(self, repo, branch):
+        hg_remote = _hg_remote(repo)
+        args = [branch] if branch else []
+
+        assert hg_remote.heads({'path': repo.root}, branch) == (
+            self._command_output(
+                mercurial.commands.heads, repo, template='{node} ', *args))
+
+    def test_branch_heads_returns_binary_nodes(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        assert hg_remote.branch_heads({'path': repo.root}, 'default') == [
+            repo[3].node(), repo[1].node()]
+
+    def test_ancestor_matches_debugancestor(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        assert hg_remote.ancestor({'path': repo.root}, '1', '2') == (
+            self._command_output(
+                mercurial.commands.debugancestor, repo, '1', '2'))
+
+    def test_ancestors_of_pairs(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        result = hg_remote.ancestors(
+            {'path': repo.root}, [('1', '3'), ('2', '2')])
+
+        assert result == [repo[0].node(), repo[2].node()]
+
+
+class TestDiffStream(object):
+    @pytest.fixture
+    def repo(self, hg_repo, tmpdir):
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            tmpdir.join(name).write('%s\n' % name * 100)
+        hg_repo[None].add(['a.txt', 'b.txt', 'c.txt'])
+        hg_repo.commit(text='add files', user='tester')
+        return hg_repo
+
+    def test_yields_same_diff_as_diff(self, repo):
+        hg_remote = _hg_remote(repo)
+        args = ({'path': repo.root}, '0', '1', None, True, False, 3)
+
+        chunks = list(hg_remote.diff_stream(*args))
+
+        assert len(chunks) > 1
+        assert ''.join(chunks) == hg_remote.diff(*args)
+
+    def test_stops_at_max_files(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        chunks = list(hg_remote.ctx_diff_stream(
+            {'path': repo.root}, '1', max_files=2))
+
+        assert chunks[-1]['limit'] == 'max_files'
+        assert chunks[-1]['files'] == 2
+        diff = ''.join(chunks[:-1])
+        assert 'a.txt' in diff and 'b.txt' in diff and 'c.txt' not in diff
+
+    def test_stops_at_max_bytes(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        chunks = list(hg_remote.ctx_diff_stream(
+            {'path': repo.root}, '1', max_bytes=100))
+
+        assert chunks[-1]['limit'] == 'max_bytes'
+        assert sum(len(chunk) for chunk in chunks[:-1]) <= 100
+
+    def test_raises_lookup_exception_before_streaming(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        with pytest.raises(Exception) as exc_info:
+            hg_remote.diff_stream(
+                {'path': repo.root}, '0', 'missing', None, True, False, 3)
+
+        assert exc_info.value._vcs_kind == 'lookup'
+
+
+class TestCtxStatusMany(object):
+    @pytest.fixture
+    def repo(self, hg_repo, tmpdir):
+        tmpdir.join('file.txt').write('changed\n')
+        tmpdir.join('new.txt').write('new\n')
+        hg_repo[None].add(['new.txt'])
+        hg_repo.commit(text='commit 1', user='tester')
+        hg_repo[None].forget(['file.txt'])
+        tmpdir.join('file.txt').remove()
+        hg_repo.commit(text='commit 2', user='tester')
+        return hg_repo
+
+    def test_matches_ctx_status_and_ctx_files(self, repo):
+        hg_remote = _hg_remote(repo)
+        wire = {'path': repo.root}
+        revisions = ['2', '0', '1']
+
+        result = hg_remote.ctx_status_many(wire, revisions)
+
+        for revision, commit in zip(revisions, result['commits']):
+            status = hg_remote.ctx_status(wire, revision)
+            modified, added, removed, files = [
+                [result['paths'][index] for index in indices]
+                for indices in commit]
+            assert [modified, added, removed] == status[:3]
+            assert files == sorted(hg_remote.ctx_files(wire, revision))
+
+    def test_reads_every_manifest_once(self, repo):
+        hg_remote = _hg_remote(repo)
+
+        with patch('mercurial.context.changectx.manifest',
+                   side_effect=lambda self: self._manifest,
+                   autospec=True) as manifest:
+            hg_remote.ctx_status_many({'path': repo.root}, ['0', '1', '2'])
+
+        # the null revision plus the three revisions
+        assert manifest.call_count == 4
+
+
+class TestLargefiles(object):
+    content = 'largefile content\n' * 100
+    sha = hashlib.sha1(content).hexdigest()
+
+    @pytest.fixture
+    def repo(self, hg_repo, tmpdir):
+        hg_repo.ui.setconfig(
+            'largefiles', 'usercache', str(tmpdir.join('usercache')))
+        return hg_repo
+
+    def test_largefile_store_and_batch_checks(self, repo):
+        hg_remote = _hg_remote(repo)
+        wire = {'path': repo.root}
+        missing = '0' * 40
+
+        path = hg_remote.largefile_store(
+            wire, self.sha, StringIO.StringIO(self.content))
+
+        assert open(path).read() == self.content
+        assert hg_remote.in_store_many(wire, [self.sha, missing]) == [
+            True, False]
+        assert hg_remote.in_user_cache_many(wire, [missing, self.sha]) == [
+            False, True]
+        assert hg_remote.store_paths(wire, [self.sha]) == [path]
+
+    def test_largefile_store_rejects_wrong_content(self, repo):
+        hg_remote = _hg_remote(repo)
+        wire = {'path': repo.root}
+
+        with pytest.raises(Exception) as exc_info:
+            hg_remote.largefile_store(
+                wire, self.sha, StringIO.StringIO('other content'))
+
+        assert exc_info.value._vcs_kind == 'abort'
+        assert hg_remote.in_store_many(wire, [self.sha]) == [False]
+        assert os.listdir(os.path.dirname(
+            hg_remote.store_path(wire, self.sha))) == []
+
+    def test_largefile_store_keeps_default_permissions(self, repo):
+        hg_remote = _hg_remote(repo)
+        wire = {'path': repo.root}
+
+        path = hg_remote.largefile_store(
+            wire, self.sha, StringIO.StringIO(self.content))
+
+        # the same mode as any other file written by this process
+        assert os.stat(path).st_mode == os.stat(repo.wjoin('file.txt')).st_mode
+        assert os.listdir(os.path.dirname(path)) == [self.sha]
+
+    def test_largefile_path_rejects_invalid_hash(self, repo):
+        with pytest.raises(Exception) as exc_info:
+            _hg_remote(repo).largefile_path(
+                {'path': repo.root}, '../../hgrc')
+        assert exc_info.value._vcs_kind == 'lookup'
+
+    def test_largefile_path_links_from_user_cache(self, repo, tmpdir):
+        hg_remote = _hg_remote(repo)
+        wire = {'path': repo.root}
+        cache_path = tmpdir.join('usercache', self.sha)
+        cache_path.write(self.content, ensure=True)
+
+        path = hg_remote.largefile_path(wire, self.sha)
+
+        assert os.path.samefile(path, str(cache_path))
+        assert hg_remote.largefile_path(wire, '0' * 40) is None
+
+    def test_link_many_falls_back_when_hardlinks_fail(self, repo, tmpdir):
+        hg_remote = _hg_remote(repo)
+        tmpdir.join('usercache', self.sha).write(self.content, ensure=True)
+        dest = str(tmpdir.join('linked', 'file'))
+
+        with patch('os.link', side_effect=OSError(1, 'Not permitted')):
+            methods = hg_remote.link_many(
+                {'path': repo.root}, [(self.sha, dest)])
+
+        assert methods[0] in ('reflink', 'copy')
+        assert open(dest).read() == self.content
+        assert os.listdir(os.path.dirname(dest)) == ['file']
+
+    def test_link_replaces_existing_file(self, repo, tmpdir):
+        hg_remote = _hg_remote(repo)
+        cache_path = tmpdir.join('usercache', self.sha)
+        cache_path.write(self.content, ensure=True)
+        dest = tmpdir.join('linked', 'file')
+        dest.write('partial', ensure=True)
+
+        hg_remote.link({'path': repo.root}, self.sha, str(dest))
+
+        assert dest.read() == self.content
+        assert os.listdir(str(dest.dirpath())) == ['file']
+
+    def test_link_many_keeps_existing_link(self, repo, tmpdir):
+        hg_remote = _hg_remote(repo)
+        cache_path = tmpdir.join('usercache', self.sha)
+        cache_path.write(self.content, ensure=True)
+        dest = str(tmpdir.join('file'))
+        os.link(str(cache_path), dest)
+
+        assert hg_remote.link_many(
+            {'path': repo.root}, [(self.sha, dest)]) == ['exists']
+
+
+class TestRevsFromRevspecUnion(object):
+    @pytest.fixture
+    def fork(self, hg_repo, tmpdir):
+        fork_path = str(tmpdir.join('fork'))
+        mercurial.hg.clone(hg_repo.baseui, {}, hg_repo.root, fork_path)
+        fork = mercurial.hg.repository(hg_repo.baseui, fork_path)
+        self._commit(fork, 'fork.txt')
+        return fork
+
+    def _commit(self, repo, name):
+        with open(repo.wjoin(name), 'w') as f:
+            f.write('%s\n' % name)
+        repo[None].add([name])
+        return repo.commit(text=name, user='tester')
+
+    def _call(self, hg_remote, repo, fork, rev_spec, *args, **wire):
+        wire.setdefault('context', 'context-uid')
+        wire.update({'path': fork.root, 'config': []})
+        return hg_remote.revs_from_revspec(
+            wire, rev_spec, *args, other_path=repo.root)
+
+    def test_reuses_union_repository(self, hg_repo, fork):
+        hg_remote = hg.HgRemote(hg.MercurialFactory(None))
+
+        with patch('mercurial.unionrepo.unionrepository',
+                   wraps=mercurial.unionrepo.unionrepository) as union:
+            first = self._call(hg_remote, hg_repo, fork, 'all()')
+            second = self._call(hg_remote, hg_repo, fork, 'all()')
+
+        assert first == second == [0, 1]
+        assert union.call_count == 1
+
+    @pytest.mark.parametrize('wire', [
+        {'context': None},
+        {'context': 'context-uid', 'cache': False},
+    ])
+    def test_union_repository_not_shared_outside_context(
+            self, hg_repo, fork, wire):
+        hg_remote = hg.HgRemote(hg.MercurialFactory(None))
+
+        with patch('mercurial.unionrepo.unionrepository',
+                   wraps=mercurial.unionrepo.unionrepository) as union:
+            self._call(hg_remote, hg_repo, fork, 'all()', **wire)
+            self._call(hg_remote, hg_repo, fork, 'all()', **wire)
+
+        assert union.call_count == 2
+
+    def test_union_repository_not_shared_between_contexts(
+            self, hg_repo, fork):
+        hg_remote = hg.HgRemote(hg.MercurialFactory(None))
+
+        with patch('mercurial.unionrepo.unionrepository',
+                   wraps=mercurial.unionrepo.unionrepository) as union:
+            self._call(hg_remote, hg_repo, fork, 'all()', context='a')
+            self._call(hg_remote, hg_repo, fork, 'all()', context='b')
+
+        assert union.call_count == 2
+
+    def test_recreates_union_repository_after_changes(self, hg_repo, fork):
+        hg_remote = hg.HgRemote(hg.MercurialFactory(None))
+        assert self._call(hg_remote, hg_repo, fork, 'all()') == [0, 1]
+
+        self._commit(fork, 'other.txt')
+
+        assert self._call(hg_remote, hg_repo, fork, 'all()') == [0, 1, 2]
+
+    def test_memoizes_specs_of_commit_ids(self, hg_repo, fork):
+        hg_remote = hg.HgRemote(hg.MercurialFactory(None))
+        node = hex(fork['tip'].node())
+
+        with patch('mercurial.localrepo.localrepository.revs',
+                   autospec=True,
+                   side_effect=lambda repo, spec, *args: [1]) as revs:
+            for _ in range(3):
+                result = self._call(
+                    hg_remote, hg_repo, fork, 'ancestors(%s)', node)
+
+        assert result == [1]
+        assert revs.call_count == 1
+
+    def test_does_not_memoize_specs_without_arguments(self, hg_repo, fork):
+        hg_remote = hg.HgRemote(hg.MercurialFactory(None))
+
+        with patch('mercurial.localrepo.localrepository.revs',
+                   autospec=True,
+                   side_effect=lambda repo, spec, *args: [1]) as revs:
+            for _ in range(2):
+                self._call(hg_remote, hg_repo, fork, 'draft()')
+
+        assert revs.call_count == 2
+
+    def test_memoized_specs_follow_bookmarks(self, hg_repo, fork):
+        hg_remote = hg.HgRemote(hg.MercurialFactory(None))
+        node = hex(fork['tip'].node())
+        spec = 'ancestors(%s) and bookmark()'
+        assert self._call(hg_remote, hg_repo, fork, spec, node) == []
+
+        mercurial.commands.bookmark(hg_repo.ui, hg_repo, 'feature', rev='0')
+
+        assert self._call(hg_remote, hg_repo, fork, spec, node) == [0]
+
+
 class TestReraiseSafeExceptions(object):
     def test_method_decorated_with_reraise_safe_exceptions(self):
         factory = Mock()
@@ -0,0 +1,107 @@
+# RhodeCode VCSServer provides access to different vcs backends via network.
+# Copyright (C) 2014-2016 RodeCode GmbH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import os
+
+import mercurial.hg
+import mercurial.ui
+import mock
+import pytest
+
+from vcsserver import hgcache, scm_app
+
+
+@pytest.fixture
+def warmer():
+    warmer = hgcache.CacheWarmer()
+    with mock.patch.object(warmer, '_ensure_worker'):
+        yield warmer
+
+
+@pytest.fixture
+def repo(tmpdir):
+    baseui = mercurial.ui.ui()
+    baseui.setconfig('ui', 'quiet', 'true')
+    repo = mercurial.hg.repository(baseui, str(tmpdir), create=True)
+    tmpdir.join('file.txt').write('content\n')
+    repo[None].add(['file.txt'])
+    repo.commit(text='initial', user='tester')
+    return repo
+
+
+def _cache_files(repo):
+    return sorted(os.listdir(repo.join('cache')))
+
+
+def test_schedule_coalesces_waiting_repositories(warmer):
+    baseui = mercurial.ui.ui()
+
+    warmer.schedule('/repo/a', baseui)
+    warmer.schedule('/repo/b', baseui)
+    warmer.schedule('/repo/a', baseui)
+
+    assert warmer.stats() == {
+        'pending': 2, 'warmed': 0, 'coalesced': 1, 'failed': 0}
+
+
+def test_schedule_does_nothing_when_disabled(warmer):
+    with mock.patch('vcsserver.settings.HG_WARM_CACHES', False):
+        warmer.schedule('/repo/a', mercurial.ui.ui())
+
+    assert warmer.stats()['pending'] == 0
+
+
+def test_run_pending_writes_caches(warmer, repo):
+    for name in os.listdir(repo.join('cache')):
+        os.unlink(repo.join('cache', name))
+
+    warmer.schedule_repo(repo)
+    warmer.run_pending()
+
+    cache_files = _cache_files(repo)
+    assert 'branch2-served' in cache_files
+    assert 'tags2' in cache_files
+    assert 'rbc-revs-v1' in cache_files
+    assert warmer.stats()['warmed'] == 1
+
+
+def test_warm_does_not_reread_known_revisions(warmer, repo):
+    warmer.warm(repo.root, repo.baseui)
+
+    with mock.patch('mercurial.branchmap.revbranchcache.branchinfo',
+                    autospec=True) as branchinfo:
+        warmer.warm(repo.root, repo.baseui)
+
+    assert not branchinfo.called
+
+
+def test_run_pending_counts_failures(warmer, tmpdir):
+    warmer.schedule(str(tmpdir.join('missing')), mercurial.ui.ui())
+    warmer.run_pending()
+
+    assert warmer.stats()['failed'] == 1
+
+
+def test_hgweb_transactions_schedule_warming(tmpdir, repo):
+    app = scm_app.create_hg_wsgi_app(repo.root, 'repo', [])
+    hgweb_repo = app._lastrepo.fetch()[0]
+
+    tmpdir.join('file.txt').write('changed\n')
+    with mock.patch.object(hgcache, 'warmer') as warmer:
+        hgweb_repo.commit(text='second', user='tester')
+
+    warmer.schedule_repo.assert_called_once_with(hgweb_repo.unfiltered())
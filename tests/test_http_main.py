@@ -0,0 +1,195 @@
+# RhodeCode VCSServer provides access to different vcs backends via network.
+# Copyright (C) 2014-2016 RodeCode GmbH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import base64
+
+import mock
+import msgpack
+import pytest
+import webob
+
+from vcsserver import http_main
+
+
+class StubRemote(object):
+    def diff_stream(self, wire, fail=False):
+        if fail:
+            raise KeyError('missing')
+
+        def chunks():
+            yield 'diff --git a/file b/file\n'
+            yield {'limit': 'max_files'}
+        return chunks()
+
+    def broken_stream(self, wire):
+        yield 'first'
+        raise ValueError('broken')
+
+    def diff(self, wire):
+        return 'diff'
+
+
+@pytest.fixture
+def app():
+    with mock.patch.object(http_main.HTTPApplication, '__init__',
+                           return_value=None):
+        app = http_main.HTTPApplication()
+    app._remotes = {'hg': StubRemote()}
+    return app
+
+
+def _call(app, method, **kwargs):
+    request = webob.Request.blank('/hg/stream', method='POST')
+    request.body = msgpack.packb({
+        'id': 'request-id',
+        'method': method,
+        'params': {'wire': {'path': 'repo'}, 'args': [], 'kwargs': kwargs},
+    })
+    request.matchdict = {'backend': 'hg'}
+    response = app.vcs_stream_view(request)
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(''.join(response.app_iter))
+    return list(unpacker)
+
+
+def test_vcs_stream_view_streams_chunks(app):
+    assert _call(app, 'diff_stream') == [
+        'diff --git a/file b/file\n', {'limit': 'max_files'}]
+
+
+def test_vcs_stream_view_returns_error_before_streaming(app):
+    result = _call(app, 'diff_stream', fail=True)
+
+    assert len(result) == 1
+    assert result[0]['id'] == 'request-id'
+    assert result[0]['error']['type'] == 'KeyError'
+
+
+def test_vcs_stream_view_appends_error_while_streaming(app):
+    result = _call(app, 'broken_stream')
+
+    assert result[0] == 'first'
+    assert result[1]['error']['message'] == 'broken'
+
+
+def test_vcs_stream_view_rejects_non_stream_methods(app):
+    result = _call(app, 'diff')
+
+    assert 'error' in result[0]
+
+
+class StubLargefilesRemote(object):
+    def __init__(self, path):
+        self.path = path
+        self.stored = None
+
+    def largefile_path(self, wire, sha):
+        return self.path if sha == 'a' * 40 else None
+
+    def largefile_store(self, wire, sha, stream):
+        self.stored = (wire, sha, stream.read())
+
+
+def _largefiles_request(method, sha, body=''):
+    request = webob.Request.blank(
+        '/largefiles/hg/%s' % sha, method=method,
+        headers={'X-RC-REPO-PATH': '/repo',
+                 'X-RC-REPO-CONFIG': base64.b64encode(msgpack.packb([]))})
+    request.body = body
+    request.matchdict = {'sha': sha}
+    return request
+
+
+def test_largefiles_hg_view_downloads(app, tmpdir):
+    largefile = tmpdir.join('largefile')
+    largefile.write('content')
+    app._remotes['hg'] = StubLargefilesRemote(str(largefile))
+
+    response = app.largefiles_hg_view(_largefiles_request('GET', 'a' * 40))
+    assert ''.join(response.app_iter) == 'content'
+
+    response = app.largefiles_hg_view(_largefiles_request('GET', 'b' * 40))
+    assert response.status_int == 404
+
+
+def test_largefiles_hg_view_uploads(app):
+    remote = app._remotes['hg'] = StubLargefilesRemote(None)
+
+    response = app.largefiles_hg_view(
+        _largefiles_request('PUT', 'a' * 40, body='content'))
+
+    assert response.status_int == 201
+    assert remote.stored == (
+        {'path': '/repo', 'config': []}, 'a' * 40, 'content')
+
+
+class StubSvnRemote(object):
+    def commit_nodes(self, wire, message, author, timestamp, nodes,
+                     removed):
+        self.committed = [
+            (node['path'], ''.join(chunks)) for node, chunks in nodes]
+        self.removed = removed
+        return 7
+
+
+def _svn_commit_request(*objects):
+    request = webob.Request.blank('/svn/commit', method='POST')
+    request.body = ''.join(msgpack.packb(obj) for obj in objects)
+    return request
+
+
+def test_svn_commit_view_streams_nodes(app):
+    remote = app._remotes['svn'] = StubSvnRemote()
+    request = _svn_commit_request(
+        {'id': 'request-id', 'wire': {'path': '/repo'}, 'message': 'msg',
+         'author': 'tester', 'removed': [{'path': 'old'}]},
+        {'path': 'a'}, 'first ', 'chunk', None,
+        {'path': 'b'}, None)
+
+    response = app.svn_commit_view(request)
+
+    assert msgpack.unpackb(response.body) == {
+        'id': 'request-id', 'result': 7}
+    assert remote.committed == [('a', 'first chunk'), ('b', '')]
+    assert remote.removed == [{'path': 'old'}]
+
+
+def test_svn_commit_view_rejects_truncated_stream(app):
+    app._remotes['svn'] = StubSvnRemote()
+    request = _svn_commit_request(
+        {'id': 'request-id', 'wire': {'path': '/repo'}, 'message': 'msg',
+         'author': 'tester'},
+        {'path': 'a'}, 'chunk')
+
+    response = app.svn_commit_view(request)
+
+    error = msgpack.unpackb(response.body)['error']
+    assert 'ended within the content' in error['message']
+
+
+@pytest.mark.parametrize('body, message', [
+    ('', 'is empty'),
+    (msgpack.packb('garbled'), 'does not start with a header'),
+])
+def test_svn_commit_view_rejects_missing_header(app, body, message):
+    app._remotes['svn'] = StubSvnRemote()
+    request = webob.Request.blank('/svn/commit', method='POST')
+    request.body = body
+
+    response = app.svn_commit_view(request)
+
+    assert message in msgpack.unpackb(response.body)['error']['message']
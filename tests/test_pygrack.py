@@ -132,6 +132,79 @@ def test_pull_has_hook_messages(pygrack_app):
     assert packets == ['NAK\n', '\x02foo', 'subp\n', '\x02bar']
 
 
+def test_inforefs_protocol_v2_skips_service_advert(pygrack_app):
+    with mock.patch('vcsserver.subprocessio.SubprocessIOChunker',
+                    return_value=['0014version 2\n']) as chunker:
+        response = pygrack_app.get(
+            '/repo_name/info/refs?service=git-upload-pack',
+            headers={'Git-Protocol': 'version=2'})
+
+    assert response.body == '0014version 2\n'
+    kwargs = chunker.call_args[1]
+    assert kwargs['starting_values'] == []
+    assert kwargs['env']['GIT_PROTOCOL'] == 'version=2'
+
+
+def test_protocol_v2_runs_pull_hooks_only_for_fetch(pygrack_app):
+    request = '0014command=ls-refs\n0000'
+    with mock.patch('vcsserver.hooks.git_pre_pull') as pre_pull:
+        with mock.patch('vcsserver.subprocessio.SubprocessIOChunker',
+                        return_value=['0000']):
+            pygrack_app.post(
+                '/git-upload-pack', params=request,
+                content_type='application/x-git-upload-pack',
+                headers={'Git-Protocol': 'version=2'})
+
+    assert not pre_pull.called
+
+
+def test_protocol_v2_failed_pre_pull_sends_error_packet(pygrack_app):
+    request = '0012command=fetch\n0001000ethin-pack\n0009done\n0000'
+    with mock.patch('vcsserver.hooks.git_pre_pull',
+                    return_value=hooks.HookResponse(1, 'foo\n')):
+        response = pygrack_app.post(
+            '/git-upload-pack', params=request,
+            content_type='application/x-git-upload-pack',
+            headers={'Git-Protocol': 'version=2'})
+
+    data = io.BytesIO(response.body)
+    proto = dulwich.protocol.Protocol(data.read, None)
+    packets = list(proto.read_pkt_seq())
+
+    assert packets == ['ERR foo\nPre pull hook failed: aborting']
+    assert data.read() == ''
+
+
+def test_protocol_v2_fetch_has_hook_messages(pygrack_app):
+    request = '0012command=fetch\n0001000ethin-pack\n0009done\n0000'
+    output = ['000dpackfile\n', '0009\x01PACK', '0000']
+    with mock.patch('vcsserver.hooks.git_pre_pull',
+                    return_value=hooks.HookResponse(0, 'foo')):
+        with mock.patch('vcsserver.hooks.git_post_pull',
+                        return_value=hooks.HookResponse(0, 'bar')):
+            with mock.patch('vcsserver.subprocessio.SubprocessIOChunker',
+                            return_value=output):
+                response = pygrack_app.post(
+                    '/git-upload-pack', params=request,
+                    content_type='application/x-git-upload-pack',
+                    headers={'Git-Protocol': 'version=2'})
+
+    data = io.BytesIO(response.body)
+    proto = dulwich.protocol.Protocol(data.read, None)
+    packets = list(proto.read_pkt_seq())
+
+    assert packets == ['packfile\n', '\x01PACK', '\x02foo', '\x02bar']
+    assert data.read() == ''
+
+
+def test_protocol_v2_response_without_packfile_is_unchanged(
+        pygrack_instance):
+    response = ['0013acknowledgments\n', '0008NAK\n', '0000']
+
+    assert pygrack_instance._inject_messages_to_response(
+        response, frozenset(), 'foo', 'bar', protocol_v2=True) == response
+
+
 def test_get_want_capabilities(pygrack_instance):
     data = io.BytesIO(
         '0054want 74730d410fcb6603ace96f1dc55ea6196122532d ' +
@@ -247,3 +320,32 @@ def test_build_failed_pre_pull_response(pygrack_instance, capabilities):
     ]
 
     assert response == expected_response
+
+
+def test_pull_without_hooks_relays_output_to_file_wrapper(pygrack_app):
+    file_wrapper = mock.Mock(return_value=['0008NAK\n'])
+    with mock.patch('vcsserver.settings.SUBPROCESSIO_USE_FILE_WRAPPER', True), \
+            mock.patch('vcsserver.hooks.git_pre_pull',
+                       return_value=hooks.HookResponse(0, '')), \
+            mock.patch('vcsserver.subprocessio.SubprocessIORelay') as relay:
+        response = pygrack_app.post(
+            '/git-upload-pack', params='0000',
+            content_type='application/x-git-upload-pack',
+            extra_environ={'wsgi.file_wrapper': file_wrapper})
+
+    assert response.body == '0008NAK\n'
+    file_wrapper.assert_called_once_with(relay.return_value, mock.ANY)
+
+
+def test_pull_returns_503_if_no_process_slot_is_free(pygrack_app):
+    with mock.patch('vcsserver.hooks.git_pre_pull',
+                    return_value=hooks.HookResponse(0, '')), \
+            mock.patch('vcsserver.subprocessio.SubprocessIOChunker',
+                       side_effect=pygrack.subprocessio.AdmissionTimeout):
+        response = pygrack_app.post(
+            '/git-upload-pack', params='0000',
+            content_type='application/x-git-upload-pack',
+            expect_errors=True)
+
+    assert response.status_int == 503
+    assert response.headers['Retry-After'] == '10'
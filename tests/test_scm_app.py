@@ -84,3 +84,31 @@ def test_git_fallbacks_to_git_folder(tmpdir):
                        expect_errors=True)
 
     assert response.status_int == 403
+
+
+def test_get_hg_wsgi_app_reuses_app_for_same_config(tmpdir):
+    mercurial.hg.repository(mercurial.ui.ui(), str(tmpdir), create=True)
+    config = [['paths', 'default', '']]
+
+    with mock.patch('vcsserver.scm_app._hg_wsgi_apps', None):
+        app = scm_app.get_hg_wsgi_app(str(tmpdir), 'repo', config)
+        same_app = scm_app.get_hg_wsgi_app(str(tmpdir), 'repo', config)
+        other_app = scm_app.get_hg_wsgi_app(
+            str(tmpdir), 'repo', config + [['web', 'push_ssl', 'false']])
+
+        tmpdir.join('.hg', 'hgrc').write('[web]\nallow_push = *\n')
+        after_hgrc_change = scm_app.get_hg_wsgi_app(
+            str(tmpdir), 'repo', config)
+
+    assert app is same_app
+    assert app is not other_app
+    assert app is not after_hgrc_change
+
+
+def test_get_hg_wsgi_app_without_cache(tmpdir):
+    mercurial.hg.repository(mercurial.ui.ui(), str(tmpdir), create=True)
+
+    with mock.patch('vcsserver.settings.HG_WSGI_APP_CACHE_SIZE', 0):
+        app = scm_app.get_hg_wsgi_app(str(tmpdir), 'repo', [])
+
+        assert app is not scm_app.get_hg_wsgi_app(str(tmpdir), 'repo', [])
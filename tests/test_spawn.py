@@ -0,0 +1,132 @@
+# RhodeCode VCSServer provides access to different vcs backends via network.
+# Copyright (C) 2014-2016 RodeCode GmbH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import os
+import signal
+import sys
+import time
+
+import mock
+import pytest
+import subprocess32 as subprocess
+
+from vcsserver import spawn, subprocessio
+
+
+pytestmark = pytest.mark.skipif(
+    not spawn.available(), reason='posix_spawn is not usable')
+
+
+def _get_python_args(script):
+    return [sys.executable, '-c', 'import sys, os; ' + script]
+
+
+def test_popen_pipes():
+    process = spawn.Popen(
+        _get_python_args('sys.stdout.write(sys.stdin.read().upper()); '
+                         'sys.stderr.write("err"); sys.exit(3)'),
+        stdin=spawn.PIPE, stdout=spawn.PIPE, stderr=spawn.PIPE)
+    process.stdin.write('input')
+    process.stdin.close()
+
+    assert process.stdout.read() == 'INPUT'
+    assert process.stderr.read() == 'err'
+    assert process.wait() == 3
+
+
+def test_popen_cwd_env_and_shell(tmpdir):
+    process = spawn.Popen(
+        'echo $SPAWN_TEST; pwd', shell=True, cwd=str(tmpdir),
+        env={'SPAWN_TEST': 'value', 'PATH': os.environ['PATH']},
+        stdout=spawn.PIPE)
+
+    assert process.stdout.read().splitlines() == ['value', str(tmpdir)]
+    assert process.wait() == 0
+
+
+def test_popen_closes_other_file_descriptors():
+    read_fd, write_fd = os.pipe()
+    try:
+        process = spawn.Popen(
+            _get_python_args('os.fstat(%d)' % write_fd), stderr=spawn.PIPE)
+        assert process.wait() == 1
+        assert 'Bad file descriptor' in process.stderr.read()
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_popen_restores_sigpipe():
+    process = spawn.Popen(
+        ['grep', 'SigIgn', '/proc/self/status'], stdout=spawn.PIPE)
+    ignored = int(process.stdout.read().split()[1], 16)
+    process.wait()
+
+    assert not ignored & (1 << (signal.SIGPIPE - 1))
+
+
+def test_popen_terminate():
+    process = spawn.Popen(_get_python_args('import time; time.sleep(10)'))
+    process.terminate()
+
+    assert process.wait() == -15
+
+
+def test_popen_missing_executable_raises():
+    with pytest.raises(OSError):
+        spawn.Popen(['does-not-exist-vcsserver'])
+
+
+@pytest.mark.parametrize('kwargs, expected', [
+    ({'stdout': spawn.PIPE, 'env': {}, 'cwd': '/'}, True),
+    ({'stderr': subprocess.STDOUT}, False),
+    ({'preexec_fn': lambda: None}, False),
+])
+def test_can_spawn(kwargs, expected):
+    assert spawn.can_spawn(kwargs) == expected
+
+
+def test_chunker_uses_posix_spawn_if_configured():
+    with mock.patch('vcsserver.settings.SUBPROCESSIO_SPAWN', 'posix_spawn'):
+        chunker = subprocessio.SubprocessIOChunker(
+            _get_python_args('sys.stdout.write("out")'), shell=False)
+        output = ''.join(chunker)
+
+    assert isinstance(chunker.process, spawn.Popen)
+    assert output == 'out'
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('ballast_mb', [0, 128, 512])
+@pytest.mark.parametrize('popen', [subprocess.Popen, spawn.Popen],
+                         ids=['fork', 'posix_spawn'])
+def test_spawn_latency_by_rss(ballast_mb, popen, repeat, benchmark_results):
+    # touch the memory, so that it is part of the RSS of the worker
+    ballast = bytearray(ballast_mb * 1024 * 1024)
+    calls = max(repeat / 10, 1)
+
+    start = time.time()
+    for x in xrange(calls):
+        popen(['true']).wait()
+    latency = (time.time() - start) / calls
+
+    benchmark_results.append({
+        'benchmark': '%s.Popen' % popen.__module__,
+        'ballast_mb': ballast_mb,
+        'latency_ms': latency * 1000,
+    })
+    del ballast
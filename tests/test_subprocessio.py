@@ -17,8 +17,12 @@
 
 import io
 import os
+import signal
 import sys
+import threading
+import time
 
+import mock
 import pytest
 
 from vcsserver import subprocessio
@@ -120,3 +124,232 @@ def test_output_with_input_skipping_iterator(size, environ):
 
     print len(data), len(output)
     assert output == data
+
+
+@pytest.fixture(params=['thread', 'eventloop'])
+def engine(request):
+    return request.param
+
+
+@pytest.mark.parametrize('size', [1, 10**5, 10**6])
+def test_engines_output_with_input(size, engine, environ):
+    data = 'X' * size
+    inputstream = io.BytesIO(data)
+    args = _get_python_args('shutil.copyfileobj(sys.stdin, sys.stdout)')
+    output = ''.join(subprocessio.SubprocessIOChunker(
+        args, shell=False, inputstream=inputstream, env=environ,
+        engine=engine, chunk_size=65536, buffer_size=1024 * 1024))
+
+    assert output == data
+
+
+def test_engines_string_input(engine, environ):
+    args = _get_python_args('shutil.copyfileobj(sys.stdin, sys.stdout)')
+    output = ''.join(subprocessio.SubprocessIOChunker(
+        args, shell=False, inputstream='X' * 10**5, env=environ,
+        engine=engine))
+
+    assert output == 'X' * 10**5
+
+
+def test_engines_starting_values(engine, environ):
+    args = _get_python_args('sys.stdout.write("out")')
+    output = ''.join(subprocessio.SubprocessIOChunker(
+        args, shell=False, starting_values=['start-'], env=environ,
+        engine=engine))
+
+    assert output == 'start-out'
+
+
+def test_engines_raise_exception_on_stderr(engine, environ):
+    args = _get_python_args('sys.stderr.write("X"); time.sleep(1);')
+    with pytest.raises(EnvironmentError) as excinfo:
+        list(subprocessio.SubprocessIOChunker(
+            args, shell=False, env=environ, engine=engine))
+
+    assert 'exited due to an error:\nX' in str(excinfo.value)
+
+
+def test_engines_raise_exception_on_non_zero_return_code(engine, environ):
+    args = _get_python_args('sys.exit(1)')
+    with pytest.raises(EnvironmentError):
+        list(subprocessio.SubprocessIOChunker(
+            args, shell=False, env=environ, engine=engine))
+
+
+def test_eventloop_pauses_reading_when_buffer_is_full(environ):
+    args = _get_python_args('sys.stdout.write("X" * 10**6)')
+    chunker = subprocessio.SubprocessIOChunker(
+        args, shell=False, env=environ, engine='eventloop',
+        chunk_size=4096, buffer_size=16384)
+
+    assert chunker.output.reading_paused
+    assert sum(len(chunk) for chunk in chunker.output.data) < 10**6
+    assert len(''.join(chunker)) == 10**6
+
+
+def test_eventloop_feeds_file_like_input_from_own_thread(environ):
+    args = _get_python_args('shutil.copyfileobj(sys.stdin, sys.stdout)')
+    chunker = subprocessio.SubprocessIOChunker(
+        args, shell=False, inputstream=io.BytesIO('X' * 10**5),
+        env=environ, engine='eventloop')
+
+    assert chunker._close_input_fd is not None
+    assert ''.join(chunker) == 'X' * 10**5
+
+
+def _failing_loop():
+    loop = subprocessio.IOLoop()
+    read_fd, write_fd = os.pipe()
+    reader = subprocessio.PipeReader(os.fdopen(read_fd, 'rb'), loop)
+    return loop, reader, write_fd
+
+
+def test_ioloop_aborts_waiting_readers_when_it_stops():
+    loop, reader, write_fd = _failing_loop()
+    errors = []
+
+    def consume():
+        try:
+            next(reader)
+        except IOError as e:
+            errors.append(e)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    with mock.patch.object(loop, '_serve', side_effect=ValueError()):
+        time.sleep(0.1)
+        loop.start()
+        loop.join(5)
+    consumer.join(5)
+    os.close(write_fd)
+
+    assert loop.stopped
+    assert not consumer.is_alive()
+    assert len(errors) == 1
+
+
+def test_ioloop_instance_replaces_stopped_loop():
+    loop, reader, write_fd = _failing_loop()
+    with mock.patch.object(loop, '_serve', side_effect=ValueError()):
+        loop.start()
+        loop.join(5)
+    os.close(write_fd)
+
+    with mock.patch.object(subprocessio.IOLoop, '_instance', loop):
+        new_loop = subprocessio.IOLoop.instance()
+
+    assert new_loop is not loop
+    assert not new_loop.stopped
+    read_fd, write_fd = os.pipe()
+    with pytest.raises(IOError):
+        subprocessio.PipeReader(os.fdopen(read_fd, 'rb'), loop)
+    os.close(write_fd)
+
+
+def test_ioloop_instance_is_replaced_in_forked_process():
+    loop = subprocessio.IOLoop.instance()
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            # fail instead of hanging if the inherited loop is used
+            signal.alarm(5)
+            read_fd, write_fd = os.pipe()
+            child_loop = subprocessio.IOLoop.instance()
+            reader = subprocessio.PipeReader(
+                os.fdopen(read_fd, 'rb'), child_loop)
+            os.write(write_fd, 'data')
+            os.close(write_fd)
+            if child_loop is not loop and ''.join(reader) == 'data':
+                status = 0
+        finally:
+            os._exit(status)
+
+    assert os.waitpid(pid, 0)[1] == 0
+    assert subprocessio.IOLoop.instance() is loop
+
+
+def test_unknown_engine_raises(environ):
+    with pytest.raises(ValueError):
+        subprocessio.SubprocessIOChunker(
+            _get_python_args(''), shell=False, env=environ, engine='unknown')
+
+
+def test_relay_reads_output(engine, environ):
+    args = _get_python_args('shutil.copyfileobj(sys.stdin, sys.stdout)')
+    relay = subprocessio.SubprocessIORelay(
+        args, shell=False, env=environ, engine=engine,
+        inputstream=io.BytesIO('X' * 10**5))
+
+    assert relay.read() == 'X' * 10**5
+    relay.close()
+    assert relay.process.returncode == 0
+
+
+def test_relay_close_terminates_unfinished_process(environ):
+    args = _get_python_args('sys.stdout.write("X" * 10**6)')
+    relay = subprocessio.SubprocessIORelay(args, shell=False, env=environ)
+
+    assert relay.read(10) == 'X' * 10
+    relay.close()
+    assert relay.process.returncode is not None
+
+
+def test_admission_limits_per_key_without_blocking_other_keys():
+    controller = subprocessio.AdmissionController(
+        max_processes=3, max_per_key=1, timeout=0.1)
+    ticket = controller.acquire('repo1')
+
+    with pytest.raises(subprocessio.AdmissionTimeout):
+        controller.acquire('repo1')
+    other = controller.acquire('repo2')
+
+    stats = controller.stats()
+    assert stats['running'] == 2
+    assert stats['running_per_repo'] == {'repo1': 1, 'repo2': 1}
+    assert stats['timed_out'] == 1
+    ticket.release()
+    other.release()
+    assert controller.stats()['running'] == 0
+
+
+def test_admission_grants_slots_in_fifo_order():
+    controller = subprocessio.AdmissionController(
+        max_processes=1, max_per_key=0, timeout=5)
+    ticket = controller.acquire('repo')
+    granted = []
+
+    def wait_for_slot(name):
+        controller.acquire('repo').release()
+        granted.append(name)
+
+    threads = []
+    for name in ('first', 'second', 'third'):
+        thread = threading.Thread(target=wait_for_slot, args=(name, ))
+        thread.start()
+        threads.append(thread)
+        while controller.stats()['queued'] < len(threads):
+            time.sleep(0.01)
+
+    ticket.release()
+    for thread in threads:
+        thread.join()
+
+    assert granted == ['first', 'second', 'third']
+    assert controller.stats()['admitted'] == 4
+
+
+def test_chunker_releases_admission_slot_on_close(environ):
+    controller = subprocessio.AdmissionController(
+        max_processes=1, max_per_key=0, timeout=0.1)
+    with mock.patch('vcsserver.subprocessio.admission', controller):
+        chunker = subprocessio.SubprocessIOChunker(
+            _get_python_args('sys.stdout.write("out")'), shell=False,
+            env=environ, admission_key='repo')
+        assert controller.stats()['running'] == 1
+        assert ''.join(chunker) == 'out'
+        chunker.close()
+
+    assert controller.stats()['running'] == 0
@@ -0,0 +1,221 @@
+# RhodeCode VCSServer provides access to different vcs backends via network.
+# Copyright (C) 2014-2016 RodeCode GmbH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Benchmarks of the streaming classes in `subprocessio`.
+
+Every test records the throughput in MB/s, the CPU time per MB of this
+process and of the generator processes, the peak RSS growth and the peak
+number of threads. Run with `--benchmark-output=results.json` to get the
+results in machine-readable form. The large payloads only run with
+`--benchmarks`.
+"""
+
+import os
+import resource
+import subprocess
+import threading
+import time
+
+import pytest
+
+from vcsserver import subprocessio
+
+
+MB = 1024 * 1024
+
+CHUNK_SIZES = [4096, 65536]
+BUFFER_SIZES = [65536, MB]
+PAYLOAD_SIZES = [MB, pytest.param(16 * MB, marks=pytest.mark.benchmark)]
+CONCURRENCY = [1, 4]
+
+
+class Sampler(threading.Thread):
+    """
+    Samples the RSS and the number of threads of this process.
+    """
+
+    def __init__(self, interval=0.005):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.start_rss = self.peak_rss = _get_rss()
+        self.peak_threads = threading.active_count()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._sample()
+            self._stop_event.wait(self.interval)
+
+    def _sample(self):
+        self.peak_rss = max(self.peak_rss, _get_rss())
+        # the sampler itself is not counted
+        self.peak_threads = max(
+            self.peak_threads, threading.active_count() - 1)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._sample()
+
+
+def _get_rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _generator_cmd(payload_size):
+    return ['dd', 'if=/dev/zero', 'bs=%d' % MB,
+            'count=%d' % (payload_size / MB), 'status=none']
+
+
+def _measure(benchmark_results, name, params, payload_size, concurrency,
+             target):
+    """
+    Runs `target` in `concurrency` threads and records the resource usage.
+
+    `target` has to return the number of bytes it has processed.
+    """
+    processed = []
+    sampler = Sampler()
+    sampler.start()
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+
+    threads = [
+        threading.Thread(target=lambda: processed.append(target()))
+        for x in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    duration = time.time() - start
+    end_self = resource.getrusage(resource.RUSAGE_SELF)
+    end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    sampler.stop()
+
+    assert processed == [payload_size] * concurrency
+    total_mb = float(payload_size * concurrency) / MB
+
+    def cpu(end, start):
+        return (end.ru_utime - start.ru_utime) + (end.ru_stime - start.ru_stime)
+
+    result = dict(params)
+    result.update({
+        'benchmark': name,
+        'payload_size': payload_size,
+        'concurrency': concurrency,
+        'duration': duration,
+        'mb_per_second': total_mb / duration,
+        'cpu_per_mb': cpu(end_self, start_self) / total_mb,
+        'children_cpu_per_mb': cpu(end_children, start_children) / total_mb,
+        'peak_rss_growth': sampler.peak_rss - sampler.start_rss,
+        'peak_threads': sampler.peak_threads,
+    })
+    benchmark_results.append(result)
+    return result
+
+
+@pytest.mark.parametrize('engine', ['thread', 'eventloop'])
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('buffer_size', BUFFER_SIZES)
+@pytest.mark.parametrize('payload_size', PAYLOAD_SIZES)
+@pytest.mark.parametrize('concurrency', CONCURRENCY)
+def test_subprocessio_chunker_output(
+        engine, chunk_size, buffer_size, payload_size, concurrency,
+        benchmark_results):
+
+    def target():
+        chunker = subprocessio.SubprocessIOChunker(
+            _generator_cmd(payload_size), shell=False, engine=engine,
+            chunk_size=chunk_size, buffer_size=buffer_size)
+        size = sum(len(chunk) for chunk in chunker)
+        chunker.close()
+        return size
+
+    _measure(benchmark_results, 'SubprocessIOChunker', {
+        'engine': engine,
+        'chunk_size': chunk_size,
+        'buffer_size': buffer_size,
+    }, payload_size, concurrency, target)
+
+
+@pytest.mark.parametrize('engine', ['thread', 'eventloop'])
+@pytest.mark.parametrize('payload_size', PAYLOAD_SIZES)
+@pytest.mark.parametrize('concurrency', CONCURRENCY)
+def test_subprocessio_chunker_input_and_output(
+        engine, payload_size, concurrency, benchmark_results):
+    data = '\0' * payload_size
+
+    def target():
+        chunker = subprocessio.SubprocessIOChunker(
+            ['cat'], inputstream=data, shell=False, engine=engine)
+        size = sum(len(chunk) for chunk in chunker)
+        chunker.close()
+        return size
+
+    _measure(benchmark_results, 'SubprocessIOChunker+input', {
+        'engine': engine,
+    }, payload_size, concurrency, target)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('buffer_size', BUFFER_SIZES)
+@pytest.mark.parametrize('payload_size', PAYLOAD_SIZES)
+@pytest.mark.parametrize('concurrency', CONCURRENCY)
+def test_buffered_generator(
+        chunk_size, buffer_size, payload_size, concurrency,
+        benchmark_results):
+
+    def target():
+        process = subprocess.Popen(
+            _generator_cmd(payload_size), stdout=subprocess.PIPE)
+        generator = subprocessio.BufferedGenerator(
+            process.stdout, buffer_size, chunk_size)
+        size = sum(len(chunk) for chunk in generator)
+        process.wait()
+        return size
+
+    _measure(benchmark_results, 'BufferedGenerator', {
+        'chunk_size': chunk_size,
+        'buffer_size': buffer_size,
+    }, payload_size, concurrency, target)
+
+
+@pytest.mark.parametrize('payload_size', PAYLOAD_SIZES)
+@pytest.mark.parametrize('concurrency', CONCURRENCY)
+def test_stream_feeder(payload_size, concurrency, benchmark_results):
+    data = '\0' * payload_size
+
+    def target():
+        feeder = subprocessio.StreamFeeder(data)
+        feeder.start()
+        size = 0
+        while True:
+            chunk = os.read(feeder.output, MB)
+            if not chunk:
+                break
+            size += len(chunk)
+        os.close(feeder.output)
+        feeder.join()
+        return size
+
+    _measure(benchmark_results, 'StreamFeeder', {},
+             payload_size, concurrency, target)
@@ -15,10 +15,12 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import gc
 import io
 import mock
 import pytest
 import sys
+import threading
 
 
 class MockPopen(object):
@@ -65,3 +67,443 @@ def test_svn_libraries_can_be_imported():
     import svn
     import svn.client
     assert svn.client is not None
+
+
+def test_revision_changes_range_caches_revisions():
+    from vcsserver import svn
+
+    remote = svn.SvnRemote(mock.Mock())
+    changes = {'added': ['file'], 'changed': [], 'removed': []}
+
+    with mock.patch('svn.repos.fs'), \
+            mock.patch('svn.fs.youngest_rev', return_value=3), \
+            mock.patch('svn.fs.get_uuid', return_value='uuid'), \
+            mock.patch.object(remote, '_revision_changes',
+                              return_value=changes) as revision_changes:
+        result = remote.revision_changes_range({'path': 'path'}, 1, 5)
+        remote.revision_changes_range({'path': 'path'}, 2, 3)
+
+    assert [item['revision'] for item in result] == [1, 2, 3]
+    assert result[0]['added'] == ['file']
+    assert revision_changes.call_count == 3
+
+
+def test_revision_changes_maps_changed_paths():
+    import svn.core
+    import svn.fs
+    from vcsserver import svn as vcs_svn
+
+    def change(change_kind, node_kind=svn.core.svn_node_file):
+        return mock.Mock(change_kind=change_kind, node_kind=node_kind)
+
+    paths_changed = {
+        '/trunk': change(svn.fs.path_change_modify, svn.core.svn_node_dir),
+        '/trunk/added': change(svn.fs.path_change_add),
+        '/trunk/modified': change(svn.fs.path_change_modify),
+        '/trunk/replaced': change(svn.fs.path_change_replace),
+        '/trunk/removed': change(svn.fs.path_change_delete),
+    }
+    remote = vcs_svn.SvnRemote(None)
+
+    with mock.patch('svn.fs.revision_root'), \
+            mock.patch('svn.fs.paths_changed2', return_value=paths_changed):
+        changes = remote._revision_changes(mock.Mock(), 2)
+
+    assert changes == {
+        'added': ['trunk/added'],
+        'changed': ['trunk/modified', 'trunk/replaced'],
+        'removed': ['trunk/removed'],
+    }
+
+
+def _fake_get_logs4(revisions):
+    def get_logs4(repo, paths, start, end, limit, discover_changed_paths,
+                  strict_node_history, include_merged_revisions, revprops,
+                  authz_read_func, receiver):
+        for revision in revisions:
+            receiver(mock.Mock(revision=revision, revprops={}), None)
+    return mock.Mock(side_effect=get_logs4)
+
+
+def test_log_stream_reads_the_log_once():
+    from vcsserver import svn
+
+    remote = svn.SvnRemote(mock.Mock())
+    get_logs4 = _fake_get_logs4(range(10, 0, -1))
+
+    with mock.patch('svn.repos.fs'), \
+            mock.patch('svn.repos.get_logs4', get_logs4):
+        chunks = list(remote.log_stream(
+            {'path': 'path'}, 'trunk', 10, 1, chunk_size=4))
+
+    assert [[e['revision'] for e in chunk] for chunk in chunks] == [
+        [10, 9, 8, 7], [6, 5, 4, 3], [2, 1]]
+    assert get_logs4.call_count == 1
+    assert get_logs4.call_args[0][1:5] == (['/trunk'], 10, 1, 0)
+
+
+def test_log_stream_reraises_errors_of_the_log():
+    from vcsserver import svn
+
+    remote = svn.SvnRemote(mock.Mock())
+
+    with mock.patch('svn.repos.fs'), \
+            mock.patch('svn.repos.get_logs4',
+                       side_effect=ValueError('missing path')):
+        with pytest.raises(ValueError):
+            list(remote.log_stream({'path': 'path'}, 'trunk', 10, 1))
+
+
+def test_log_stream_stops_reading_when_closed():
+    from vcsserver import svn
+
+    remote = svn.SvnRemote(mock.Mock())
+    get_logs4 = _fake_get_logs4(xrange(1000, 0, -1))
+
+    with mock.patch('svn.repos.fs'), \
+            mock.patch('svn.repos.get_logs4', get_logs4):
+        stream = remote.log_stream(
+            {'path': 'path'}, 'trunk', 1000, 1, chunk_size=1)
+        next(stream)
+        stream.close()
+        for thread in threading.enumerate():
+            if thread.name == 'svn-log-stream':
+                thread.join(5)
+                assert not thread.is_alive()
+
+
+def test_revision_root_is_cached_per_thread():
+    from vcsserver import svn
+
+    remote = svn.SvnRemote(mock.Mock())
+    wire = {'path': 'path'}
+    other_thread = []
+
+    with mock.patch('svn.repos.fs'), \
+            mock.patch('svn.fs.get_uuid', return_value='uuid'), \
+            mock.patch('svn.fs.revision_root',
+                       side_effect=lambda fsobj, rev: object()) as root:
+        first = remote._revision_root(wire, 3)
+        second = remote._revision_root(wire, 3)
+        thread = threading.Thread(target=lambda: other_thread.append(
+            remote._revision_root(wire, 3)))
+        thread.start()
+        thread.join()
+
+    assert first == second
+    assert other_thread[0][0] is not first[0]
+    assert root.call_count == 2
+    assert remote._revision_root_hits == 1
+
+
+def test_revision_roots_are_dropped_with_their_repository():
+    from vcsserver import svn
+
+    class Repo(object):
+        pass
+
+    factory = mock.Mock()
+    remote = svn.SvnRemote(factory)
+    wire = {'path': 'path'}
+
+    with mock.patch('svn.repos.fs', new=lambda repo: None), \
+            mock.patch('svn.fs.revision_root',
+                       side_effect=lambda fsobj, rev: object()) as root:
+        repos = [Repo(), Repo()]
+        for repo in repos:
+            factory.repo.return_value = repo
+            remote._revision_root(wire, 3)
+        assert root.call_count == 2
+        assert len(remote._local.revision_roots) == 2
+
+        factory.repo.return_value = repo = None
+        del repos[:]
+        gc.collect()
+
+    assert len(remote._local.revision_roots) == 0
+
+
+def test_get_nodes_recursive():
+    import svn.core
+    from vcsserver import svn as vcs_svn
+
+    tree = {
+        'trunk': {
+            'src': {'main.c': 'int main;\n'},
+            'README': 'readme\n',
+        },
+    }
+
+    def lookup(path):
+        node = tree
+        for part in filter(None, path.split('/')):
+            node = node[part]
+        return node
+
+    def dir_entries(root, path):
+        return dict(
+            (name, mock.Mock(kind=svn.core.svn_node_dir
+                             if isinstance(node, dict)
+                             else svn.core.svn_node_file))
+            for name, node in lookup(path).items())
+
+    remote = vcs_svn.SvnRemote(None)
+    remote._revision_root = mock.Mock(return_value=('root', 5))
+
+    with mock.patch('svn.fs.dir_entries', side_effect=dir_entries), \
+            mock.patch('svn.fs.file_length',
+                       side_effect=lambda root, path: len(lookup(path))), \
+            mock.patch('svn.fs.node_created_rev', return_value=4):
+        nodes = remote.get_nodes_recursive(
+            {'path': 'path'}, 'trunk', 5, depth=None, with_size=True,
+            with_last_changed=True)
+        top_level = remote.get_nodes_recursive({'path': 'path'}, 'trunk', 5)
+
+    assert nodes == [
+        {'path': 'README', 'kind': 'file', 'size': 7, 'last_changed': 4},
+        {'path': 'src', 'kind': 'dir', 'size': None, 'last_changed': 4},
+        {'path': 'src/main.c', 'kind': 'file', 'size': 10,
+         'last_changed': 4},
+    ]
+    assert top_level == [
+        {'path': 'README', 'kind': 'file'},
+        {'path': 'src', 'kind': 'dir'},
+    ]
+
+
+class FakeProcess(object):
+    def __init__(self, returncode=0, stdout='', pid=4242):
+        self.stdout = io.BytesIO(stdout)
+        self.returncode = returncode
+        self.pid = pid
+        self.terminated = False
+
+    def poll(self):
+        return None
+
+    def terminate(self):
+        self.terminated = True
+
+    def wait(self):
+        pass
+
+
+LOAD_OUTPUT = '\n'.join([
+    '<<< Started new transaction, based on original revision 3',
+    '     * adding path : file ... done.',
+    '------- Committed revision 3 >>>',
+    '<<< Started new transaction, based on original revision 4',
+    '------- Committed revision 4 >>>',
+    ''])
+
+
+@pytest.fixture
+def svn_repo_path(tmpdir):
+    tmpdir.mkdir('db')
+    return str(tmpdir)
+
+
+def _run_import_job(repo_path, start_rev, processes, head='4\n'):
+    from vcsserver import svn
+
+    job = svn.ImportJob(
+        repo_path, 'url', start_rev, svn._lock_import(repo_path))
+    with mock.patch('subprocess.check_output', return_value=head), \
+            mock.patch('subprocess.Popen',
+                       side_effect=processes) as popen:
+        job.start()
+        job.wait()
+    return job, popen
+
+
+def test_import_job_resumes_after_youngest_revision(svn_repo_path):
+    job, popen = _run_import_job(
+        svn_repo_path, 3, [FakeProcess(), FakeProcess(stdout=LOAD_OUTPUT)])
+
+    dump_cmd = popen.call_args_list[0][0][0]
+    assert dump_cmd[-4:] == ['--incremental', '-r', '3:HEAD', 'url']
+    assert job.status()['state'] == 'done'
+    assert job.status()['loaded_revision'] == 4
+    assert job.status()['total_revisions'] == 4
+
+
+def test_import_job_reports_dump_failure(svn_repo_path):
+    job, popen = _run_import_job(
+        svn_repo_path, 1, [FakeProcess(returncode=1), FakeProcess()])
+
+    assert popen.call_args_list[0][0][0][-1] == 'url'
+    assert job.status()['state'] == 'failed'
+    assert job.status()['reason'] == 'UNKNOWN'
+
+
+def test_import_job_is_done_when_up_to_date(svn_repo_path):
+    job, popen = _run_import_job(svn_repo_path, 5, [])
+
+    assert job.status()['state'] == 'done'
+    assert not popen.called
+
+
+def test_import_job_cancel_terminates_processes(svn_repo_path):
+    from vcsserver import svn
+
+    job = svn.ImportJob(svn_repo_path, 'url', 1)
+    processes = [FakeProcess(), FakeProcess()]
+    job._processes = processes
+
+    job.cancel()
+    job._load()
+
+    assert all(process.terminated for process in processes)
+    assert job.status()['state'] == 'cancelled'
+
+
+def test_import_job_status_is_read_from_the_repository(svn_repo_path):
+    from vcsserver import svn
+
+    job, popen = _run_import_job(
+        svn_repo_path, 3, [FakeProcess(), FakeProcess(stdout=LOAD_OUTPUT)])
+
+    assert svn.ImportJob.job_status(svn_repo_path, job.id) == job.status()
+    with pytest.raises(KeyError):
+        svn.ImportJob.job_status(svn_repo_path, 'other')
+
+
+def test_import_job_without_lock_was_interrupted(svn_repo_path):
+    from vcsserver import svn
+
+    job = svn.ImportJob(svn_repo_path, 'url', 1)
+    job.state = 'running'
+    job._store()
+
+    status = svn.ImportJob.job_status(svn_repo_path, job.id)
+    assert status['state'] == 'failed'
+
+
+def test_import_lock_excludes_other_imports(svn_repo_path):
+    from vcsserver import svn
+
+    lock_file = svn._lock_import(svn_repo_path)
+    assert svn._import_locked(svn_repo_path)
+    assert svn._lock_import(svn_repo_path) is None
+
+    lock_file.close()
+    assert not svn._import_locked(svn_repo_path)
+
+
+def test_import_job_cancelled_from_other_process(svn_repo_path):
+    from vcsserver import svn
+
+    job = svn.ImportJob(
+        svn_repo_path, 'url', 1, svn._lock_import(svn_repo_path))
+    job.state = 'running'
+    job._processes = [FakeProcess(pid=123)]
+    job._store()
+
+    with mock.patch('os.kill') as kill:
+        svn.ImportJob.cancel_job(svn_repo_path, job.id)
+
+    kill.assert_called_once_with(123, mock.ANY)
+    job._processes = []
+    assert job._cancel_requested()
+
+
+def test_txn_node_processor_checks_directories_once():
+    import svn.core
+    from vcsserver import svn as vcs_svn
+
+    checked = []
+
+    def check_path(root, path):
+        checked.append(path)
+        if path in ('', 'trunk'):
+            return svn.core.svn_node_dir
+        return svn.core.svn_node_none
+
+    known_dirs = set()
+    with mock.patch('svn.fs.check_path', side_effect=check_path), \
+            mock.patch('svn.fs.make_dir') as make_dir, \
+            mock.patch('svn.fs.make_file'), \
+            mock.patch('svn.fs.apply_text'), \
+            mock.patch('svn.core.svn_stream_write') as stream_write, \
+            mock.patch('svn.core.svn_stream_close'):
+        for path in ('trunk/new/a', 'trunk/new/b'):
+            vcs_svn.TxnNodeProcessor(
+                {'path': path}, 'root', known_dirs).update(['1', '2'])
+
+    make_dir.assert_called_once_with('root', 'trunk/new')
+    assert checked == ['trunk/new', 'trunk', 'trunk/new/a', 'trunk/new/b']
+    assert stream_write.call_count == 4
+
+
+def _patch_revision_dates(dates, youngest):
+    return mock.patch.multiple(
+        'svn.fs', youngest_rev=lambda fsobj: youngest[0],
+        revision_prop=mock.Mock(
+            side_effect=lambda fsobj, rev, name: dates[rev]))
+
+
+def _patch_time_from_cstring():
+    return mock.patch(
+        'svn.core.svn_time_from_cstring',
+        side_effect=lambda date: int(date) * 1E6)
+
+
+def test_timestamp_index_is_extended_and_stored(tmpdir):
+    from vcsserver import svn
+
+    tmpdir.mkdir('db')
+    dates = {0: '10', 1: '20', 2: None, 3: '40'}
+    youngest = [2]
+
+    with _patch_revision_dates(dates, youngest), _patch_time_from_cstring():
+        index = svn.TimestampIndex(str(tmpdir), 'uuid')
+        assert index.dated_revision(None, 5) == 0
+        assert index.dated_revision(None, 25) == 2
+        youngest[0] = 3
+        assert index.dated_revision(None, 40) == 3
+        assert tmpdir.join('db', index.FILE_NAME).read('rb') == (
+            'uuid\n' + index.timestamps.tostring())
+
+        reloaded = svn.TimestampIndex(str(tmpdir), 'uuid')
+        with mock.patch('svn.fs.revision_prop',
+                        return_value='40') as revision_prop:
+            assert reloaded.dated_revision(None, 15) == 0
+        revision_prop.assert_called_once_with(None, 3, mock.ANY)
+        assert list(reloaded.timestamps) == [10.0, 20.0, 20.0]
+
+        other = svn.TimestampIndex(str(tmpdir), 'other-uuid')
+        other.dated_revision(None, 15)
+        assert len(other.timestamps) == 3
+
+
+def test_timestamp_index_reads_date_of_youngest_revision(tmpdir):
+    from vcsserver import svn
+
+    tmpdir.mkdir('db')
+    # The date of revision 1 is only set after its commit
+    dates = {0: '10', 1: '99', 2: '30'}
+    youngest = [1]
+
+    with _patch_revision_dates(dates, youngest), _patch_time_from_cstring():
+        index = svn.TimestampIndex(str(tmpdir), 'uuid')
+        assert index.dated_revision(None, 50) == 0
+        dates[1] = '20'
+        assert index.dated_revision(None, 25) == 1
+        youngest[0] = 2
+
+        assert index.dated_revision(None, 25) == 1
+        assert list(index.timestamps) == [10.0, 20.0]
+
+
+def test_write_file_replaces_file_with_default_permissions(tmpdir):
+    from vcsserver import svn
+
+    tmpdir.join('other').write('')
+    path = tmpdir.join('file')
+    path.write('old')
+
+    svn._write_file(str(path), 'new')
+
+    assert path.read() == 'new'
+    assert path.stat().mode == tmpdir.join('other').stat().mode
+    assert sorted(tmpdir.listdir()) == [path, tmpdir.join('other')]
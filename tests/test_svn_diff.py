@@ -0,0 +1,102 @@
+# RhodeCode VCSServer provides access to different vcs backends via network.
+# Copyright (C) 2014-2016 RodeCode GmbH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import difflib
+import random
+
+import pytest
+
+from vcsserver import svn_diff
+
+
+def _apply(opcodes, fromlines, tolines):
+    result = []
+    position = (0, 0)
+    for tag, i1, i2, j1, j2 in opcodes:
+        assert (i1, j1) == position
+        if tag == 'equal':
+            assert fromlines[i1:i2] == tolines[j1:j2]
+        result.extend(tolines[j1:j2])
+        position = (i2, j2)
+    assert position == (len(fromlines), len(tolines))
+    return result
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_get_opcodes_transforms_the_lines(seed):
+    rng = random.Random(seed)
+    fromlines = [rng.choice('abcdef') for x in xrange(rng.randint(0, 200))]
+    tolines = [rng.choice('abcdef') for x in xrange(rng.randint(0, 200))]
+
+    opcodes = svn_diff.get_opcodes(fromlines, tolines)
+
+    assert _apply(opcodes, fromlines, tolines) == tolines
+
+
+@pytest.mark.parametrize('fromlines, tolines', [
+    ([], []),
+    ([], ['a\n']),
+    (['a\n'], []),
+    (['a\n', 'b\n', 'c\n'], ['a\n', 'b\n', 'c\n']),
+    (['a\n', 'b\n', 'c\n'], ['a\n', 'x\n', 'c\n']),
+    (['a\n', 'b\n', 'c\n', 'd\n'], ['a\n', 'c\n', 'e\n']),
+])
+def test_get_opcodes_matches_difflib_on_simple_input(fromlines, tolines):
+    matcher = difflib.SequenceMatcher(None, fromlines, tolines)
+
+    assert svn_diff.get_opcodes(fromlines, tolines) == matcher.get_opcodes()
+    assert list(svn_diff.group_opcodes(
+        svn_diff.get_opcodes(fromlines, tolines), 1)) == list(
+            matcher.get_grouped_opcodes(1))
+
+
+def test_get_opcodes_finds_minimal_diff_without_unique_lines():
+    fromlines = list('abcabba')
+    tolines = list('cbabac')
+
+    opcodes = svn_diff.get_opcodes(fromlines, tolines)
+
+    # the longest common subsequence has 4 lines
+    assert sum(i2 - i1 for tag, i1, i2, j1, j2 in opcodes
+               if tag == 'equal') == 4
+
+
+def test_get_opcodes_aligns_unique_lines():
+    fromlines = ['}\n', 'def a():\n', '}\n', 'def b():\n', '}\n']
+    tolines = ['}\n', 'def b():\n', '}\n']
+
+    opcodes = svn_diff.get_opcodes(fromlines, tolines)
+
+    assert opcodes == [
+        ('equal', 0, 1, 0, 1),
+        ('delete', 1, 3, 1, 1),
+        ('equal', 3, 5, 1, 3),
+    ]
+
+
+def test_unified_diff():
+    diff = svn_diff.unified_diff(
+        ['a\n', 'b\n', 'c\n'], ['a\n', 'B\n', 'c\n', 'd'], context=1)
+
+    assert ''.join(diff) == (
+        '@@ -1,3 +1,4 @@\n'
+        ' a\n'
+        '-b\n'
+        '+B\n'
+        ' c\n'
+        '+d\n'
+        '\\ No newline at end of file\n')
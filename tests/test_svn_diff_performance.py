@@ -0,0 +1,117 @@
+# RhodeCode VCSServer provides access to different vcs backends via network.
+# Copyright (C) 2014-2016 RodeCode GmbH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Benchmarks of `svn_diff.unified_diff` against the `difflib` based
+implementation it replaced.
+
+Every test records the duration of both implementations and the number of
+changed lines they report on synthetic files. Run with
+`--benchmark-output=results.json` to get the results in machine-readable
+form. The large files only run with `--benchmarks`.
+"""
+
+import difflib
+import random
+import time
+
+import pytest
+
+from vcsserver import svn_diff
+
+
+LINE_COUNTS = [10000, pytest.param(100000, marks=pytest.mark.benchmark)]
+CHANGE_RATIOS = [0.001, 0.05]
+
+
+def _source_lines(rng, count):
+    """Lines which look like code, with many repeated lines."""
+    common = ['}\n', '\n', '    return None\n', '    pass\n']
+    return [
+        rng.choice(common) if rng.random() < 0.3 else
+        '    value_%d = compute(%d)\n' % (index, rng.randint(0, 1000))
+        for index in xrange(count)]
+
+
+def _edit(rng, lines, ratio):
+    lines = list(lines)
+    for change in xrange(int(len(lines) * ratio)):
+        index = rng.randrange(len(lines))
+        action = rng.choice(['change', 'insert', 'delete'])
+        if action == 'change':
+            lines[index] = 'changed %d\n' % change
+        elif action == 'insert':
+            lines.insert(index, 'inserted %d\n' % change)
+        else:
+            del lines[index]
+    return lines
+
+
+def _difflib_hunks(fromlines, tolines, context):
+    matcher = difflib.SequenceMatcher(None, fromlines, tolines)
+    return matcher.get_grouped_opcodes(context)
+
+
+def _changed_lines(hunks):
+    return sum(
+        max(i2 - i1, j2 - j1)
+        for hunk in hunks for tag, i1, i2, j1, j2 in hunk if tag != 'equal')
+
+
+def _timed(func, *args):
+    start = time.time()
+    result = list(func(*args))
+    return time.time() - start, result
+
+
+@pytest.mark.parametrize('line_count', LINE_COUNTS)
+@pytest.mark.parametrize('change_ratio', CHANGE_RATIOS)
+def test_unified_diff_engine(line_count, change_ratio, benchmark_results):
+    rng = random.Random(line_count)
+    fromlines = _source_lines(rng, line_count)
+    tolines = _edit(rng, fromlines, change_ratio)
+
+    duration, hunks = _timed(svn_diff.get_hunks, fromlines, tolines, 3)
+    difflib_duration, difflib_hunks = _timed(
+        _difflib_hunks, fromlines, tolines, 3)
+
+    benchmark_results.append({
+        'benchmark': 'svn_diff.get_hunks',
+        'line_count': line_count,
+        'change_ratio': change_ratio,
+        'duration': duration,
+        'difflib_duration': difflib_duration,
+        'changed_lines': _changed_lines(hunks),
+        'difflib_changed_lines': _changed_lines(difflib_hunks),
+    })
+
+
+@pytest.mark.parametrize('line_count', LINE_COUNTS)
+def test_unified_diff_output(line_count, benchmark_results):
+    rng = random.Random(line_count)
+    fromlines = _source_lines(rng, line_count)
+    tolines = _edit(rng, fromlines, 0.01)
+
+    duration, lines = _timed(
+        svn_diff.unified_diff, fromlines, tolines, 3)
+
+    benchmark_results.append({
+        'benchmark': 'svn_diff.unified_diff',
+        'line_count': line_count,
+        'duration': duration,
+        'output_lines': len(lines),
+    })
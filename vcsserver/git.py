@@ -44,6 +44,9 @@ DIR_STAT = stat.S_IFDIR
 FILE_MODE = stat.S_IFMT
 GIT_LINK = objects.S_IFGITLINK
 
+_commit_ids_token_re = re.compile(
+    r'^(\d+):((?:[0-9a-f]{40}(?:,[0-9a-f]{40})*)?)$')
+
 log = logging.getLogger(__name__)
 
 
@@ -222,6 +225,28 @@ class GitRemote(object):
             index.build_index_from_tree(repo.path, repo.index_path(),
                                         repo.object_store, repo["HEAD"].tree)
 
+    @reraise_safe_exceptions
+    def create_clone_bundle(self, wire, bundle_path, bundle_url):
+        """
+        Writes a bundle of all refs to `bundle_path` and advertises it as
+        bundle URI, so that cloning clients fetch it from `bundle_url` and
+        only negotiate the objects created since then.
+        """
+        tmp_path = bundle_path + '.tmp'
+        self.run_git_command(
+            wire, ['bundle', 'create', tmp_path, '--all'],
+            fail_on_stderr=False)
+        os.rename(tmp_path, bundle_path)
+
+        bundle_config = [
+            ('uploadpack.advertiseBundleURIs', 'true'),
+            ('bundle.version', '1'),
+            ('bundle.mode', 'all'),
+            ('bundle.rhodecode.uri', bundle_url),
+        ]
+        for key, value in bundle_config:
+            self.run_git_command(wire, ['config', key, value])
+
     # TODO: this is quite complex, check if that can be simplified
     @reraise_safe_exceptions
     def commit(self, wire, commit_data, branch, commit_tree, updated, removed):
@@ -407,6 +432,107 @@ class GitRemote(object):
             for x in repo_remote.get_walker(include=[rev2], exclude=[rev1])]
         return revs
 
+    @reraise_safe_exceptions
+    def get_commit_ids_page(self, wire, offset, limit, token=None):
+        """
+        Returns up to `limit` commit ids from position `offset` on, packed as
+        20 byte binary ids, oldest first in the order of
+        `git rev-list --all --reverse --date-order`.
+
+        The `token` works as for Mercurial: passing the `token` of a previous
+        call makes `offset` count from the end of that listing. The commits
+        added since then follow in their own order, only they are walked. If
+        commits of that listing are gone, `reset` is set and the listing
+        starts from the beginning.
+
+        The token holds the tips of all refs, which are resolved once per
+        call, so that all parts of a result describe the same state.
+        """
+        length, old_tips = 0, []
+        if token:
+            length, old_tips = self._parse_commit_ids_token(token)
+
+        tips = self._commit_tips(wire)
+        new_ids = None
+        if length:
+            new_ids = self._commit_ids_since(wire, tips, old_tips)
+
+        if new_ids is not None:
+            total = length + len(new_ids)
+            start = length + offset
+            end = start + limit if limit else total
+            commit_ids = new_ids[offset:end - length]
+        else:
+            total = 0
+            if tips:
+                output, __ = self._rev_list(wire, tips, ['--count'])
+                total = int(output)
+            start = offset
+            end = min(start + limit, total) if limit else total
+            commit_ids = []
+            if start < end:
+                # --reverse is applied after --skip and --max-count
+                output, __ = self._rev_list(
+                    wire, tips, ['--date-order', '--skip=%d' % (total - end),
+                                 '--max-count=%d' % (end - start)])
+                commit_ids = output.split()[::-1]
+
+        return {
+            'commit_ids': ''.join(commit_ids).decode('hex'),
+            'offset': start,
+            'total': total,
+            'token': '%d:%s' % (total, ','.join(tips)),
+            'reset': bool(length) and new_ids is None,
+        }
+
+    def _parse_commit_ids_token(self, token):
+        match = _commit_ids_token_re.match(token)
+        if not match:
+            raise exceptions.LookupException(
+                'Invalid commit ids token %r' % (token, ))
+        tips = match.group(2)
+        return int(match.group(1)), tips.split(',') if tips else []
+
+    def _commit_tips(self, wire):
+        """
+        Returns the sorted ids of the commits the refs point to.
+        """
+        output, __ = self.run_git_command(
+            wire, ['for-each-ref', '--format=%(objecttype) %(objectname) '
+                   '%(*objecttype) %(*objectname)'])
+        tips = set()
+        for line in output.splitlines():
+            fields = line.split()
+            if fields[0] == 'commit':
+                tips.add(fields[1])
+            elif fields[2:3] == ['commit']:
+                tips.add(fields[3])
+        return sorted(tips)
+
+    def _rev_list(self, wire, revs, args, **opts):
+        # The revisions are passed on stdin, there may be many of them
+        return self.run_git_command(
+            wire, ['rev-list', '--stdin'] + args,
+            inputstream=''.join('%s\n' % rev for rev in revs), **opts)
+
+    def _commit_ids_since(self, wire, tips, old_tips):
+        """
+        Returns the ids of the commits reachable from `tips` but not from
+        `old_tips`, oldest first, or `None` if commits reachable from
+        `old_tips` are gone.
+        """
+        gone, __ = self._rev_list(
+            wire, old_tips + ['^' + tip for tip in tips], ['--count'],
+            _safe=True)
+        if gone.strip() != '0':
+            return None
+        if not tips:
+            return []
+        output, __ = self._rev_list(
+            wire, tips + ['^' + tip for tip in old_tips],
+            ['--date-order', '--reverse'])
+        return output.split()
+
     @reraise_safe_exceptions
     def get_object(self, wire, sha):
         repo = self._factory.repo(wire)
@@ -15,10 +15,17 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import bisect
+import errno
+import fcntl
+import hashlib
 import io
 import logging
+import os
+import re
 import stat
 import sys
+import tempfile
 import urllib
 import urllib2
 
@@ -26,15 +33,17 @@ from hgext import largefiles, rebase
 from hgext.strip import strip as hgext_strip
 from mercurial import commands
 from mercurial import unionrepo
+from repoze.lru import LRUCache
 
-from vcsserver import exceptions
+from vcsserver import exceptions, hgcache
 from vcsserver.base import RepoFactory
 from vcsserver.hgcompat import (
-    archival, bin, clone, config as hgconfig, diffopts, hex, hg_url,
-    httpbasicauthhandler, httpdigestauthhandler, httppeer, localrepository,
-    match, memctx, exchange, memfilectx, nullrev, patch, peer, revrange, ui,
-    Abort, LookupError, RepoError, RepoLookupError, InterventionRequired,
-    RequirementError)
+    archival, bin, changegroup, clone, config as hgconfig, copymode,
+    diffopts, hex, hg_url, httpbasicauthhandler, httpdigestauthhandler,
+    httppeer, localrepository, match, mdiff, memctx, exchange, memfilectx,
+    nullrev, patch, peer,
+    revrange, streamclone, ui, Abort, LookupError, RepoError, RepoLookupError,
+    InterventionRequired, RequirementError)
 
 log = logging.getLogger(__name__)
 
@@ -102,9 +111,126 @@ def raise_from_original(new_type):
         del traceback
 
 
+def limit_diff(chunks, max_bytes=None, max_files=None):
+    """
+    Passes through the diff `chunks` of `patch.diff` until a limit is hit.
+
+    If a limit is hit, the last item is a dict naming the exceeded limit.
+    """
+    size = 0
+    files = 0
+    for chunk in chunks:
+        if chunk.startswith('diff '):
+            files += 1
+            if max_files and files > max_files:
+                yield {'limit': 'max_files', 'files': files - 1, 'size': size}
+                return
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            yield {'limit': 'max_bytes', 'files': files,
+                   'size': size - len(chunk)}
+            return
+        yield chunk
+
+
+# ioctl request of Linux to share the extents of one file with another one
+FICLONE = 0x40049409
+
+LARGEFILE_CHUNK_SIZE = 128 * 1024
+
+_largefile_sha_re = re.compile(r'^[0-9a-f]{40}$')
+
+_node_re = re.compile(r'^[0-9a-fA-F]{40}$')
+
+
+def link_largefile(src, dest):
+    """
+    Places the largefile `src` at `dest` without duplicating its data.
+
+    Tries a hardlink first and a reflink (copy-on-write clone) second. Only
+    if neither is supported, the content is copied over in chunks. An
+    existing `dest` is replaced atomically, unless it is a link of `src`.
+    """
+    dest_dir = os.path.dirname(dest)
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    try:
+        os.link(src, dest)
+        return 'hardlink'
+    except OSError as e:
+        if e.errno == errno.EEXIST and os.path.samefile(src, dest):
+            return 'exists'
+
+    tmp_fd, tmp_path = tempfile.mkstemp(
+        prefix='.%s-' % os.path.basename(dest), dir=dest_dir)
+    with open(src, 'rb') as src_file:
+        try:
+            with os.fdopen(tmp_fd, 'wb') as dest_file:
+                try:
+                    fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+                    method = 'reflink'
+                except (IOError, OSError):
+                    method = 'copy'
+                    for chunk in iter(
+                            lambda: src_file.read(LARGEFILE_CHUNK_SIZE), ''):
+                        dest_file.write(chunk)
+            os.chmod(tmp_path, os.stat(src).st_mode)
+            os.rename(tmp_path, dest)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+    return method
+
+
+def _check_largefile_sha(sha):
+    if not _largefile_sha_re.match(sha or ''):
+        raise exceptions.LookupException('Invalid largefile hash %r' % (sha,))
+
+
+def _config_digest(config):
+    return hashlib.sha1(repr([tuple(item) for item in config])).digest()
+
+
+def _repo_state(path):
+    """
+    Returns a key which changes when the changelog, the obsolescence markers,
+    the phases or the bookmarks of the repository at `path` change.
+    """
+    state = []
+    for name in ('store/00changelog.i', 'store/obsstore',
+                 'store/phaseroots', 'bookmarks'):
+        try:
+            st = os.stat(os.path.join(path, '.hg', name))
+        except OSError:
+            state.append(None)
+        else:
+            state.append((st.st_mtime, st.st_size, st.st_ino))
+    return tuple(state)
+
+
 class MercurialFactory(RepoFactory):
 
+    def __init__(self, repo_cache):
+        super(MercurialFactory, self).__init__(repo_cache)
+        self._ui_templates = LRUCache(100)
+        self._union_repos = LRUCache(20)
+
     def _create_config(self, config, hooks=True):
+        """
+        Returns a fresh copy of the `ui` for `config`.
+
+        Building a `ui` reads the system config files, so the fully configured
+        `ui` is kept as a template per config and only copied.
+        """
+        key = (_config_digest(config), hooks)
+        template = self._ui_templates.get(key)
+        if template is None:
+            template = self._make_ui(config, hooks)
+            self._ui_templates.put(key, template)
+        return template.copy()
+
+    def _make_ui(self, config, hooks):
         if not hooks:
             hooks_to_clean = frozenset((
                 'changegroup.repo_size', 'preoutgoing.pre_pull',
@@ -123,11 +249,44 @@ class MercurialFactory(RepoFactory):
         baseui = self._create_config(wire["config"])
         return localrepository(baseui, wire["path"], create)
 
+    def union_repo(self, wire, other_path):
+        """
+        Returns a union repository of `other_path` and the repository of
+        `wire`.
+
+        Like the repositories of `repo`, the instance is only reused within
+        the :term:`call context` of `wire`, and there until the changelog of
+        either side changes.
+        """
+        context = wire.get('context', None)
+        if not (context and wire.get('cache', True)):
+            return self._create_union_repo(wire, other_path)
+
+        key = (context, other_path, wire["path"],
+               _config_digest(wire["config"]))
+        state = (_repo_state(other_path), _repo_state(wire["path"]))
+        cached = self._union_repos.get(key)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+
+        repo = self._create_union_repo(wire, other_path)
+        self._union_repos.put(key, (state, repo))
+        return repo
+
+    def _create_union_repo(self, wire, other_path):
+        baseui = self._create_config(wire["config"])
+        return unionrepo.unionrepository(baseui, other_path, wire["path"])
+
 
 class HgRemote(object):
 
+    # Number of linear file revisions to walk back to find a cached annotation
+    ANNOTATE_REUSE_DEPTH = 50
+
     def __init__(self, factory):
         self._factory = factory
+        self._annotate_cache = LRUCache(200)
+        self._revspec_cache = LRUCache(500)
 
         self._bulk_methods = {
             "affected_files": self.ctx_files,
@@ -192,6 +351,53 @@ class HgRemote(object):
         baseui = self._factory._create_config(wire["config"], hooks=hooks)
         clone(baseui, source, dest, noupdate=not update_after_clone)
 
+    @reraise_safe_exceptions
+    def create_clone_bundle(self, wire, bundle_path, bundle_url, stream=False):
+        """
+        Writes a full bundle of the repository to `bundle_path` and advertises
+        it to clients via `.hg/clonebundles.manifest`.
+
+        Clients supporting clone bundles download the file from `bundle_url`
+        and only pull the changesets added since the bundle was created.
+        A `stream` bundle contains the raw revlogs and is faster to apply.
+        """
+        repo = self._factory.repo(wire)
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            prefix='.%s-' % os.path.basename(bundle_path),
+            dir=os.path.dirname(bundle_path))
+        os.close(tmp_fd)
+
+        try:
+            if stream:
+                requirements, chunks = streamclone.generatebundlev1(repo)
+                changegroup.writechunks(repo.ui, chunks, tmp_path)
+                bundle_spec = 'none-packed1;requirements%%3D%s' % (
+                    urllib.quote(','.join(sorted(requirements)), safe=''))
+            else:
+                bundle_spec = 'gzip-v2'
+                empty = commands.bundle(
+                    repo.ui, repo, tmp_path, all=True, type=bundle_spec)
+                if empty:
+                    log.debug('No changesets to bundle in %s', wire['path'])
+                    if repo.vfs.exists('clonebundles.manifest'):
+                        repo.vfs.unlink('clonebundles.manifest')
+                    return False
+
+            copymode(bundle_path, tmp_path)
+            os.rename(tmp_path, bundle_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        manifest = repo.vfs('clonebundles.manifest', 'w', atomictemp=True)
+        try:
+            manifest.write('%s BUNDLESPEC=%s\n' % (bundle_url, bundle_spec))
+        except Exception:
+            manifest.discard()
+            raise
+        manifest.close()
+        return True
+
     @reraise_safe_exceptions
     def commitctx(
             self, wire, message, parents, commit_time, commit_timezone,
@@ -238,6 +444,7 @@ class HgRemote(object):
 
         n = repo.commitctx(commit_ctx)
         new_id = hex(n)
+        hgcache.warmer.schedule_repo(repo)
 
         return new_id
 
@@ -274,6 +481,19 @@ class HgRemote(object):
             git=git, ignore_whitespace=ignore_whitespace, context=context)
         return list(result)
 
+    @reraise_safe_exceptions
+    def ctx_diff_stream(
+            self, wire, revision, git=True, ignore_whitespace=True, context=3,
+            max_bytes=None, max_files=None):
+        """
+        Streaming variant of `ctx_diff`, see `limit_diff` for the limits.
+        """
+        repo = self._factory.repo(wire)
+        ctx = repo[revision]
+        result = ctx.diff(
+            git=git, ignore_whitespace=ignore_whitespace, context=context)
+        return limit_diff(result, max_bytes, max_files)
+
     @reraise_safe_exceptions
     def ctx_files(self, wire, revision):
         repo = self._factory.repo(wire)
@@ -308,6 +528,64 @@ class HgRemote(object):
         # API expects this to be a list
         return list(status)
 
+    @reraise_safe_exceptions
+    def ctx_status_many(self, wire, revisions):
+        """
+        Returns the status against the first parent for many revisions.
+
+        Every path is listed once in `paths`. For each revision `commits`
+        holds the indices of the modified, added and removed paths and of
+        the paths returned by `ctx_files`. Manifests are reused between
+        revisions, so a linear range reads every manifest only once.
+        """
+        repo = self._factory.repo(wire)
+        ctxs = [repo[revision] for revision in revisions]
+        manifests = LRUCache(8)
+
+        def manifest(ctx):
+            node = ctx.manifestnode()
+            result = manifests.get(node)
+            if result is None:
+                result = ctx.manifest()
+                manifests.put(node, result)
+            return result
+
+        paths = []
+        positions = {}
+
+        def indices(names):
+            result = []
+            for name in sorted(names):
+                position = positions.get(name)
+                if position is None:
+                    position = positions[name] = len(paths)
+                    paths.append(name)
+                result.append(position)
+            return result
+
+        statuses = {}
+        # oldest first, so that manifests are read as deltas to cached ones
+        for ctx in sorted(ctxs, key=lambda ctx: ctx.rev()):
+            if ctx.rev() in statuses:
+                continue
+            modified, added, removed = [], [], []
+            diff = manifest(ctx.p1()).diff(manifest(ctx))
+            for name, ((node1, flag1), (node2, flag2)) in diff.iteritems():
+                if node1 is None:
+                    added.append(name)
+                elif node2 is None:
+                    removed.append(name)
+                else:
+                    modified.append(name)
+            statuses[ctx.rev()] = (modified, added, removed, ctx.files())
+
+        return {
+            'paths': paths,
+            'commits': [
+                [indices(names) for names in statuses[ctx.rev()]]
+                for ctx in ctxs],
+        }
+
     @reraise_safe_exceptions
     def ctx_user(self, wire, revision):
         repo = self._factory.repo(wire)
@@ -384,40 +662,79 @@ class HgRemote(object):
         except RepoLookupError:
             raise exceptions.LookupException()
 
+    @reraise_safe_exceptions
+    def diff_stream(
+            self, wire, rev1, rev2, file_filter, opt_git, opt_ignorews,
+            context, max_bytes=None, max_files=None):
+        """
+        Streaming variant of `diff`, see `limit_diff` for the limits.
+        """
+        repo = self._factory.repo(wire)
+
+        if file_filter:
+            filter = match(file_filter[0], '', [file_filter[1]])
+        else:
+            filter = file_filter
+        opts = diffopts(git=opt_git, ignorews=opt_ignorews, context=context)
+
+        try:
+            chunks = patch.diff(
+                repo, node1=rev1, node2=rev2, match=filter, opts=opts)
+        except RepoLookupError:
+            raise exceptions.LookupException()
+        return limit_diff(chunks, max_bytes, max_files)
+
     @reraise_safe_exceptions
     def file_history(self, wire, revision, path, limit):
         repo = self._factory.repo(wire)
 
         ctx = repo[revision]
         fctx = ctx.filectx(path)
-
-        def history_iter():
-            limit_rev = fctx.rev()
-            for obj in reversed(list(fctx.filelog())):
-                obj = fctx.filectx(obj)
-                if limit_rev >= obj.rev():
-                    yield obj
+        filelog = fctx.filelog()
+        changelog = repo.changelog
 
         history = []
-        for cnt, obj in enumerate(history_iter()):
-            if limit and cnt >= limit:
+        for filerev in self._file_revs_reversed(filelog, fctx.rev()):
+            if limit and len(history) >= limit:
                 break
-            history.append(hex(obj.node()))
+            history.append(hex(changelog.node(filelog.linkrev(filerev))))
+        return history
+
+    def _file_revs_reversed(self, filelog, max_rev):
+        """
+        Yields the revisions of `filelog` linked to changesets up to
+        `max_rev`, newest first.
+
+        The linkrevs grow with the file revisions, so the start is found by
+        bisection and only the consumed part of the filelog is read.
+        """
+        low, high = 0, len(filelog)
+        while low < high:
+            middle = (low + high) // 2
+            if filelog.linkrev(middle) <= max_rev:
+                low = middle + 1
+            else:
+                high = middle
 
-        return [x for x in history]
+        for filerev in xrange(low - 1, -1, -1):
+            if filelog.linkrev(filerev) <= max_rev:
+                yield filerev
 
     @reraise_safe_exceptions
     def file_history_untill(self, wire, revision, path, limit):
         repo = self._factory.repo(wire)
         ctx = repo[revision]
         fctx = ctx.filectx(path)
+        filelog = fctx.filelog()
+        changelog = repo.changelog
 
-        file_log = list(fctx.filelog())
+        first = 0
         if limit:
             # Limit to the last n items
-            file_log = file_log[-limit:]
+            first = max(len(filelog) - limit, 0)
 
-        return [hex(fctx.filectx(cs).node()) for cs in reversed(file_log)]
+        return [hex(changelog.node(filelog.linkrev(filerev)))
+                for filerev in xrange(len(filelog) - 1, first - 1, -1)]
 
     @reraise_safe_exceptions
     def fctx_annotate(self, wire, revision, path):
@@ -425,13 +742,96 @@ class HgRemote(object):
         ctx = repo[revision]
         fctx = ctx.filectx(path)
 
-        result = []
-        for i, annotate_data in enumerate(fctx.annotate()):
-            ln_no = i + 1
-            sha = hex(annotate_data[0].node())
-            result.append((ln_no, sha, annotate_data[1]))
+        commit_ids, line_commits, lines = self._annotate(repo, fctx)
+        return [(ln_no, commit_ids[commit], line) for ln_no, (commit, line)
+                in enumerate(zip(line_commits, lines), 1)]
+
+    @reraise_safe_exceptions
+    def fctx_annotate_columnar(self, wire, revision, path):
+        """
+        Returns the annotation in columnar form: the list of changeset ids
+        and per line the index of its changeset in this list.
+        """
+        repo = self._factory.repo(wire)
+        ctx = repo[revision]
+        fctx = ctx.filectx(path)
+
+        commit_ids, line_commits, lines = self._annotate(repo, fctx)
+        return {
+            'commit_ids': commit_ids,
+            'line_commits': line_commits,
+            'lines': lines,
+        }
+
+    def _annotate(self, repo, fctx):
+        """
+        Returns the annotation of `fctx` as `(commit_ids, line_commits, lines)`.
+
+        Results are cached per file revision and introducing changeset. On a
+        cache miss the linear file history is walked back to the nearest
+        cached annotation and only the diffs since are applied, as
+        `filectx.annotate` does it.
+        """
+        introrev = fctx.introrev()
+        if fctx.rev() != introrev:
+            fctx = fctx.filectx(fctx.filenode(), changeid=introrev)
+
+        key = (repo.root, fctx.filenode(), introrev)
+        result = self._annotate_cache.get(key)
+        if result is not None:
+            return result
+
+        chain = [fctx]
+        while result is None and len(chain) <= self.ANNOTATE_REUSE_DEPTH:
+            parents = [
+                p for p in chain[-1].parents() if p.path() == fctx.path()]
+            if len(parents) != 1:
+                break
+            parent = parents[0]
+            result = self._annotate_cache.get(
+                (repo.root, parent.filenode(), parent.rev()))
+            if result is None:
+                chain.append(parent)
+
+        if result is None:
+            annotation = fctx.annotate()
+            result = self._compact_annotation(
+                [hex(annotated.node()) for annotated, __ in annotation],
+                [line for __, line in annotation])
+        else:
+            for child in reversed(chain):
+                result = self._annotate_child(result, child)
+
+        self._annotate_cache.put(key, result)
         return result
 
+    def _annotate_child(self, parent_result, fctx):
+        parent_ids, parent_line_commits, parent_lines = parent_result
+        text = fctx.data()
+        own_commit = len(parent_ids)
+        line_commits = [own_commit] * len(text.splitlines())
+        blocks = mdiff.allblocks(''.join(parent_lines), text, refine=True)
+        for (a1, a2, b1, b2), kind in blocks:
+            if kind == '=':
+                line_commits[b1:b2] = parent_line_commits[a1:a2]
+
+        commit_ids = parent_ids + [hex(fctx.node())]
+        return self._compact_annotation(
+            [commit_ids[commit] for commit in line_commits],
+            text.splitlines(True))
+
+    def _compact_annotation(self, line_ids, lines):
+        commit_ids = []
+        positions = {}
+        line_commits = []
+        for commit_id in line_ids:
+            position = positions.get(commit_id)
+            if position is None:
+                position = positions[commit_id] = len(commit_ids)
+                commit_ids.append(commit_id)
+            line_commits.append(position)
+        return commit_ids, line_commits, lines
+
     @reraise_safe_exceptions
     def fctx_data(self, wire, revision, path):
         repo = self._factory.repo(wire)
@@ -459,6 +859,76 @@ class HgRemote(object):
         revs = repo.filtered(name).changelog.index
         return map(lambda x: hex(x[7]), revs)[:-1]
 
+    @reraise_safe_exceptions
+    def get_commit_ids_page(self, wire, name, offset, limit, token=None):
+        """
+        Returns up to `limit` commit ids from position `offset` on, packed as
+        20 byte binary nodes in changelog order.
+
+        The returned `token` describes the current state of the changelog.
+        If the `token` of a previous call is passed in, `offset` counts from
+        the end of that state, so only the commits added since are fetched.
+        If that state is gone, e.g. after a strip, the listing starts from the
+        beginning again and `reset` is set.
+        """
+        repo = self._factory.repo(wire)
+        changelog = repo.filtered(name).changelog
+        hidden = sorted(changelog.filteredrevs)
+        # len() of the changelog includes the filtered revisions
+        total = len(changelog) - len(hidden)
+
+        start = 0
+        reset = False
+        if token:
+            start = self._changelog_token_position(changelog, hidden, token)
+            reset = start is None
+            start = start or 0
+        start += offset
+
+        nodes = []
+        if start < total:
+            first_rev = self._rev_at_position(hidden, start)
+            for rev in changelog.revs(first_rev):
+                if limit and len(nodes) >= limit:
+                    break
+                nodes.append(changelog.node(rev))
+
+        return {
+            'commit_ids': ''.join(nodes),
+            'offset': start,
+            'total': total,
+            'token': '%d:%s' % (total, hex(changelog.tip())),
+            'reset': reset,
+        }
+
+    def _changelog_token_position(self, changelog, hidden, token):
+        """
+        Returns the position after the state described by `token`, or `None`
+        if the changelog does not contain that state anymore.
+        """
+        length, sep, node = token.partition(':')
+        if not (length.isdigit() and sep and _node_re.match(node)):
+            raise exceptions.LookupException(
+                'Invalid commit ids token %r' % (token, ))
+        length = int(length)
+        if not length:
+            return 0
+        try:
+            rev = changelog.rev(bin(node))
+        except LookupError:
+            return None
+        if rev - bisect.bisect_right(hidden, rev) != length - 1:
+            return None
+        return length
+
+    def _rev_at_position(self, hidden, position):
+        rev = position
+        for hidden_rev in hidden:
+            if hidden_rev > rev:
+                break
+            rev += 1
+        return rev
+
     @reraise_safe_exceptions
     def get_config_value(self, wire, section, name, untrusted=False):
         repo = self._factory.repo(wire)
@@ -493,11 +963,101 @@ class HgRemote(object):
         repo = self._factory.repo(wire)
         return largefiles.lfutil.storepath(repo, sha)
 
+    @reraise_safe_exceptions
+    def in_store_many(self, wire, shas):
+        """Returns a list of flags telling which of `shas` are in the store."""
+        repo = self._factory.repo(wire)
+        return [largefiles.lfutil.instore(repo, sha) for sha in shas]
+
+    @reraise_safe_exceptions
+    def in_user_cache_many(self, wire, shas):
+        """Returns a list of flags telling which of `shas` are cached."""
+        repo = self._factory.repo(wire)
+        return [largefiles.lfutil.inusercache(repo.ui, sha) for sha in shas]
+
+    @reraise_safe_exceptions
+    def store_paths(self, wire, shas):
+        repo = self._factory.repo(wire)
+        return [largefiles.lfutil.storepath(repo, sha) for sha in shas]
+
     @reraise_safe_exceptions
     def link(self, wire, sha, path):
         repo = self._factory.repo(wire)
-        largefiles.lfutil.link(
-            largefiles.lfutil.usercachepath(repo.ui, sha), path)
+        link_largefile(largefiles.lfutil.usercachepath(repo.ui, sha), path)
+
+    @reraise_safe_exceptions
+    def link_many(self, wire, items):
+        """
+        Links the cached largefiles of `items`, a list of `(sha, path)` pairs.
+
+        Returns the method used for each item, one of `'hardlink'`,
+        `'reflink'`, `'copy'` or `'exists'` if the path is already a link of
+        the cached largefile.
+        """
+        repo = self._factory.repo(wire)
+        return [
+            link_largefile(largefiles.lfutil.usercachepath(repo.ui, sha), path)
+            for sha, path in items]
+
+    @reraise_safe_exceptions
+    def largefile_path(self, wire, sha):
+        """
+        Returns the path of the largefile `sha` in the store or `None`.
+
+        A largefile which is only in the user cache is linked into the store.
+        """
+        _check_largefile_sha(sha)
+        repo = self._factory.repo(wire)
+        lfutil = largefiles.lfutil
+        path = lfutil.storepath(repo, sha)
+        if os.path.exists(path):
+            return path
+        if lfutil.inusercache(repo.ui, sha):
+            link_largefile(lfutil.usercachepath(repo.ui, sha), path)
+            return path
+        return None
+
+    @reraise_safe_exceptions
+    def largefile_store(self, wire, sha, stream):
+        """
+        Stores the largefile `sha` read in chunks from the file like `stream`.
+
+        The content is verified against `sha` before it is moved into the
+        store and then shared with the user cache.
+        """
+        _check_largefile_sha(sha)
+        repo = self._factory.repo(wire)
+        lfutil = largefiles.lfutil
+        path = lfutil.storepath(repo, sha)
+        store_dir = os.path.dirname(path)
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            prefix='.%s-' % sha, dir=store_dir)
+        digest = hashlib.sha1()
+        try:
+            with os.fdopen(tmp_fd, 'wb') as tmp_file:
+                for chunk in iter(
+                        lambda: stream.read(LARGEFILE_CHUNK_SIZE), ''):
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+            if digest.hexdigest() != sha:
+                raise exceptions.AbortException(
+                    'Largefile content does not match hash %s' % sha)
+            copymode(path, tmp_path, repo.store.createmode)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        try:
+            if not lfutil.inusercache(repo.ui, sha):
+                link_largefile(path, lfutil.usercachepath(repo.ui, sha))
+        except (Abort, EnvironmentError):
+            log.warning('Could not add largefile %s to the user cache', sha,
+                        exc_info=True)
+        return path
 
     @reraise_safe_exceptions
     def localrepository(self, wire, create=False):
@@ -529,8 +1089,10 @@ class HgRemote(object):
         if commit_ids:
             commit_ids = [bin(commit_id) for commit_id in commit_ids]
 
-        return exchange.pull(
+        result = exchange.pull(
             repo, remote, heads=commit_ids, force=None).cgresult
+        hgcache.warmer.schedule_repo(repo)
+        return result
 
     @reraise_safe_exceptions
     def revision(self, wire, rev):
@@ -567,18 +1129,39 @@ class HgRemote(object):
 
         # case when we want to compare two independent repositories
         if other_path and other_path != wire["path"]:
-            baseui = self._factory._create_config(wire["config"])
-            repo = unionrepo.unionrepository(baseui, other_path, wire["path"])
-        else:
-            repo = self._factory.repo(wire)
+            return self._union_revs_from_revspec(
+                wire, other_path, rev_spec, args)
+        repo = self._factory.repo(wire)
         return list(repo.revs(rev_spec, *args))
 
+    def _union_revs_from_revspec(self, wire, other_path, rev_spec, args):
+        """
+        Evaluates `rev_spec` in the union of both repositories.
+
+        Results of specs on full commit ids are memoized for as long as both
+        repositories stay the same.
+        """
+        repo = self._factory.union_repo(wire, other_path)
+        if not args or not all(isinstance(arg, basestring) and
+                               _node_re.match(arg) for arg in args):
+            return list(repo.revs(rev_spec, *args))
+
+        key = (other_path, wire["path"], _config_digest(wire["config"]),
+               _repo_state(other_path), _repo_state(wire["path"]),
+               rev_spec, tuple(args))
+        revs = self._revspec_cache.get(key)
+        if revs is None:
+            revs = list(repo.revs(rev_spec, *args))
+            self._revspec_cache.put(key, revs)
+        return list(revs)
+
     @reraise_safe_exceptions
     def strip(self, wire, revision, update, backup):
         repo = self._factory.repo(wire)
         ctx = repo[revision]
         hgext_strip(
             repo.baseui, repo, ctx.node(), update=update, backup=backup)
+        hgcache.warmer.schedule_repo(repo)
 
     @reraise_safe_exceptions
     def tag(self, wire, name, revision, message, local, user,
@@ -634,34 +1217,61 @@ class HgRemote(object):
             opts['rev'] = revision
 
         commands.pull(baseui, repo, source, **opts)
+        hgcache.warmer.schedule_repo(repo)
 
     @reraise_safe_exceptions
     def heads(self, wire, branch=None):
-        repo = self._factory.repo(wire)
-        baseui = self._factory._create_config(wire['config'])
-        output = io.BytesIO()
+        """
+        Returns the open branch heads like `hg heads --template '{node} '`.
+        """
+        nodes = self.branch_heads(wire, branch)
+        return ''.join('%s ' % hex(node) for node in nodes)
 
-        def write(data, **unused_kwargs):
-            output.write(data)
+    @reraise_safe_exceptions
+    def branch_heads(self, wire, branch=None, closed=False):
+        """
+        Returns the heads of `branch`, or of all branches, as binary nodes
+        ordered from newest to oldest.
 
-        baseui.write = write
+        `branch` can be given as any revision, its branch is used.
+        """
+        repo = self._factory.repo(wire)
+        branchmap = repo.branchmap()
         if branch:
-            args = [branch]
+            branches = [repo[branch].branch()]
         else:
-            args = []
-        commands.heads(baseui, repo, template='{node} ', *args)
+            branches = list(branchmap)
 
-        return output.getvalue()
+        changelog = repo.changelog
+        revs = set()
+        for name in branches:
+            if name in branchmap:
+                revs.update(
+                    changelog.rev(node) for node in
+                    branchmap.branchheads(name, closed=closed))
+        return [changelog.node(rev) for rev in sorted(revs, reverse=True)]
 
     @reraise_safe_exceptions
     def ancestor(self, wire, revision1, revision2):
+        """
+        Returns the common ancestor like `hg debugancestor`, as `rev:node`.
+        """
         repo = self._factory.repo(wire)
-        baseui = self._factory._create_config(wire['config'])
-        output = io.BytesIO()
-        baseui.write = output.write
-        commands.debugancestor(baseui, repo, revision1, revision2)
+        changelog = repo.changelog
+        node = changelog.ancestor(repo.lookup(revision1),
+                                  repo.lookup(revision2))
+        return '%d:%s\n' % (changelog.rev(node), hex(node))
 
-        return output.getvalue()
+    @reraise_safe_exceptions
+    def ancestors(self, wire, pairs):
+        """
+        Returns the common ancestor of each pair of revisions as binary node.
+        """
+        repo = self._factory.repo(wire)
+        changelog = repo.changelog
+        return [
+            changelog.ancestor(repo.lookup(revision1), repo.lookup(revision2))
+            for revision1, revision2 in pairs]
 
     @reraise_safe_exceptions
     def push(self, wire, revisions, dest_path, hooks=True,
@@ -670,6 +1280,7 @@ class HgRemote(object):
         baseui = self._factory._create_config(wire['config'], hooks=hooks)
         commands.push(baseui, repo, dest=dest_path, rev=revisions,
                       new_branch=push_branches)
+        hgcache.schedule_path(dest_path, repo.baseui)
 
     @reraise_safe_exceptions
     def merge(self, wire, revision):
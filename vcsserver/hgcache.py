@@ -0,0 +1,146 @@
+# RhodeCode VCSServer provides access to different vcs backends via network.
+# Copyright (C) 2014-2016 RodeCode GmbH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Background warming of the on-disk caches of Mercurial repositories.
+
+After a repository changed, Mercurial rebuilds its branchmap, tags and
+revision branch caches lazily on the next read. `CacheWarmer` does this in a
+background thread instead, so that interactive requests find warm caches.
+"""
+
+import logging
+import os
+from collections import OrderedDict
+from threading import Condition, Thread
+
+from vcsserver import settings
+from vcsserver.hgcompat import localrepository
+
+log = logging.getLogger(__name__)
+
+
+class CacheWarmer(object):
+    """
+    Warms the caches of repositories one after another in a worker thread.
+
+    Scheduling a repository which is already waiting is coalesced into the
+    waiting entry, so a burst of pushes leads to a single warming run.
+    """
+
+    # Repository views which are served, `visible` by `HgRemote` and
+    # `served` by hgweb
+    FILTERS = ('visible', 'served')
+
+    def __init__(self):
+        self._condition = Condition()
+        self._pending = OrderedDict()
+        self._thread = None
+        self._warmed = 0
+        self._coalesced = 0
+        self._failed = 0
+
+    def schedule(self, path, baseui):
+        """
+        Schedules the warming of the repository at `path` using `baseui`.
+        """
+        if not settings.HG_WARM_CACHES:
+            return
+        with self._condition:
+            if path in self._pending:
+                self._coalesced += 1
+            else:
+                self._pending[path] = baseui.copy()
+            self._ensure_worker()
+            self._condition.notify()
+
+    def schedule_repo(self, repo):
+        self.schedule(repo.root, repo.baseui)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'pending': len(self._pending),
+                'warmed': self._warmed,
+                'coalesced': self._coalesced,
+                'failed': self._failed,
+            }
+
+    def run_pending(self):
+        """
+        Warms all waiting repositories in the calling thread.
+        """
+        while self._run_next(block=False):
+            pass
+
+    def warm(self, path, baseui):
+        repo = localrepository(baseui, path)
+        for name in self.FILTERS:
+            repo.filtered(name).branchmap()
+        repo.tags()
+        # Updating the branchmaps filled the revision branch cache for the
+        # revisions they did not know yet
+        repo.revbranchcache().write()
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._work, name='hg-cache-warmer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _work(self):
+        while True:
+            self._run_next(block=True)
+
+    def _run_next(self, block):
+        with self._condition:
+            while block and not self._pending:
+                self._condition.wait()
+            if not self._pending:
+                return False
+            path, baseui = self._pending.popitem(last=False)
+
+        try:
+            self.warm(path, baseui)
+        except Exception:
+            log.exception('Failed to warm the caches of %s', path)
+            with self._condition:
+                self._failed += 1
+        else:
+            log.debug('Warmed the caches of %s', path)
+            with self._condition:
+                self._warmed += 1
+        return True
+
+
+warmer = CacheWarmer()
+
+
+def warm_caches_hook(ui, repo, **kwargs):
+    """
+    Mercurial `txnclose` hook which schedules the warming of `repo`.
+    """
+    warmer.schedule_repo(repo.unfiltered())
+    return False
+
+
+def schedule_path(path, baseui):
+    """
+    Schedules the warming of `path` if it is a local repository.
+    """
+    if os.path.isdir(os.path.join(path, '.hg')):
+        warmer.schedule(path, baseui)
@@ -31,10 +31,13 @@ from mercurial import config
 from mercurial import extensions
 from mercurial import scmutil
 from mercurial import archival
+from mercurial import changegroup
 from mercurial import discovery
 from mercurial import unionrepo
 from mercurial import localrepo
+from mercurial import streamclone
 from mercurial import merge as hg_merge
+from mercurial import mdiff
 
 from mercurial.commands import clone, nullid, pull
 from mercurial.context import memctx, memfilectx
@@ -51,6 +54,7 @@ from mercurial.discovery import findcommonoutgoing
 from mercurial.hg import peer
 from mercurial.httppeer import httppeer
 from mercurial.util import url as hg_url
+from mercurial.util import copymode
 from mercurial.scmutil import revrange
 from mercurial.node import nullrev
 from mercurial import exchange
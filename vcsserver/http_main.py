@@ -26,9 +26,13 @@ import msgpack
 from beaker.cache import CacheManager
 from beaker.util import parse_cache_config_options
 from pyramid.config import Configurator
-from pyramid.wsgi import wsgiapp
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from pyramid.response import FileResponse, Response
+from pyramid.wsgi import wsgiapp, wsgiapp2
+from webob.static import DirectoryApp
 
-from vcsserver import remote_wsgi, scm_app, settings, hgpatches
+from vcsserver import (
+    remote_wsgi, scm_app, settings, hgcache, hgpatches, subprocessio)
 from vcsserver.echo_stub import remote_wsgi as remote_wsgi_stub
 from vcsserver.echo_stub.echo_app import EchoApp
 from vcsserver.server import VcsServer
@@ -175,6 +179,52 @@ class HTTPApplication(object):
         git_path = app_settings.get('git_path', None)
         if git_path:
             settings.GIT_EXECUTABLE = git_path
+        subprocessio_engine = app_settings.get('subprocessio.engine', None)
+        if subprocessio_engine:
+            settings.SUBPROCESSIO_ENGINE = subprocessio_engine
+        subprocessio_chunk_size = app_settings.get(
+            'subprocessio.chunk_size', None)
+        if subprocessio_chunk_size:
+            settings.SUBPROCESSIO_CHUNK_SIZE = int(subprocessio_chunk_size)
+        subprocessio_buffer_size = app_settings.get(
+            'subprocessio.buffer_size', None)
+        if subprocessio_buffer_size:
+            settings.SUBPROCESSIO_BUFFER_SIZE = int(subprocessio_buffer_size)
+        use_file_wrapper = app_settings.get(
+            'subprocessio.use_file_wrapper', 'false')
+        settings.SUBPROCESSIO_USE_FILE_WRAPPER = (
+            use_file_wrapper.lower() == 'true')
+        subprocessio_spawn = app_settings.get('subprocessio.spawn', None)
+        if subprocessio_spawn:
+            settings.SUBPROCESSIO_SPAWN = subprocessio_spawn
+        settings.SUBPROCESSIO_MAX_PROCESSES = int(app_settings.get(
+            'subprocessio.max_processes', 0))
+        settings.SUBPROCESSIO_MAX_PROCESSES_PER_REPO = int(app_settings.get(
+            'subprocessio.max_processes_per_repo', 0))
+        settings.SUBPROCESSIO_QUEUE_TIMEOUT = int(app_settings.get(
+            'subprocessio.queue_timeout', 60))
+        settings.HG_WSGI_APP_CACHE_SIZE = int(app_settings.get(
+            'hg.wsgi_app_cache_size', 50))
+        settings.HG_WARM_CACHES = app_settings.get(
+            'hg.warm_caches', 'true').lower() == 'true'
+        svn_fs_cache_size = app_settings.get('svn.fs_cache_size', None)
+        if svn_fs_cache_size:
+            settings.SVN_FS_CACHE_SIZE = int(svn_fs_cache_size)
+        svn_fs_cache_file_handles = app_settings.get(
+            'svn.fs_cache_file_handles', None)
+        if svn_fs_cache_file_handles:
+            settings.SVN_FS_CACHE_FILE_HANDLES = int(svn_fs_cache_file_handles)
+        settings.SVN_FS_CACHE_DELTAS = app_settings.get(
+            'svn.fs_cache_deltas', 'true').lower() == 'true'
+        settings.SVN_FS_CACHE_FULLTEXTS = app_settings.get(
+            'svn.fs_cache_fulltexts', 'true').lower() == 'true'
+        settings.SVN_FS_CACHE_REVPROPS = app_settings.get(
+            'svn.fs_cache_revprops', 'false').lower() == 'true'
+        settings.SVN_REVISION_ROOT_CACHE_SIZE = int(app_settings.get(
+            'svn.revision_root_cache_size', 100))
+        clone_bundles_path = app_settings.get('clone_bundles_path', None)
+        if clone_bundles_path:
+            settings.CLONE_BUNDLES_PATH = clone_bundles_path
 
     def _configure(self):
         self.config.add_renderer(
@@ -185,8 +235,11 @@ class HTTPApplication(object):
         self.config.add_route('hg_proxy', '/proxy/hg')
         self.config.add_route('git_proxy', '/proxy/git')
         self.config.add_route('vcs', '/{backend}')
+        self.config.add_route('vcs_stream', '/{backend}/stream')
         self.config.add_route('stream_git', '/stream/git/*repo_name')
         self.config.add_route('stream_hg', '/stream/hg/*repo_name')
+        self.config.add_route('largefiles_hg', '/largefiles/hg/{sha}')
+        self.config.add_route('svn_commit', '/svn/commit')
 
         self.config.add_view(
             self.status_view, route_name='status', renderer='json')
@@ -194,17 +247,27 @@ class HTTPApplication(object):
         self.config.add_view(self.git_proxy(), route_name='git_proxy')
         self.config.add_view(
             self.vcs_view, route_name='vcs', renderer='msgpack')
+        self.config.add_view(self.vcs_stream_view, route_name='vcs_stream')
 
         self.config.add_view(self.hg_stream(), route_name='stream_hg')
         self.config.add_view(self.git_stream(), route_name='stream_git')
+        self.config.add_view(
+            self.largefiles_hg_view, route_name='largefiles_hg',
+            request_method=('GET', 'PUT'))
+        self.config.add_view(
+            self.svn_commit_view, route_name='svn_commit',
+            request_method='POST')
+
+        if settings.CLONE_BUNDLES_PATH:
+            self.config.add_route('clone_bundles', '/bundles/*subpath')
+            self.config.add_view(
+                self.clone_bundles(), route_name='clone_bundles')
 
     def wsgi_app(self):
         return self.config.make_wsgi_app()
 
-    def vcs_view(self, request):
-        remote = self._remotes[request.matchdict['backend']]
+    def _parse_payload(self, request):
         payload = msgpack.unpackb(request.body, use_list=True)
-        method = payload.get('method')
         params = payload.get('params')
         wire = params.get('wire')
         args = params.get('args')
@@ -215,35 +278,112 @@ class HTTPApplication(object):
             except KeyError:
                 pass
             args.insert(0, wire)
+        return payload, payload.get('method'), args, kwargs
+
+    def _error_response(self, payload, e):
+        type_ = e.__class__.__name__
+        if type_ not in self.ALLOWED_EXCEPTIONS:
+            type_ = None
+
+        resp = {
+            'id': payload.get('id'),
+            'error': {
+                'message': e.message,
+                'type': type_
+            }
+        }
+        try:
+            resp['error']['_vcs_kind'] = e._vcs_kind
+        except AttributeError:
+            pass
+        return resp
+
+    def vcs_view(self, request):
+        remote = self._remotes[request.matchdict['backend']]
+        payload, method, args, kwargs = self._parse_payload(request)
 
         try:
             resp = getattr(remote, method)(*args, **kwargs)
         except Exception as e:
-            type_ = e.__class__.__name__
-            if type_ not in self.ALLOWED_EXCEPTIONS:
-                type_ = None
-
+            resp = self._error_response(payload, e)
+        else:
             resp = {
                 'id': payload.get('id'),
-                'error': {
-                    'message': e.message,
-                    'type': type_
-                }
+                'result': resp
             }
+
+        return resp
+
+    def vcs_stream_view(self, request):
+        """
+        Calls a `*_stream` method and sends the items it yields as a sequence
+        of msgpack objects, as soon as they are produced.
+
+        Errors are sent in the format of `vcs_view`, either as the only item
+        or as the last item if they occur while streaming.
+        """
+        remote = self._remotes[request.matchdict['backend']]
+        payload, method, args, kwargs = self._parse_payload(request)
+
+        response = Response(content_type='application/x-msgpack')
+        try:
+            if not method.endswith('_stream'):
+                raise AttributeError(
+                    'Method %s does not support streaming' % (method, ))
+            chunks = getattr(remote, method)(*args, **kwargs)
+        except Exception as e:
+            response.body = msgpack.packb(self._error_response(payload, e))
+            return response
+
+        def stream():
             try:
-                resp['error']['_vcs_kind'] = e._vcs_kind
-            except AttributeError:
-                pass
+                for chunk in chunks:
+                    yield msgpack.packb(chunk)
+            except Exception as e:
+                log.exception('Error while streaming %s', method)
+                yield msgpack.packb(self._error_response(payload, e))
+
+        response.app_iter = stream()
+        return response
+
+    def svn_commit_view(self, request):
+        """
+        Commits to a Subversion repository from a stream of msgpack objects,
+        so that the content of the files is never in memory as a whole.
+
+        The stream starts with a dict with the `id` of the request and the
+        `wire`, `message`, `author`, `timestamp` and `removed` arguments of
+        `SvnRemote.commit`. For every updated file a dict with its `path` and
+        `properties` follows, then the chunks of its content and `None`.
+        The response has the format of `vcs_view`.
+        """
+        remote = self._remotes['svn']
+        unpacker = msgpack.Unpacker(request.body_file, read_size=65536)
+        header = {}
+
+        try:
+            header = _unpack_commit_header(unpacker)
+            result = remote.commit_nodes(
+                header['wire'], header['message'], header['author'],
+                header.get('timestamp'), _unpack_commit_nodes(unpacker),
+                header.get('removed', []))
+        except Exception as e:
+            resp = self._error_response(header, e)
         else:
             resp = {
-                'id': payload.get('id'),
-                'result': resp
+                'id': header.get('id'),
+                'result': result
             }
 
-        return resp
+        return Response(
+            body=msgpack.packb(resp), content_type='application/x-msgpack')
 
     def status_view(self, request):
-        return {'status': 'OK'}
+        return {
+            'status': 'OK',
+            'subprocessio': subprocessio.admission.stats(),
+            'hg_cache_warming': hgcache.warmer.stats(),
+        }
 
     def _msgpack_renderer_factory(self, info):
         def _render(value, system):
@@ -286,8 +426,7 @@ class HTTPApplication(object):
                 packed_config = base64.b64decode(
                     environ['HTTP_X_RC_REPO_CONFIG'])
                 config = msgpack.unpackb(packed_config)
-                app = scm_app.create_hg_wsgi_app(
-                    repo_path, repo_name, config)
+                app = scm_app.get_hg_wsgi_app(repo_path, repo_name, config)
 
                 # Consitent path information for hgweb
                 environ['PATH_INFO'] = environ['HTTP_X_RC_PATH_INFO']
@@ -318,6 +457,76 @@ class HTTPApplication(object):
             return _git_stream
 
 
+    def largefiles_hg_view(self, request):
+        """
+        Downloads (`GET`) or uploads (`PUT`) a single Mercurial largefile.
+
+        The content is streamed in chunks in both directions, so that the
+        memory use does not depend on the size of the largefile.
+        """
+        remote = self._remotes['hg']
+        sha = request.matchdict['sha']
+        wire = {
+            'path': request.headers['X-RC-REPO-PATH'],
+            'config': msgpack.unpackb(
+                base64.b64decode(request.headers['X-RC-REPO-CONFIG'])),
+        }
+
+        try:
+            if request.method == 'PUT':
+                remote.largefile_store(wire, sha, request.body_file)
+                return Response(status=201)
+            path = remote.largefile_path(wire, sha)
+        except Exception as e:
+            if getattr(e, '_vcs_kind', None) in ('abort', 'lookup'):
+                return HTTPBadRequest(e.message)
+            raise
+
+        if path is None:
+            return HTTPNotFound()
+        return FileResponse(
+            path, request=request, content_type='application/octet-stream')
+
+    def clone_bundles(self):
+        """
+        Serves the pre-computed clone bundles from disk.
+
+        The file is handed over to the server's `wsgi.file_wrapper`, so that
+        servers which support it can send it without copying it through
+        Python.
+        """
+        app = DirectoryApp(settings.CLONE_BUNDLES_PATH, index_page=None)
+        return wsgiapp2(app)
+
+
+def _unpack_commit_header(unpacker):
+    try:
+        header = next(unpacker)
+    except StopIteration:
+        raise ValueError('Commit stream is empty')
+    if not isinstance(header, dict):
+        raise ValueError('Commit stream does not start with a header')
+    return header
+
+
+def _unpack_commit_nodes(unpacker):
+    """
+    Yields the updated nodes of the stream of `svn_commit_view` with an
+    iterator over their content, which has to be consumed before the next
+    node.
+    """
+    for node in unpacker:
+        yield node, _unpack_commit_chunks(unpacker)
+
+
+def _unpack_commit_chunks(unpacker):
+    for chunk in unpacker:
+        if chunk is None:
+            return
+        yield chunk
+    raise ValueError('Commit stream ended within the content of a node')
+
+
 class ResponseFilter(object):
 
     def __init__(self, start_response):
@@ -25,7 +25,7 @@ import simplejson as json
 import dulwich.protocol
 from webob import Request, Response, exc
 
-from vcsserver import hooks, subprocessio
+from vcsserver import hooks, settings, subprocessio
 
 
 log = logging.getLogger(__name__)
@@ -74,6 +74,9 @@ class GitRepository(object):
         '\x02\x9d\x08\x82;\xd8\xa8\xea\xb5\x10\xadj\xc7\\\x82<\xfd>\xd3\x1e'
     )
     SIDE_BAND_CAPS = frozenset(('side-band', 'side-band-64k'))
+    # Version 2 always multiplexes the packfile section with side-band-64k
+    V2_SIDE_BAND_CAPS = frozenset(('side-band-64k',))
+    V2_PACKFILE_HEADER = '000dpackfile\n'
 
     def __init__(self, repo_name, content_path, git_path, update_server_info,
                  extras):
@@ -97,7 +100,25 @@ class GitRepository(object):
         """
         return path.split(self.repo_name, 1)[-1].strip('/')
 
-    def inforefs(self, request, unused_environ):
+    def _is_protocol_v2(self, environ):
+        """
+        Check if the client asked for Git wire protocol version 2.
+
+        Version 2 is required for bundle URIs, so the protocol header is passed
+        on to git as `GIT_PROTOCOL`.
+        """
+        return 'version=2' in environ.get('HTTP_GIT_PROTOCOL', '')
+
+    def _get_v2_command(self, request):
+        """Read the command name from a version 2 request."""
+        pos = request.body_file_seekable.tell()
+        first_line = request.body_file_seekable.readline()
+        request.body_file_seekable.seek(pos)
+
+        # skip the pkt-line length prefix
+        return first_line[4:].strip().partition('command=')[2]
+
+    def inforefs(self, request, environ):
         """
         WSGI Response producer for HTTP GET Git Smart
         HTTP /info/refs request.
@@ -118,18 +139,26 @@ class GitRepository(object):
         # if you do add '\n' as part of data, count it.
         server_advert = '# service=%s\n' % git_command
         packet_len = str(hex(len(server_advert) + 4)[2:].rjust(4, '0')).lower()
+        starting_values = [packet_len + server_advert + '0000']
         try:
             gitenv = dict(os.environ)
             # forget all configs
             gitenv['RC_SCM_DATA'] = json.dumps(self.extras)
+            if self._is_protocol_v2(environ):
+                # version 2 starts directly with the capability advertisement
+                gitenv['GIT_PROTOCOL'] = environ['HTTP_GIT_PROTOCOL']
+                starting_values = []
             command = [self.git_path, git_command[4:], '--stateless-rpc',
                        '--advertise-refs', self.content_path]
             out = subprocessio.SubprocessIOChunker(
                 command,
                 env=gitenv,
-                starting_values=[packet_len + server_advert + '0000'],
-                shell=False
+                starting_values=starting_values,
+                shell=False,
+                admission_key=self.content_path
             )
+        except subprocessio.AdmissionTimeout:
+            raise
         except EnvironmentError:
             log.exception('Error processing command')
             raise exc.HTTPExpectationFailed()
@@ -150,7 +179,8 @@ class GitRepository(object):
         return frozenset(
             dulwich.protocol.extract_want_line_capabilities(first_line)[1])
 
-    def _build_failed_pre_pull_response(self, capabilities, pre_pull_messages):
+    def _build_failed_pre_pull_response(self, capabilities, pre_pull_messages,
+                                        protocol_v2=False):
         """
         Construct a response with an empty PACK file.
 
@@ -165,8 +195,20 @@ class GitRepository(object):
 
         Note that for clients not supporting side-band we just send them the
         emtpy PACK file.
+
+        Version 2 clients get an `ERR` packet with the messages instead, which
+        aborts the fetch with a "remote error".
         """
-        if self.SIDE_BAND_CAPS.intersection(capabilities):
+        if protocol_v2:
+            response = []
+            proto = dulwich.protocol.Protocol(None, response.append)
+            message = 'ERR %sPre pull hook failed: aborting' % (
+                pre_pull_messages or '')
+            # keep the packet within the maximum pkt-line length
+            proto.write_pkt_line(message[:65516])
+            proto.write_pkt_line(None)
+            return response
+        elif self.SIDE_BAND_CAPS.intersection(capabilities):
             response = []
             proto = dulwich.protocol.Protocol(None, response.append)
             proto.write_pkt_line('NAK\n')
@@ -221,7 +263,8 @@ class GitRepository(object):
         return response
 
     def _inject_messages_to_response(self, response, capabilities,
-                                     start_messages, end_messages):
+                                     start_messages, end_messages,
+                                     protocol_v2=False):
         """
         Given a list reponse we inject the pre/post-pull messages.
 
@@ -232,6 +275,10 @@ class GitRepository(object):
         Note that we do not check the no-progress capability as by default, git
         sends it, which effectively would block all messages.
         """
+        if protocol_v2:
+            return self._inject_messages_to_v2_response(
+                response, start_messages, end_messages)
+
         if not self.SIDE_BAND_CAPS.intersection(capabilities):
             return response
 
@@ -255,6 +302,63 @@ class GitRepository(object):
 
         return new_response
 
+    def _inject_messages_to_v2_response(self, response, start_messages,
+                                        end_messages):
+        """
+        Inject the pre/post-pull messages at the end of a version 2 fetch.
+
+        Only the packfile section is multiplexed, it is the last section of
+        the response and ends with:
+            ...0000
+
+        Pack data is only sent after the section header, so searching for the
+        header cannot match the data of an earlier packet.
+        """
+        if not response or not response[-1].endswith('0000'):
+            return response
+
+        if not start_messages and not end_messages:
+            return response
+
+        if not self._has_v2_packfile_section(response):
+            return response
+
+        new_response = response[:-1]
+        new_response.append(response[-1][:-4])
+        new_response.extend(
+            self._get_messages(start_messages, self.V2_SIDE_BAND_CAPS))
+        new_response.extend(
+            self._get_messages(end_messages, self.V2_SIDE_BAND_CAPS))
+        new_response.append('0000')
+
+        return new_response
+
+    def _has_v2_packfile_section(self, response):
+        header = self.V2_PACKFILE_HEADER
+        tail = ''
+        for chunk in response:
+            # the header may be split between two chunks
+            data = tail + chunk
+            if header in data:
+                return True
+            tail = data[-(len(header) - 1):]
+        return False
+
+    def _can_relay_output(self, git_command, environ):
+        """
+        Check if the output of git can be handed unmodified to the server.
+
+        This is not possible if messages of the pull hooks have to be injected
+        into the response or if update-server-info has to run after a push.
+        """
+        if not settings.SUBPROCESSIO_USE_FILE_WRAPPER:
+            return False
+        if 'wsgi.file_wrapper' not in environ:
+            return False
+        if git_command == 'git-upload-pack':
+            return 'pull' not in self.extras.get('hooks', ())
+        return not self.update_server_info
+
     def backend(self, request, environ):
         """
         WSGI Response producer for HTTP POST Git Smart HTTP requests.
@@ -282,9 +386,12 @@ class GitRepository(object):
             log.debug('command %s not allowed', git_command)
             return exc.HTTPForbidden()
 
+        protocol_v2 = self._is_protocol_v2(environ)
         capabilities = None
-        if git_command == 'git-upload-pack':
+        if git_command == 'git-upload-pack' and not protocol_v2:
             capabilities = self._get_want_capabilities(request)
+        run_pull_hooks = git_command == 'git-upload-pack' and (
+            not protocol_v2 or self._get_v2_command(request) == 'fetch')
 
         if 'CONTENT_LENGTH' in environ:
             inputstream = FileWrapper(request.body_file_seekable,
@@ -297,21 +404,38 @@ class GitRepository(object):
                              git_command.encode('utf8'))
         resp.charset = None
 
-        if git_command == 'git-upload-pack':
+        if run_pull_hooks:
             status, pre_pull_messages = hooks.git_pre_pull(self.extras)
             if status != 0:
                 resp.app_iter = self._build_failed_pre_pull_response(
-                    capabilities, pre_pull_messages)
+                    capabilities or frozenset(), pre_pull_messages,
+                    protocol_v2=protocol_v2)
                 return resp
 
         gitenv = dict(os.environ)
         # forget all configs
         gitenv['GIT_CONFIG_NOGLOBAL'] = '1'
         gitenv['RC_SCM_DATA'] = json.dumps(self.extras)
+        if protocol_v2:
+            gitenv['GIT_PROTOCOL'] = environ['HTTP_GIT_PROTOCOL']
         cmd = [self.git_path, git_command[4:], '--stateless-rpc',
                self.content_path]
         log.debug('handling cmd %s', cmd)
 
+        if self._can_relay_output(git_command, environ):
+            log.debug('relaying output of %s to wsgi.file_wrapper', cmd)
+            relay = subprocessio.SubprocessIORelay(
+                cmd,
+                inputstream=inputstream,
+                env=gitenv,
+                cwd=self.content_path,
+                shell=False,
+                admission_key=self.content_path
+            )
+            resp.app_iter = environ['wsgi.file_wrapper'](
+                relay, settings.SUBPROCESSIO_BUFFER_SIZE)
+            return resp
+
         out = subprocessio.SubprocessIOChunker(
             cmd,
             inputstream=inputstream,
@@ -319,7 +443,8 @@ class GitRepository(object):
             cwd=self.content_path,
             shell=False,
             fail_on_stderr=False,
-            fail_on_return_code=False
+            fail_on_return_code=False,
+            admission_key=self.content_path
         )
 
         if self.update_server_info and git_command == 'git-receive-pack':
@@ -345,11 +470,12 @@ class GitRepository(object):
             for _ in output:
                 pass
 
-        if git_command == 'git-upload-pack':
+        if run_pull_hooks:
             out = list(out)
             unused_status, post_pull_messages = hooks.git_post_pull(self.extras)
             resp.app_iter = self._inject_messages_to_response(
-                out, capabilities, pre_pull_messages, post_pull_messages)
+                out, capabilities or frozenset(), pre_pull_messages,
+                post_pull_messages, protocol_v2=protocol_v2)
         else:
             resp.app_iter = out
 
@@ -368,6 +494,11 @@ class GitRepository(object):
         except exc.HTTPException as error:
             log.exception('HTTP Error')
             resp = error
+        except subprocessio.AdmissionTimeout:
+            log.warning('No process slot for %s, rejecting request',
+                        self.content_path)
+            resp = exc.HTTPServiceUnavailable(
+                headers=[('Retry-After', '10')])
         except Exception:
             log.exception('Unknown error')
             resp = exc.HTTPInternalServerError()
@@ -15,6 +15,7 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import hashlib
 import logging
 import os
 
@@ -24,8 +25,9 @@ import mercurial.hgweb.common
 import mercurial.hgweb.hgweb_mod
 import mercurial.hgweb.protocol
 import webob.exc
+from repoze.lru import LRUCache
 
-from vcsserver import pygrack, exceptions, settings
+from vcsserver import pygrack, exceptions, hgcache, settings
 
 
 log = logging.getLogger(__name__)
@@ -125,12 +127,70 @@ def create_hg_wsgi_app(repo_path, repo_name, config):
     baseui = make_hg_ui_from_config(config)
     update_hg_ui_from_hgrc(baseui, repo_path)
 
+    if os.path.isfile(
+            os.path.join(repo_path, '.hg', 'clonebundles.manifest')):
+        # advertise the pre-computed bundle, see `HgRemote.create_clone_bundle`
+        baseui.setconfig('extensions', 'clonebundles', '')
+
+    # warm the caches of pushed changes before they are read the next time
+    baseui.setconfig(
+        'hooks', 'txnclose.rc_warm_caches', hgcache.warm_caches_hook)
+
     try:
         return HgWeb(repo_path, name=repo_name, baseui=baseui)
     except mercurial.error.RequirementError as exc:
         raise exceptions.RequirementException(exc)
 
 
+_hg_wsgi_apps = None
+
+
+def _get_hg_wsgi_app_cache():
+    global _hg_wsgi_apps
+    size = settings.HG_WSGI_APP_CACHE_SIZE
+    if _hg_wsgi_apps is None or _hg_wsgi_apps.size != size:
+        _hg_wsgi_apps = LRUCache(size)
+    return _hg_wsgi_apps
+
+
+def _hg_wsgi_app_key(repo_path, repo_name, config):
+    """
+    Key of a prepared `HgWeb`, it changes with everything which goes into
+    its `ui`. Changes of the repository itself are picked up by hgweb.
+    """
+    config_digest = hashlib.sha1(
+        repr([tuple(item) for item in config])).hexdigest()
+    try:
+        hgrc_mtime = os.stat(
+            os.path.join(repo_path, '.hg', 'hgrc')).st_mtime
+    except OSError:
+        hgrc_mtime = None
+    has_clone_bundles = os.path.isfile(
+        os.path.join(repo_path, '.hg', 'clonebundles.manifest'))
+    return (repo_path, repo_name, config_digest, hgrc_mtime,
+            has_clone_bundles)
+
+
+def get_hg_wsgi_app(repo_path, repo_name, config):
+    """
+    Returns a cached WSGI application to handle Mercurial requests.
+
+    hgweb keeps a pool of repository instances and refreshes them when the
+    repository changes, so a cached application can serve later requests
+    without opening the repository again.
+    """
+    if not settings.HG_WSGI_APP_CACHE_SIZE:
+        return create_hg_wsgi_app(repo_path, repo_name, config)
+
+    cache = _get_hg_wsgi_app_cache()
+    key = _hg_wsgi_app_key(repo_path, repo_name, config)
+    app = cache.get(key)
+    if app is None:
+        app = create_hg_wsgi_app(repo_path, repo_name, config)
+        cache.put(key, app)
+    return app
+
+
 class GitHandler(object):
     def __init__(self, repo_location, repo_name, git_path, update_server_info,
                  extras):
@@ -28,3 +28,38 @@ PYRO_HG_REMOTE_WSGI = 'hg_remote_wsgi'
 WIRE_ENCODING = 'UTF-8'
 
 GIT_EXECUTABLE = 'git'
+
+# Engine used by `subprocessio.SubprocessIOChunker`, "thread" or "eventloop"
+SUBPROCESSIO_ENGINE = 'thread'
+SUBPROCESSIO_BUFFER_SIZE = 65536
+SUBPROCESSIO_CHUNK_SIZE = 4096
+# Pass unmodified git output to the server's `wsgi.file_wrapper`
+SUBPROCESSIO_USE_FILE_WRAPPER = False
+# Process creation of `subprocessio`, "fork" or "posix_spawn"
+SUBPROCESSIO_SPAWN = 'fork'
+# Limits of concurrently running git processes served via HTTP, 0 disables
+# them, and the seconds to wait for a free slot before the request fails
+SUBPROCESSIO_MAX_PROCESSES = 0
+SUBPROCESSIO_MAX_PROCESSES_PER_REPO = 0
+SUBPROCESSIO_QUEUE_TIMEOUT = 60
+
+# Number of prepared hgweb applications kept for /stream/hg, 0 disables it
+HG_WSGI_APP_CACHE_SIZE = 50
+# Rebuild the branchmap, tags and branch caches in the background after
+# Mercurial repositories changed
+HG_WARM_CACHES = True
+
+# Size in MB and open file handles of the in-process FSFS cache of
+# Subversion, `None` keeps the defaults of Subversion
+SVN_FS_CACHE_SIZE = None
+SVN_FS_CACHE_FILE_HANDLES = None
+# Data kept in the FSFS cache
+SVN_FS_CACHE_DELTAS = True
+SVN_FS_CACHE_FULLTEXTS = True
+SVN_FS_CACHE_REVPROPS = False
+# Number of Subversion revision roots kept per thread and repository, 0
+# disables the cache
+SVN_REVISION_ROOT_CACHE_SIZE = 100
+
+# Directory holding the pre-computed clone bundles served under /bundles
+CLONE_BUNDLES_PATH = None
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+# RhodeCode VCSServer provides access to different vcs backends via network.
+# Copyright (C) 2014-2016 RodeCode GmbH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+"""
+Spawning of subprocesses via `posix_spawn`.
+
+`subprocess.Popen` forks the worker before it executes the command. The cost
+of the fork grows with the size of the worker, because its page tables have
+to be copied, and our workers carry large caches of repository objects.
+glibc implements `posix_spawn` based on `clone(CLONE_VM | CLONE_VFORK)`, so
+the address space is not copied and the cost does not depend on the size of
+the worker.
+
+`Popen` implements the subset of `subprocess.Popen` which is needed by
+`subprocessio`, use `popen` to pick the implementation based on the settings.
+"""
+
+import ctypes
+import errno
+import fcntl
+import os
+import signal
+import sys
+from threading import Lock, RLock
+
+import subprocess32 as subprocess
+
+from vcsserver import settings
+
+
+PIPE = subprocess.PIPE
+
+# glibc values of the flags in posix_spawnattr_t
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSIGMASK = 0x08
+
+# The glibc structures are opaque, the buffers are sized generously
+_FILE_ACTIONS_SIZE = 256
+_ATTR_SIZE = 1024
+_SIGSET_SIZE = 256
+
+_SUPPORTED_KWARGS = frozenset((
+    'bufsize', 'stdin', 'stdout', 'stderr', 'env', 'cwd', 'shell',
+    'close_fds'))
+
+# Signals ignored by Python which have to be restored in the child,
+# same as `restore_signals` of `subprocess.Popen`.
+_RESTORED_SIGNALS = tuple(
+    getattr(signal, name) for name in ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ')
+    if hasattr(signal, name))
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        # changing the directory and closing all other file descriptors
+        # needs glibc 2.34 or newer
+        libc.posix_spawn
+        libc.posix_spawn_file_actions_addchdir_np
+        libc.posix_spawn_file_actions_addclosefrom_np
+    except (OSError, AttributeError):
+        return None
+
+    libc.posix_spawn.argtypes = [
+        ctypes.POINTER(ctypes.c_int), ctypes.c_char_p, ctypes.c_void_p,
+        ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p),
+        ctypes.POINTER(ctypes.c_char_p)]
+    libc.posix_spawn_file_actions_adddup2.argtypes = [
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+    libc.posix_spawn_file_actions_addchdir_np.argtypes = [
+        ctypes.c_void_p, ctypes.c_char_p]
+    libc.posix_spawn_file_actions_addclosefrom_np.argtypes = [
+        ctypes.c_void_p, ctypes.c_int]
+    libc.posix_spawnattr_setflags.argtypes = [ctypes.c_void_p, ctypes.c_short]
+    return libc
+
+
+_libc = _load_libc()
+
+_active = []
+_active_lock = RLock()
+
+
+def available():
+    """
+    Returns `True` if `posix_spawn` can be used on this system.
+    """
+    return _libc is not None
+
+
+def can_spawn(kwargs):
+    """
+    Checks if a call to `subprocess.Popen` with `kwargs` can be served
+    by `Popen` of this module.
+    """
+    if not available():
+        return False
+    if not _SUPPORTED_KWARGS.issuperset(kwargs):
+        return False
+    return subprocess.STDOUT not in (
+        kwargs.get('stdin'), kwargs.get('stdout'), kwargs.get('stderr'))
+
+
+def popen(cmd, **kwargs):
+    """
+    Starts `cmd` via `posix_spawn` if it is enabled and possible, via
+    `subprocess.Popen` otherwise.
+    """
+    if settings.SUBPROCESSIO_SPAWN == 'posix_spawn' and can_spawn(kwargs):
+        return Popen(cmd, **kwargs)
+    return subprocess.Popen(cmd, **kwargs)
+
+
+def _cleanup():
+    """
+    Reaps processes whose `Popen` objects have been collected already.
+    """
+    with _active_lock:
+        for process in _active[:]:
+            if process.poll() is not None:
+                _active.remove(process)
+
+
+def _check(result):
+    if result:
+        raise OSError(result, os.strerror(result))
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode(sys.getfilesystemencoding())
+    return value
+
+
+def _to_c_array(values):
+    array = (ctypes.c_char_p * (len(values) + 1))()
+    array[:len(values)] = values
+    array[len(values)] = None
+    return array
+
+
+def _cloexec_pipe():
+    read_fd, write_fd = os.pipe()
+    for fd in (read_fd, write_fd):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return read_fd, write_fd
+
+
+def _find_executable(name, env):
+    if os.path.dirname(name):
+        return name
+    for directory in env.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    raise OSError(
+        errno.ENOENT, '%s: %r' % (os.strerror(errno.ENOENT), name))
+
+
+class Popen(object):
+    """
+    Process started via `posix_spawn`, mimicking `subprocess.Popen`.
+    """
+
+    returncode = None
+
+    def __init__(self, args, bufsize=-1, stdin=None, stdout=None,
+                 stderr=None, env=None, cwd=None, shell=False,
+                 close_fds=True):
+        _cleanup()
+        self._waitpid_lock = Lock()
+        self.stdin = self.stdout = self.stderr = None
+
+        if isinstance(args, basestring):
+            args = [args]
+        else:
+            args = list(args)
+        if shell:
+            args = ['/bin/sh', '-c'] + args
+        args = [_encode(arg) for arg in args]
+        if env is None:
+            env = os.environ
+        executable = _find_executable(args[0], env)
+        env_list = ['%s=%s' % (_encode(key), _encode(value))
+                    for key, value in env.iteritems()]
+
+        file_actions = ctypes.create_string_buffer(_FILE_ACTIONS_SIZE)
+        attr = ctypes.create_string_buffer(_ATTR_SIZE)
+        _check(_libc.posix_spawn_file_actions_init(file_actions))
+        _check(_libc.posix_spawnattr_init(attr))
+
+        child_fds = []
+        try:
+            streams = {}
+            for target_fd, value, mode in ((0, stdin, 'wb'),
+                                           (1, stdout, 'rb'),
+                                           (2, stderr, 'rb')):
+                if value is None:
+                    continue
+                if value == PIPE:
+                    read_fd, write_fd = _cloexec_pipe()
+                    if target_fd == 0:
+                        source_fd, parent_fd = read_fd, write_fd
+                    else:
+                        source_fd, parent_fd = write_fd, read_fd
+                    child_fds.append(source_fd)
+                    streams[target_fd] = os.fdopen(parent_fd, mode, bufsize)
+                elif isinstance(value, (int, long)):
+                    source_fd = value
+                else:
+                    source_fd = value.fileno()
+                _check(_libc.posix_spawn_file_actions_adddup2(
+                    file_actions, source_fd, target_fd))
+            self.stdin = streams.get(0)
+            self.stdout = streams.get(1)
+            self.stderr = streams.get(2)
+
+            if cwd:
+                _check(_libc.posix_spawn_file_actions_addchdir_np(
+                    file_actions, _encode(cwd)))
+            if close_fds:
+                _check(_libc.posix_spawn_file_actions_addclosefrom_np(
+                    file_actions, 3))
+
+            self._set_signal_attributes(attr)
+
+            pid = ctypes.c_int()
+            _check(_libc.posix_spawn(
+                ctypes.byref(pid), executable, file_actions, attr,
+                _to_c_array(args), _to_c_array(env_list)))
+            self.pid = pid.value
+        except Exception:
+            for stream in (self.stdin, self.stdout, self.stderr):
+                if stream:
+                    stream.close()
+            raise
+        finally:
+            for fd in child_fds:
+                os.close(fd)
+            _libc.posix_spawn_file_actions_destroy(file_actions)
+            _libc.posix_spawnattr_destroy(attr)
+
+    def _set_signal_attributes(self, attr):
+        empty_mask = ctypes.create_string_buffer(_SIGSET_SIZE)
+        _check(_libc.sigemptyset(empty_mask))
+        _check(_libc.posix_spawnattr_setsigmask(attr, empty_mask))
+
+        default_signals = ctypes.create_string_buffer(_SIGSET_SIZE)
+        _check(_libc.sigemptyset(default_signals))
+        for signum in _RESTORED_SIGNALS:
+            _check(_libc.sigaddset(default_signals, signum))
+        _check(_libc.posix_spawnattr_setsigdefault(attr, default_signals))
+
+        _check(_libc.posix_spawnattr_setflags(
+            attr, POSIX_SPAWN_SETSIGDEF | POSIX_SPAWN_SETSIGMASK))
+
+    def _handle_exitstatus(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+    def _waitpid(self, options):
+        try:
+            pid, status = os.waitpid(self.pid, options)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            # the process has been reaped by somebody else
+            pid, status = self.pid, 0
+        if pid == self.pid:
+            self._handle_exitstatus(status)
+
+    def poll(self):
+        if self.returncode is None and self._waitpid_lock.acquire(False):
+            try:
+                if self.returncode is None:
+                    self._waitpid(os.WNOHANG)
+            finally:
+                self._waitpid_lock.release()
+        return self.returncode
+
+    def wait(self):
+        with self._waitpid_lock:
+            while self.returncode is None:
+                try:
+                    self._waitpid(0)
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            os.kill(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def __del__(self):
+        if getattr(self, 'pid', None) is None:
+            return
+        if self.returncode is None and self.poll() is None:
+            # reap it later, same as `subprocess.Popen` does
+            with _active_lock:
+                _active.append(self)
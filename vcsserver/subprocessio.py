@@ -22,10 +22,25 @@ You should have received a copy of the GNU Lesser General Public License
 along with git_http_backend.py Project.
 If not, see <http://www.gnu.org/licenses/>.
 """
+import errno
+import fcntl
+import logging
 import os
+import select
 import subprocess32 as subprocess
+import tempfile
+import time
+import weakref
 from collections import deque
-from threading import Event, Thread
+from threading import Condition, Event, Lock, Thread
+
+from vcsserver import settings, spawn
+
+
+log = logging.getLogger(__name__)
+
+POLL_READ = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+POLL_WRITE = select.POLLOUT | select.POLLHUP | select.POLLERR
 
 
 class StreamFeeder(Thread):
@@ -283,6 +298,588 @@ class BufferedGenerator(object):
         return self.data[i]
 
 
+class IOLoop(Thread):
+    """
+    Single thread which multiplexes the pipes of all running subprocesses.
+
+    Instead of running one reader thread per stream and one feeder thread per
+    input, all pipes of all subprocesses which use the "eventloop" engine are
+    registered here and served by one `epoll` (or `poll`) loop.
+
+    Handlers are only touched from within the loop thread, other threads
+    schedule their changes through `call`. If the loop thread stops, all
+    handlers are aborted, so that no consumer keeps waiting for it.
+    """
+
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self):
+        super(IOLoop, self).__init__(name='subprocessio-ioloop')
+        self.daemon = True
+
+        self._handlers = {}
+        self._commands = deque()
+        self._clients = weakref.WeakSet()
+        self._clients_lock = Lock()
+        self._stopped = False
+        self._pid = os.getpid()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        _set_non_blocking(self._wakeup_read)
+        _set_non_blocking(self._wakeup_write)
+
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+        else:
+            self._poller = select.poll()
+        self._poller.register(self._wakeup_read, POLL_READ)
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the shared loop, starting it on first usage and again after
+        it stopped or the process forked.
+        """
+        loop = cls._instance
+        if loop is None or not loop._serves_process():
+            with cls._instance_lock:
+                if (cls._instance is None or
+                        not cls._instance._serves_process()):
+                    loop = cls()
+                    loop.start()
+                    cls._instance = loop
+                loop = cls._instance
+        return loop
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def _serves_process(self):
+        # A forked child inherits the loop, but not its thread
+        return not self._stopped and self._pid == os.getpid()
+
+    def call(self, func, *args):
+        """
+        Run `func` within the loop thread.
+        """
+        self._commands.append((func, args))
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError as e:
+            # the loop is already woken up if the pipe is full
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def add_handler(self, handler):
+        with self._clients_lock:
+            if self._stopped:
+                raise IOError('The subprocessio IO loop stopped')
+            self._clients.add(handler)
+        self.call(self._add_handler, handler)
+
+    def remove_handler(self, handler):
+        self.call(self._remove_handler, handler)
+
+    def _add_handler(self, handler):
+        self._handlers[handler.fd] = handler
+        self._poller.register(handler.fd, handler.events)
+
+    def _remove_handler(self, handler):
+        if self._handlers.get(handler.fd) is handler:
+            del self._handlers[handler.fd]
+            self._poller.unregister(handler.fd)
+
+    def _run_commands(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        while self._commands:
+            func, args = self._commands.popleft()
+            try:
+                func(*args)
+            except Exception:
+                log.exception('Error while running %s in the IO loop', func)
+
+    def run(self):
+        try:
+            self._serve()
+        except Exception:
+            log.exception('The subprocessio IO loop failed')
+        finally:
+            with self._clients_lock:
+                self._stopped = True
+                clients = list(self._clients)
+            for client in clients:
+                client.abort(IOError('The subprocessio IO loop stopped'))
+
+    def _serve(self):
+        while True:
+            try:
+                events = self._poller.poll(-1)
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wakeup_read:
+                    self._run_commands()
+                    continue
+                handler = self._handlers.get(fd)
+                if handler is None:
+                    continue
+                try:
+                    handler.handle_event(self, event)
+                except Exception:
+                    log.exception('Error while handling %s', handler)
+                    self._remove_handler(handler)
+                    handler.close_pipe()
+
+
+class PipeReader(object):
+    """
+    Reads a subprocess pipe from within the `IOLoop`.
+
+    The read chunks are buffered up to `buffer_size` bytes. Once the buffer
+    is full, the pipe is taken out of the loop until the consumer caught up,
+    so that the subprocess gets blocked instead of our memory growing. A
+    `bottomless` reader never pauses, it drops the oldest chunks instead.
+
+    Provides the same iterator interface as `BufferedGenerator`.
+    """
+
+    events = POLL_READ
+
+    def __init__(self, pipe, loop, buffer_size=65536, chunk_size=4096,
+                 starting_values=None, bottomless=False):
+        self.pipe = pipe
+        self.fd = pipe.fileno()
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.bottomless = bottomless
+        self._loop = loop
+
+        self.data = deque(starting_values or [])
+        self._size = sum(len(chunk) for chunk in self.data)
+        self._paused = False
+        self._error = None
+        self._condition = Condition()
+
+        self.data_added_event = Event()
+        if self.data:
+            self.data_added_event.set()
+        self.done_reading_event = Event()
+
+        _set_non_blocking(self.fd)
+        loop.add_handler(self)
+
+    def __repr__(self):
+        return '<PipeReader fd: %s, buffered: %s>' % (self.fd, self._size)
+
+    def handle_event(self, loop, event):
+        try:
+            chunk = os.read(self.fd, self.chunk_size)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+
+        if not chunk:
+            loop._remove_handler(self)
+            self.close_pipe()
+            return
+
+        with self._condition:
+            self.data.append(chunk)
+            self._size += len(chunk)
+            if self.bottomless:
+                while self._size > self.buffer_size and len(self.data) > 1:
+                    self._size -= len(self.data.popleft())
+            elif self._size >= self.buffer_size:
+                self._paused = True
+                loop._remove_handler(self)
+            self._condition.notify()
+        self.data_added_event.set()
+
+    def close_pipe(self):
+        try:
+            self.pipe.close()
+        except (IOError, OSError):
+            pass
+        with self._condition:
+            self.done_reading_event.set()
+            self._condition.notify()
+        self.data_added_event.set()
+
+    def abort(self, error):
+        """
+        Stops reading, the consumer gets `error` after the buffered chunks.
+        """
+        with self._condition:
+            if self.done_reading_event.is_set():
+                return
+            self._error = error
+        self.close_pipe()
+
+    def _resume(self):
+        if not self.done_reading_event.is_set():
+            self._loop._add_handler(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        with self._condition:
+            # The loop aborts all readers when it stops, so this cannot
+            # wait forever
+            while not self.data and not self.done_reading_event.is_set():
+                self._condition.wait()
+            if not self.data:
+                if self._error is not None:
+                    raise self._error
+                raise StopIteration
+            chunk = self.data.popleft()
+            self._size -= len(chunk)
+            resume = self._paused and self._size < self.buffer_size
+            if resume:
+                self._paused = False
+        if resume:
+            self._loop.call(self._resume)
+        return chunk
+
+    def stop(self):
+        self._loop.remove_handler(self)
+        self._loop.call(self.close_pipe)
+
+    def close(self):
+        self.stop()
+
+    @property
+    def done_reading(self):
+        return self.done_reading_event.is_set()
+
+    @property
+    def reading_paused(self):
+        return self._paused
+
+    @property
+    def length(self):
+        return len(self.data)
+
+
+class PipeWriter(object):
+    """
+    Writes the string `data` into a subprocess pipe from within the `IOLoop`.
+
+    Counterpart of `StreamFeeder` for input which is already in memory.
+    Reading other input could block the loop, it is fed by a `StreamFeeder`
+    instead. The pipe is closed once all data is written.
+    """
+
+    events = POLL_WRITE
+
+    def __init__(self, data, pipe, loop, chunk_size=4096):
+        self.pipe = pipe
+        self.fd = pipe.fileno()
+        self.chunk_size = chunk_size
+        self._data = bytes(data)
+        self._offset = 0
+
+        _set_non_blocking(self.fd)
+        loop.add_handler(self)
+
+    def __repr__(self):
+        return '<PipeWriter fd: %s>' % (self.fd, )
+
+    def handle_event(self, loop, event):
+        if not event & select.POLLOUT:
+            # the subprocess closed its end of the pipe
+            self._finish(loop)
+            return
+
+        try:
+            self._offset += os.write(
+                self.fd, buffer(self._data, self._offset, self.chunk_size))
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            if e.errno != errno.EPIPE:
+                raise
+            self._finish(loop)
+            return
+        if self._offset >= len(self._data):
+            self._finish(loop)
+
+    def abort(self, error):
+        self.close_pipe()
+
+    def _finish(self, loop):
+        loop._remove_handler(self)
+        self.close_pipe()
+
+    def close_pipe(self):
+        try:
+            self.pipe.close()
+        except (IOError, OSError):
+            pass
+
+
+class AdmissionTimeout(EnvironmentError):
+    """
+    Raised if no slot to start a process was granted within the timeout.
+    """
+
+
+class AdmissionTicket(object):
+    """
+    Slot granted by `AdmissionController`, released once the process is done.
+    """
+
+    granted = False
+    released = False
+
+    def __init__(self, controller, key):
+        self._controller = controller
+        self.key = key
+
+    def release(self):
+        self._controller._release(self)
+
+
+class AdmissionController(object):
+    """
+    Limits the number of concurrently running processes, globally and per
+    key, the key being the path of the repository.
+
+    Callers exceeding a limit wait in a FIFO queue. A free slot goes to the
+    oldest waiter whose key is below its limit, so that one busy repository
+    does not hold back the others.
+
+    The limits default to the values in `settings`, 0 means unlimited.
+    """
+
+    def __init__(self, max_processes=None, max_per_key=None, timeout=None):
+        self._max_processes = max_processes
+        self._max_per_key = max_per_key
+        self._timeout = timeout
+        self._condition = Condition()
+        self._queue = deque()
+        self._running = {}
+        self._running_total = 0
+        self._admitted = 0
+        self._timed_out = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    @property
+    def max_processes(self):
+        if self._max_processes is None:
+            return settings.SUBPROCESSIO_MAX_PROCESSES
+        return self._max_processes
+
+    @property
+    def max_per_key(self):
+        if self._max_per_key is None:
+            return settings.SUBPROCESSIO_MAX_PROCESSES_PER_REPO
+        return self._max_per_key
+
+    @property
+    def timeout(self):
+        if self._timeout is None:
+            return settings.SUBPROCESSIO_QUEUE_TIMEOUT
+        return self._timeout
+
+    def acquire(self, key, timeout=None):
+        """
+        Waits for a slot for `key` and returns its `AdmissionTicket`.
+
+        Raises `AdmissionTimeout` if no slot was granted within `timeout`
+        seconds, a timeout of 0 waits forever.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        ticket = AdmissionTicket(self, key)
+        start = time.time()
+        with self._condition:
+            if self._has_capacity(key):
+                self._grant(ticket)
+            else:
+                self._queue.append(ticket)
+                deadline = start + timeout if timeout else None
+                while not ticket.granted:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self._queue.remove(ticket)
+                            self._timed_out += 1
+                            raise AdmissionTimeout(
+                                'No free slot to start a process for %s '
+                                'within %s seconds' % (key, timeout))
+                    self._condition.wait(remaining)
+
+            wait_time = time.time() - start
+            self._admitted += 1
+            self._wait_time_total += wait_time
+            self._wait_time_max = max(self._wait_time_max, wait_time)
+        if wait_time > 1:
+            log.debug('waited %.2fs for a process slot for %s', wait_time, key)
+        return ticket
+
+    def stats(self):
+        """
+        Returns the current queue depth, running processes and wait times.
+        """
+        with self._condition:
+            queued_per_key = {}
+            for ticket in self._queue:
+                queued_per_key[ticket.key] = (
+                    queued_per_key.get(ticket.key, 0) + 1)
+            return {
+                'running': self._running_total,
+                'queued': len(self._queue),
+                'running_per_repo': dict(self._running),
+                'queued_per_repo': queued_per_key,
+                'admitted': self._admitted,
+                'timed_out': self._timed_out,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_max': self._wait_time_max,
+            }
+
+    def _has_capacity(self, key):
+        max_processes = self.max_processes
+        if max_processes and self._running_total >= max_processes:
+            return False
+        max_per_key = self.max_per_key
+        if max_per_key and self._running.get(key, 0) >= max_per_key:
+            return False
+        return True
+
+    def _grant(self, ticket):
+        ticket.granted = True
+        self._running_total += 1
+        self._running[ticket.key] = self._running.get(ticket.key, 0) + 1
+
+    def _release(self, ticket):
+        with self._condition:
+            if not ticket.granted or ticket.released:
+                return
+            ticket.released = True
+            self._running_total -= 1
+            self._running[ticket.key] -= 1
+            if not self._running[ticket.key]:
+                del self._running[ticket.key]
+
+            granted = False
+            for waiting in list(self._queue):
+                if self._has_capacity(waiting.key):
+                    self._queue.remove(waiting)
+                    self._grant(waiting)
+                    granted = True
+            if granted:
+                self._condition.notify_all()
+
+
+# Shared by all callers which pass an `admission_key`
+admission = AdmissionController()
+
+
+class SubprocessIORelay(object):
+    """
+    File-like access to the stdout pipe of a subprocess.
+
+    This is the lightweight alternative to `SubprocessIOChunker` for output
+    which is passed on unmodified. The object is meant to be handed to the
+    server's `wsgi.file_wrapper`, which then reads the pipe directly in large
+    blocks, or uses kernel level transfers if it supports them for pipes.
+    There are no reader threads, no chunk queue and no error detection,
+    stderr is collected in a temporary file.
+
+    The subprocess is reaped once the server calls `close`.
+    """
+
+    _close_input_fd = None
+    _admission_ticket = None
+    _closed = False
+    _eof = False
+
+    def __init__(self, cmd, inputstream=None, chunk_size=None, engine=None,
+                 admission_key=None, **kwargs):
+        chunk_size = chunk_size or settings.SUBPROCESSIO_CHUNK_SIZE
+        engine = engine or settings.SUBPROCESSIO_ENGINE
+
+        if admission_key is not None:
+            self._admission_ticket = admission.acquire(admission_key)
+
+        # Only input in memory is written by the loop, reading other input
+        # may block
+        in_loop = engine == 'eventloop' and isinstance(
+            inputstream, (str, bytearray))
+        stdin = None
+        if inputstream and in_loop:
+            stdin = subprocess.PIPE
+        elif inputstream:
+            input_streamer = StreamFeeder(inputstream)
+            input_streamer.start()
+            stdin = self._close_input_fd = input_streamer.output
+
+        kwargs.setdefault('shell', True)
+        self.error = tempfile.TemporaryFile()
+        try:
+            self.process = spawn.popen(
+                cmd, bufsize=-1, stdin=stdin, stdout=subprocess.PIPE,
+                stderr=self.error, **kwargs)
+        except Exception:
+            self._closed = True
+            if self._admission_ticket:
+                self._admission_ticket.release()
+            raise
+        self.output = self.process.stdout
+
+        if inputstream and in_loop:
+            PipeWriter(
+                inputstream, self.process.stdin, IOLoop.instance(), chunk_size)
+            self.process.stdin = None
+
+    def read(self, size=-1):
+        data = self.output.read(size)
+        if not data:
+            self._eof = True
+        return data
+
+    def fileno(self):
+        return self.output.fileno()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if not self._eof and self.process.poll() is None:
+            # the client went away before all output was read
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+        self.output.close()
+        self.process.wait()
+        if self._close_input_fd:
+            os.close(self._close_input_fd)
+        self.error.close()
+        if self._admission_ticket:
+            self._admission_ticket.release()
+
+    def __del__(self):
+        self.close()
+
+
+def _set_non_blocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
 class SubprocessIOChunker(object):
     """
     Processor class wrapping handling of subprocess IO.
@@ -350,31 +947,36 @@ class SubprocessIOChunker(object):
     # object, so that it is closed automatically once it is consumed or
     # something similar.
     _close_input_fd = None
+    _admission_ticket = None
 
     _closed = False
 
-    def __init__(self, cmd, inputstream=None, buffer_size=65536,
-                 chunk_size=4096, starting_values=[], fail_on_stderr=True,
-                 fail_on_return_code=True, **kwargs):
+    def __init__(self, cmd, inputstream=None, buffer_size=None,
+                 chunk_size=None, starting_values=[], fail_on_stderr=True,
+                 fail_on_return_code=True, engine=None, admission_key=None,
+                 **kwargs):
         """
         Initializes SubprocessIOChunker
 
         :param cmd: A Subprocess.Popen style "cmd". Can be string or array of strings
         :param inputstream: (Default: None) A file-like, string, or file pointer.
-        :param buffer_size: (Default: 65536) A size of total buffer per stream in bytes.
-        :param chunk_size: (Default: 4096) A max size of a chunk. Actual chunk may be smaller.
+        :param buffer_size: (Default: `settings.SUBPROCESSIO_BUFFER_SIZE`) A size of total buffer per stream in bytes.
+        :param chunk_size: (Default: `settings.SUBPROCESSIO_CHUNK_SIZE`) A max size of a chunk. Actual chunk may be smaller.
         :param starting_values: (Default: []) An array of strings to put in front of output que.
         :param fail_on_stderr: (Default: True) Whether to raise an exception in
                                case something is written to stderr.
         :param fail_on_return_code: (Default: True) Whether to raise an
                                     exception if the return code is not 0.
+        :param engine: (Default: `settings.SUBPROCESSIO_ENGINE`) Either
+                       "thread" to serve every stream by its own thread, or
+                       "eventloop" to serve all streams by the shared `IOLoop`.
+        :param admission_key: (Default: None) If set, the process is only
+                              started once `admission` grants a slot for this
+                              key, the slot is released on `close`.
         """
-
-        if inputstream:
-            input_streamer = StreamFeeder(inputstream)
-            input_streamer.start()
-            inputstream = input_streamer.output
-            self._close_input_fd = inputstream
+        buffer_size = buffer_size or settings.SUBPROCESSIO_BUFFER_SIZE
+        chunk_size = chunk_size or settings.SUBPROCESSIO_CHUNK_SIZE
+        engine = engine or settings.SUBPROCESSIO_ENGINE
 
         self._fail_on_stderr = fail_on_stderr
         self._fail_on_return_code = fail_on_return_code
@@ -382,15 +984,24 @@ class SubprocessIOChunker(object):
         _shell = kwargs.get('shell', True)
         kwargs['shell'] = _shell
 
-        _p = subprocess.Popen(cmd, bufsize=-1,
-                              stdin=inputstream,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              **kwargs)
+        if engine not in ('eventloop', 'thread'):
+            raise ValueError('Unknown subprocessio engine "%s"' % (engine, ))
 
-        bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size,
-                                   starting_values)
-        bg_err = BufferedGenerator(_p.stderr, 16000, 1, bottomless=True)
+        if admission_key is not None:
+            self._admission_ticket = admission.acquire(admission_key)
+
+        try:
+            if engine == 'eventloop':
+                _p, bg_out, bg_err = self._start_eventloop(
+                    cmd, inputstream, buffer_size, chunk_size,
+                    starting_values, kwargs)
+            else:
+                _p, bg_out, bg_err = self._start_threaded(
+                    cmd, inputstream, buffer_size, chunk_size,
+                    starting_values, kwargs)
+        except Exception:
+            self._release_admission()
+            raise
 
         while not bg_out.done_reading and not bg_out.reading_paused and not bg_err.length:
             # doing this until we reach either end of file, or end of buffer.
@@ -409,6 +1020,7 @@ class SubprocessIOChunker(object):
                 _p.terminate()
             except Exception:
                 pass
+            self._release_admission()
             bg_out.stop()
             bg_err.stop()
             if fail_on_stderr:
@@ -425,6 +1037,55 @@ class SubprocessIOChunker(object):
         self.output = bg_out
         self.error = bg_err
 
+    def _start_threaded(self, cmd, inputstream, buffer_size, chunk_size,
+                        starting_values, kwargs):
+        if inputstream:
+            input_streamer = StreamFeeder(inputstream)
+            input_streamer.start()
+            inputstream = input_streamer.output
+            self._close_input_fd = inputstream
+
+        _p = spawn.popen(cmd, bufsize=-1,
+                         stdin=inputstream,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         **kwargs)
+
+        bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size,
+                                   starting_values)
+        bg_err = BufferedGenerator(_p.stderr, 16000, 1, bottomless=True)
+        return _p, bg_out, bg_err
+
+    def _start_eventloop(self, cmd, inputstream, buffer_size, chunk_size,
+                         starting_values, kwargs):
+        loop = IOLoop.instance()
+        stdin = None
+        if isinstance(inputstream, (str, bytearray)):
+            stdin = subprocess.PIPE
+        elif inputstream:
+            # Reading the input may block, so it is not done by the loop
+            input_streamer = StreamFeeder(inputstream)
+            input_streamer.start()
+            stdin = self._close_input_fd = input_streamer.output
+
+        _p = spawn.popen(cmd, bufsize=-1,
+                         stdin=stdin,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         **kwargs)
+
+        # The pipes are owned by the loop from now on, `Popen` must not
+        # touch them anymore.
+        stdin, stdout, stderr = _p.stdin, _p.stdout, _p.stderr
+        _p.stdin = _p.stdout = _p.stderr = None
+
+        if stdin is not None:
+            PipeWriter(inputstream, stdin, loop, chunk_size)
+        bg_out = PipeReader(stdout, loop, buffer_size, chunk_size,
+                            starting_values)
+        bg_err = PipeReader(stderr, loop, 16000, chunk_size, bottomless=True)
+        return _p, bg_out, bg_err
+
     def __iter__(self):
         return self
 
@@ -471,6 +1132,11 @@ class SubprocessIOChunker(object):
             self.error.close()
         except:
             pass
+        self._release_admission()
+
+    def _release_admission(self):
+        if self._admission_ticket:
+            self._admission_ticket.release()
 
     def __del__(self):
         self.close()
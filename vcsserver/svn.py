@@ -17,12 +17,28 @@
 
 from __future__ import absolute_import
 
+from array import array
+from bisect import bisect_right
 from urllib2 import URLError
+import atexit
+import errno
+import fcntl
+import json
 import logging
+import os
 import posixpath as vcspath
+import Queue
+import re
+import signal
 import StringIO
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import urllib
+import uuid
+import weakref
 
 import svn.client
 import svn.core
@@ -30,8 +46,9 @@ import svn.delta
 import svn.diff
 import svn.fs
 import svn.repos
+from repoze.lru import LRUCache
 
-from vcsserver import svn_diff
+from vcsserver import settings, svn_diff
 from vcsserver.base import RepoFactory
 
 
@@ -48,9 +65,58 @@ svn_compatible_versions = set([
 ])
 
 
+_fs_cache_configured = False
+
+# Read once, os.umask() can only be queried by changing it
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def configure_fs_cache():
+    """
+    Applies the size of the in-process FSFS cache from `settings`.
+
+    Subversion creates the cache when the first repository is opened, so
+    only the first call has an effect.
+    """
+    global _fs_cache_configured
+    if _fs_cache_configured:
+        return
+    _fs_cache_configured = True
+    config = svn.core.svn_cache_config_get()
+    if settings.SVN_FS_CACHE_SIZE is not None:
+        config.cache_size = settings.SVN_FS_CACHE_SIZE * 1024 * 1024
+    if settings.SVN_FS_CACHE_FILE_HANDLES is not None:
+        config.file_handle_count = settings.SVN_FS_CACHE_FILE_HANDLES
+    svn.core.svn_cache_config_set(config)
+
+
+def fs_cache_stats():
+    config = svn.core.svn_cache_config_get()
+    return {
+        'cache_size': config.cache_size,
+        'file_handle_count': config.file_handle_count,
+        'single_threaded': bool(config.single_threaded),
+    }
+
+
+def _fs_config():
+    """
+    Returns the FSFS options which select the data kept in the cache.
+    """
+    def flag(value):
+        return '1' if value else '0'
+    return {
+        'fsfs-cache-deltas': flag(settings.SVN_FS_CACHE_DELTAS),
+        'fsfs-cache-fulltexts': flag(settings.SVN_FS_CACHE_FULLTEXTS),
+        'fsfs-cache-revprops': flag(settings.SVN_FS_CACHE_REVPROPS),
+    }
+
+
 class SubversionFactory(RepoFactory):
 
     def _create_repo(self, wire, create, compatible_version):
+        configure_fs_cache()
         path = svn.core.svn_path_canonicalize(wire['path'])
         if create:
             fs_config = {}
@@ -63,7 +129,7 @@ class SubversionFactory(RepoFactory):
                 fs_config[compatible_version] = '1'
             repo = svn.repos.create(path, "", "", None, fs_config)
         else:
-            repo = svn.repos.open(path)
+            repo = svn.repos.open2(path, _fs_config())
         return repo
 
     def repo(self, wire, create=False, compatible_version=None):
@@ -80,13 +146,37 @@ NODE_TYPE_MAPPING = {
 }
 
 
+class _LogStreamClosed(Exception):
+    """
+    Stops reading the log of `SvnRemote.log_stream` once it got closed.
+    """
+
+
 class SvnRemote(object):
 
+    # Number of log entries sent at a time by `log_stream`
+    LOG_CHUNK_SIZE = 200
+
+    LOG_ACTIONS = {
+        'A': 'added',
+        'M': 'changed',
+        'R': 'changed',
+        'D': 'removed',
+    }
+
     def __init__(self, factory, hg_factory=None):
         self._factory = factory
         # TODO: Remove once we do not use internal Mercurial objects anymore
         # for subversion
         self._hg_factory = hg_factory
+        # Changes of committed revisions never change
+        self._changes_cache = LRUCache(5000)
+        self._timestamp_indexes = LRUCache(50)
+        # Revision roots are immutable as well, but the objects of the
+        # Subversion bindings must not be shared between threads
+        self._local = threading.local()
+        self._revision_root_hits = 0
+        self._revision_root_misses = 0
 
     def check_url(self, url, config_items):
         # this can throw exception if not installed, but we detect this
@@ -122,20 +212,36 @@ class SvnRemote(object):
     def lookup_interval(self, wire, start_ts, end_ts):
         repo = self._factory.repo(wire)
         fsobj = svn.repos.fs(repo)
+        index = self._timestamp_index(wire, fsobj)
         start_rev = None
         end_rev = None
         if start_ts:
-            start_ts_svn = apr_time_t(start_ts)
-            start_rev = svn.repos.dated_revision(repo, start_ts_svn) + 1
+            start_rev = index.dated_revision(fsobj, start_ts) + 1
         else:
             start_rev = 1
         if end_ts:
-            end_ts_svn = apr_time_t(end_ts)
-            end_rev = svn.repos.dated_revision(repo, end_ts_svn)
+            end_rev = index.dated_revision(fsobj, end_ts)
         else:
             end_rev = svn.fs.youngest_rev(fsobj)
         return start_rev, end_rev
 
+    def lookup_date(self, wire, timestamp):
+        """
+        Returns the youngest revision committed at or before `timestamp`.
+        """
+        repo = self._factory.repo(wire)
+        fsobj = svn.repos.fs(repo)
+        return self._timestamp_index(wire, fsobj).dated_revision(
+            fsobj, timestamp)
+
+    def _timestamp_index(self, wire, fsobj):
+        key = (wire['path'], svn.fs.get_uuid(fsobj))
+        index = self._timestamp_indexes.get(key)
+        if index is None:
+            index = TimestampIndex(*key)
+            self._timestamp_indexes.put(key, index)
+        return index
+
     def revision_properties(self, wire, revision):
         repo = self._factory.repo(wire)
         fs_ptr = svn.repos.fs(repo)
@@ -183,11 +289,256 @@ class SvnRemote(object):
         }
         return changes
 
-    def node_history(self, wire, path, revision, limit):
-        cross_copies = False
+    def _revision_root(self, wire, revision=None):
+        """
+        Returns the root of `revision`, HEAD by default, and its revision.
+
+        Roots are kept per thread and repository object in an LRU cache, so
+        that browsing a revision does not construct the same root for every
+        node. The roots of a repository are dropped together with it, once
+        the factory does not cache it anymore.
+        """
         repo = self._factory.repo(wire)
         fsobj = svn.repos.fs(repo)
+        if revision is None:
+            revision = svn.fs.youngest_rev(fsobj)
+        if not settings.SVN_REVISION_ROOT_CACHE_SIZE:
+            return svn.fs.revision_root(fsobj, revision), revision
+
+        repo_caches = getattr(self._local, 'revision_roots', None)
+        if repo_caches is None:
+            repo_caches = self._local.revision_roots = (
+                weakref.WeakKeyDictionary())
+        cache = repo_caches.get(repo)
+        if cache is None:
+            cache = repo_caches[repo] = LRUCache(
+                settings.SVN_REVISION_ROOT_CACHE_SIZE)
+        root = cache.get(revision)
+        if root is None:
+            self._revision_root_misses += 1
+            root = svn.fs.revision_root(fsobj, revision)
+            cache.put(revision, root)
+        else:
+            self._revision_root_hits += 1
+        return root, revision
+
+    def cache_stats(self, wire):
+        """
+        Returns the configuration of the FSFS cache and the counters of the
+        revision root cache.
+        """
+        stats = fs_cache_stats()
+        stats['fs_config'] = _fs_config()
+        stats['revision_roots'] = {
+            'hits': self._revision_root_hits,
+            'misses': self._revision_root_misses,
+            'size': settings.SVN_REVISION_ROOT_CACHE_SIZE,
+        }
+        return stats
+
+    def revision_changes_range(self, wire, start, end):
+        """
+        Returns the changes of the revisions `start` up to `end` like
+        `revision_changes`, each with an additional key `revision`.
+
+        The changes are read from the changed paths which the filesystem
+        records for every revision, instead of replaying the revisions.
+        """
+        repo = self._factory.repo(wire)
+        fsobj = svn.repos.fs(repo)
+        end = min(end, svn.fs.youngest_rev(fsobj))
+        uuid = svn.fs.get_uuid(fsobj)
+
+        result = []
+        for revision in xrange(max(start, 0), end + 1):
+            key = (uuid, wire['path'], revision)
+            changes = self._changes_cache.get(key)
+            if changes is None:
+                changes = self._revision_changes(fsobj, revision)
+                self._changes_cache.put(key, changes)
+            result.append(dict(changes, revision=revision))
+        return result
+
+    def _revision_changes(self, fsobj, revision):
         rev_root = svn.fs.revision_root(fsobj, revision)
+        added = []
+        changed = []
+        removed = []
+
+        for path, change in svn.fs.paths_changed2(rev_root).iteritems():
+            deleted = change.change_kind == svn.fs.path_change_delete
+            kind = self._changed_node_kind(
+                fsobj, revision, path, change.node_kind, deleted)
+            # TODO: Decide what to do with directory nodes. Subversion can add
+            # empty directories.
+            if kind == svn.core.svn_node_dir:
+                continue
+
+            path = path.lstrip('/')
+            if change.change_kind == svn.fs.path_change_add:
+                added.append(path)
+            elif change.change_kind in (
+                    svn.fs.path_change_modify, svn.fs.path_change_replace):
+                changed.append(path)
+            elif change.change_kind == svn.fs.path_change_delete:
+                removed.append(path)
+            else:
+                raise NotImplementedError(
+                    "Action %s not supported on path %s" % (
+                        change.change_kind, path))
+
+        return {
+            'added': sorted(added),
+            'changed': sorted(changed),
+            'removed': sorted(removed),
+        }
+
+    def _changed_node_kind(self, fsobj, revision, path, kind, deleted):
+        if kind != svn.core.svn_node_unknown:
+            return kind
+        # Older repositories do not record the kind of changed nodes
+        if deleted:
+            revision -= 1
+        return svn.fs.check_path(svn.fs.revision_root(fsobj, revision), path)
+
+    def log(self, wire, path, start_rev=None, end_rev=0, limit=0,
+            discover_changed_paths=False):
+        """
+        Returns the log entries of `path` from `start_rev` to `end_rev`,
+        newest first if `start_rev` is the higher one.
+
+        Every entry has the keys `revision`, `author`, `date` and `message`,
+        and `changes` in the format of `revision_changes` if
+        `discover_changed_paths` is set. `start_rev` defaults to HEAD.
+        """
+        repo = self._factory.repo(wire)
+        if start_rev is None:
+            start_rev = svn.fs.youngest_rev(svn.repos.fs(repo))
+        return self._get_logs(
+            repo, path, start_rev, end_rev, limit, discover_changed_paths)
+
+    def log_stream(self, wire, path, start_rev=None, end_rev=0, limit=0,
+                   discover_changed_paths=False, chunk_size=None):
+        """
+        Yields the entries of `log` as lists of up to `chunk_size` entries.
+
+        The history is read by a single `get_logs4` call in a helper thread,
+        so it follows copies like `log` does, and each list is yielded as
+        soon as it is complete.
+        """
+        chunk_size = chunk_size or self.LOG_CHUNK_SIZE
+        repo = self._factory.repo(wire)
+        if start_rev is None:
+            start_rev = svn.fs.youngest_rev(svn.repos.fs(repo))
+
+        chunks = Queue.Queue(maxsize=2)
+        closed = threading.Event()
+        pending = []
+
+        def put(item):
+            while not closed.is_set():
+                try:
+                    chunks.put(item, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+            raise _LogStreamClosed()
+
+        def on_entry(entry):
+            pending.append(entry)
+            if len(pending) >= chunk_size:
+                put(('entries', pending[:]))
+                del pending[:]
+
+        def read():
+            try:
+                self._read_logs(
+                    repo, path, start_rev, end_rev, limit,
+                    discover_changed_paths, on_entry)
+                if pending:
+                    put(('entries', pending[:]))
+                put(('done', None))
+            except _LogStreamClosed:
+                pass
+            except Exception:
+                if not closed.is_set():
+                    put(('error', sys.exc_info()))
+
+        reader = threading.Thread(target=read, name='svn-log-stream')
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                try:
+                    kind, value = chunks.get(timeout=1)
+                except Queue.Empty:
+                    if not reader.is_alive():
+                        raise Exception('Reading the log of %s stopped' % (
+                            path, ))
+                    continue
+                if kind == 'done':
+                    return
+                if kind == 'error':
+                    raise value[0], value[1], value[2]
+                yield value
+        finally:
+            closed.set()
+
+    def _get_logs(self, repo, path, start_rev, end_rev, limit,
+                  discover_changed_paths):
+        entries = []
+        self._read_logs(repo, path, start_rev, end_rev, limit,
+                        discover_changed_paths, entries.append)
+        return entries
+
+    def _read_logs(self, repo, path, start_rev, end_rev, limit,
+                   discover_changed_paths, callback):
+        fsobj = svn.repos.fs(repo)
+
+        def receiver(log_entry, pool):
+            revprops = log_entry.revprops or {}
+            entry = {
+                'revision': log_entry.revision,
+                'author': revprops.get(svn.core.SVN_PROP_REVISION_AUTHOR),
+                'date': revprops.get(svn.core.SVN_PROP_REVISION_DATE),
+                'message': revprops.get(svn.core.SVN_PROP_REVISION_LOG),
+            }
+            if discover_changed_paths:
+                entry['changes'] = self._log_entry_changes(
+                    fsobj, log_entry.revision, log_entry.changed_paths2 or {})
+            callback(entry)
+
+        svn.repos.get_logs4(
+            repo, ['/' + (path or '').lstrip('/')], start_rev, end_rev, limit,
+            discover_changed_paths,
+            False,  # strict_node_history
+            False,  # include_merged_revisions
+            [svn.core.SVN_PROP_REVISION_AUTHOR,
+             svn.core.SVN_PROP_REVISION_DATE,
+             svn.core.SVN_PROP_REVISION_LOG],
+            None,  # authz_read_func
+            receiver)
+
+    def _log_entry_changes(self, fsobj, revision, changed_paths):
+        changes = {'added': [], 'changed': [], 'removed': []}
+        for path, change in changed_paths.iteritems():
+            kind = self._changed_node_kind(
+                fsobj, revision, path, change.node_kind, change.action == 'D')
+            if kind == svn.core.svn_node_dir:
+                continue
+            key = self.LOG_ACTIONS.get(change.action)
+            if key is None:
+                raise NotImplementedError(
+                    "Action %s not supported on path %s" % (
+                        change.action, path))
+            changes[key].append(path.lstrip('/'))
+        for paths in changes.itervalues():
+            paths.sort()
+        return changes
+
+    def node_history(self, wire, path, revision, limit):
+        cross_copies = False
+        rev_root, __ = self._revision_root(wire, revision)
 
         history_revisions = []
         history = svn.fs.node_history(rev_root, path)
@@ -201,9 +552,7 @@ class SvnRemote(object):
         return history_revisions
 
     def node_properties(self, wire, path, revision):
-        repo = self._factory.repo(wire)
-        fsobj = svn.repos.fs(repo)
-        rev_root = svn.fs.revision_root(fsobj, revision)
+        rev_root, __ = self._revision_root(wire, revision)
         return svn.fs.node_proplist(rev_root, path)
 
     def file_annotate(self, wire, path, revision):
@@ -234,20 +583,12 @@ class SvnRemote(object):
         return annotations
 
     def get_node_type(self, wire, path, rev=None):
-        repo = self._factory.repo(wire)
-        fs_ptr = svn.repos.fs(repo)
-        if rev is None:
-            rev = svn.fs.youngest_rev(fs_ptr)
-        root = svn.fs.revision_root(fs_ptr, rev)
+        root, __ = self._revision_root(wire, rev)
         node = svn.fs.check_path(root, path)
         return NODE_TYPE_MAPPING.get(node, None)
 
     def get_nodes(self, wire, path, revision=None):
-        repo = self._factory.repo(wire)
-        fsobj = svn.repos.fs(repo)
-        if revision is None:
-            revision = svn.fs.youngest_rev(fsobj)
-        root = svn.fs.revision_root(fsobj, revision)
+        root, __ = self._revision_root(wire, revision)
         entries = svn.fs.dir_entries(root, path)
         result = []
         for entry_path, entry_info in entries.iteritems():
@@ -255,21 +596,53 @@ class SvnRemote(object):
                 (entry_path, NODE_TYPE_MAPPING.get(entry_info.kind, None)))
         return result
 
+    def get_nodes_recursive(self, wire, path, revision=None, depth=1,
+                            with_size=False, with_last_changed=False):
+        """
+        Returns the nodes below `path` down to `depth` levels, all levels if
+        `depth` is `None`.
+
+        Every node is a dict with the keys `path`, relative to `path`, and
+        `kind`. `size` is added for files if `with_size` is set and
+        `last_changed`, the revision which changed the node last, if
+        `with_last_changed` is set.
+        """
+        root, __ = self._revision_root(wire, revision)
+        result = []
+        pending = [('', 1)]
+        while pending:
+            rel_dir, level = pending.pop()
+            abs_dir = vcspath.join(path, rel_dir)
+            entries = svn.fs.dir_entries(root, abs_dir)
+            for name in sorted(entries, reverse=True):
+                kind = entries[name].kind
+                rel_path = vcspath.join(rel_dir, name)
+                abs_path = vcspath.join(abs_dir, name)
+                node = {
+                    'path': rel_path,
+                    'kind': NODE_TYPE_MAPPING.get(kind, None),
+                }
+                if with_size:
+                    node['size'] = (
+                        svn.fs.file_length(root, abs_path)
+                        if kind == svn.core.svn_node_file else None)
+                if with_last_changed:
+                    node['last_changed'] = svn.fs.node_created_rev(
+                        root, abs_path)
+                result.append(node)
+                if kind == svn.core.svn_node_dir and (
+                        depth is None or level < depth):
+                    pending.append((rel_path, level + 1))
+        result.sort(key=lambda node: node['path'])
+        return result
+
     def get_file_content(self, wire, path, rev=None):
-        repo = self._factory.repo(wire)
-        fsobj = svn.repos.fs(repo)
-        if rev is None:
-            rev = svn.fs.youngest_revision(fsobj)
-        root = svn.fs.revision_root(fsobj, rev)
+        root, __ = self._revision_root(wire, rev)
         content = svn.core.Stream(svn.fs.file_contents(root, path))
         return content.read()
 
     def get_file_size(self, wire, path, revision=None):
-        repo = self._factory.repo(wire)
-        fsobj = svn.repos.fs(repo)
-        if revision is None:
-            revision = svn.fs.youngest_revision(fsobj)
-        root = svn.fs.revision_root(fsobj, revision)
+        root, __ = self._revision_root(wire, revision)
         size = svn.fs.file_length(root, path)
         return size
 
@@ -300,9 +673,7 @@ class SvnRemote(object):
             errors = rdump.stderr.read()
             log.error('svnrdump dump failed: statuscode %s: message: %s',
                       rdump.returncode, errors)
-            reason = 'UNKNOWN'
-            if 'svnrdump: E230001:' in errors:
-                reason = 'INVALID_CERTIFICATE'
+            reason = _dump_failure_reason(errors)
             raise Exception(
                 'Failed to dump the remote repository from %s.' % src_url,
                 reason)
@@ -311,7 +682,65 @@ class SvnRemote(object):
                 'Failed to load the dump of remote repository from %s.' %
                 (src_url, ))
 
+    def start_import(self, wire, src_url):
+        """
+        Starts to import the remote repository `src_url` in the background
+        and returns the id of the import job.
+
+        The import continues after the youngest revision of the local
+        repository, so a cancelled or failed import can be resumed and an
+        imported repository can be synchronized by starting it again. While
+        an import of the repository is running in any process, its id is
+        returned.
+        """
+        repo_path = wire['path']
+        if not self.is_path_valid_repository(wire, repo_path):
+            raise Exception(
+                "Path %s is not a valid Subversion repository." % repo_path)
+
+        lock_file = _lock_import(repo_path)
+        if lock_file is None:
+            running = ImportJob.read_state(repo_path)
+            if running is None or running['state'] not in ImportJob.ACTIVE:
+                raise Exception(
+                    'An import into %s is already running.' % repo_path)
+            return running['id']
+
+        try:
+            repo = self._factory.repo(wire)
+            start_rev = svn.fs.youngest_rev(svn.repos.fs(repo)) + 1
+            job = ImportJob(repo_path, src_url, start_rev, lock_file)
+            job.start()
+        except Exception:
+            lock_file.close()
+            raise
+        return job.id
+
+    def import_status(self, wire, job_id):
+        """
+        Returns the state and progress of the import job `job_id`.
+        """
+        return ImportJob.job_status(wire['path'], job_id)
+
+    def cancel_import(self, wire, job_id):
+        return ImportJob.cancel_job(wire['path'], job_id)
+
     def commit(self, wire, message, author, timestamp, updated, removed):
+        for node in updated:
+            assert isinstance(node['content'], str)
+        nodes = ((node, [node['content']]) for node in updated)
+        return self.commit_nodes(
+            wire, message, author, timestamp, nodes, removed)
+
+    def commit_nodes(self, wire, message, author, timestamp, nodes, removed):
+        """
+        Commits like `commit`, but `nodes` is an iterable of `(node, chunks)`
+        pairs, where `chunks` yields the content of the node.
+
+        The content is written to the transaction chunk by chunk, so it
+        never has to be in memory as a whole. Missing parent directories
+        are created once for the whole commit.
+        """
         assert isinstance(message, str)
         assert isinstance(author, str)
 
@@ -322,12 +751,16 @@ class SvnRemote(object):
         txn = svn.repos.fs_begin_txn_for_commit(repo, rev, author, message)
         txn_root = svn.fs.txn_root(txn)
 
-        for node in updated:
-            TxnNodeProcessor(node, txn_root).update()
-        for node in removed:
-            TxnNodeProcessor(node, txn_root).remove()
-
-        commit_id = svn.repos.fs_commit_txn(repo, txn)
+        known_dirs = set()
+        try:
+            for node, chunks in nodes:
+                TxnNodeProcessor(node, txn_root, known_dirs).update(chunks)
+            for node in removed:
+                TxnNodeProcessor(node, txn_root, known_dirs).remove()
+            commit_id = svn.repos.fs_commit_txn(repo, txn)
+        except Exception:
+            svn.fs.abort_txn(txn)
+            raise
 
         if timestamp:
             apr_time = apr_time_t(timestamp)
@@ -345,6 +778,450 @@ class SvnRemote(object):
             repo, rev1, path1, rev2, path2, ignore_whitespace, context)
         return diff_creator.generate_diff()
 
+    def diff_stream(self, wire, rev1, rev2, path1=None, path2=None,
+                    ignore_whitespace=False, context=3):
+        """
+        Yields the diff of `diff` in chunks, one per changed node.
+        """
+        wire.update(cache=False)
+        repo = self._factory.repo(wire)
+        diff_creator = SvnDiffer(
+            repo, rev1, path1, rev2, path2, ignore_whitespace, context)
+        return diff_creator.generate_diff_stream()
+
+
+def _write_file(path, data):
+    # Other processes read the file, so it is only replaced as a whole
+    tmp_fd, tmp_path = tempfile.mkstemp(
+        prefix='.%s-' % os.path.basename(path), dir=os.path.dirname(path))
+    try:
+        with os.fdopen(tmp_fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0666 & ~_umask)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class TimestampIndex(object):
+    """
+    The `svn:date` of every revision of a repository, for binary searches
+    in memory instead of reading revision properties from disk.
+
+    New revisions are added when the index is used. The index is stored in
+    the `db` directory of the repository, so that it is only built once.
+    Later changes to the `svn:date` of a revision are not picked up.
+
+    The date of the youngest revision is always read from the repository,
+    because it may still be changed after the commit, e.g. by `commit_nodes`
+    or `svnadmin load`.
+    """
+
+    FILE_NAME = 'rc-revision-timestamps'
+
+    def __init__(self, repo_path, uuid):
+        self.path = os.path.join(repo_path, 'db', self.FILE_NAME)
+        self.uuid = uuid
+        self.timestamps = array('d')
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def dated_revision(self, fsobj, timestamp):
+        """
+        Returns the youngest revision at or before `timestamp`, like
+        `svn.repos.dated_revision`.
+        """
+        with self._lock:
+            youngest = self._update(fsobj)
+            previous = self.timestamps[-1] if self.timestamps else 0.0
+            if timestamp >= self._date(fsobj, youngest, previous):
+                return youngest
+            return max(bisect_right(self.timestamps, timestamp) - 1, 0)
+
+    def _update(self, fsobj):
+        """
+        Indexes the revisions before the youngest one, which is returned.
+        """
+        if not self._loaded:
+            self._load()
+            self._loaded = True
+
+        youngest = svn.fs.youngest_rev(fsobj)
+        if len(self.timestamps) > youngest:
+            # the repository has been replaced
+            del self.timestamps[:]
+        start = len(self.timestamps)
+        if start == youngest:
+            return youngest
+
+        added = array(self.timestamps.typecode)
+        previous = self.timestamps[-1] if self.timestamps else 0.0
+        for revision in xrange(start, youngest):
+            previous = self._date(fsobj, revision, previous)
+            added.append(previous)
+        self.timestamps.extend(added)
+        self._store(start, added)
+        return youngest
+
+    def _date(self, fsobj, revision, default):
+        date = svn.fs.revision_prop(
+            fsobj, revision, svn.core.SVN_PROP_REVISION_DATE)
+        if not date:
+            return default
+        return svn.core.svn_time_from_cstring(date) / 1E6
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as index_file:
+                if index_file.readline().strip() != self.uuid:
+                    return
+                data = index_file.read()
+        except IOError:
+            return
+        count = len(data) // self.timestamps.itemsize
+        self.timestamps.fromstring(data[:count * self.timestamps.itemsize])
+
+    def _store(self, start, added):
+        """
+        Writes the timestamps `added` of the revisions from `start` on.
+        """
+        try:
+            if start == 0 or not self._append(start, added):
+                _write_file(
+                    self.path, self.uuid + '\n' + self.timestamps.tostring())
+        except (IOError, OSError):
+            log.warning('Cannot store the timestamp index %s', self.path,
+                        exc_info=True)
+
+    def _append(self, start, added):
+        try:
+            index_file = open(self.path, 'r+b')
+        except IOError:
+            return False
+        with index_file:
+            # Other processes may append the same revisions; as the dates
+            # of indexed revisions are final, they write the same data
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            header = index_file.readline()
+            if header.strip() != self.uuid:
+                return False
+            index_file.seek(0, os.SEEK_END)
+            stored = (index_file.tell() - len(header)) // added.itemsize
+            if stored < start:
+                return False
+            index_file.seek(len(header) + start * added.itemsize)
+            added.tofile(index_file)
+        return True
+
+
+def _dump_failure_reason(errors):
+    if 'svnrdump: E230001:' in errors:
+        return 'INVALID_CERTIFICATE'
+    return 'UNKNOWN'
+
+
+def _import_file(repo_path, name):
+    return os.path.join(repo_path, 'db', name)
+
+
+def _lock_import(repo_path):
+    """
+    Returns the open import lock file of `repo_path`, `None` if another
+    import holds the lock.
+    """
+    lock_file = open(_import_file(repo_path, ImportJob.LOCK_FILE), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        lock_file.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    # Only `svnadmin load` inherits the lock, see `ImportJob._load`
+    flags = fcntl.fcntl(lock_file, fcntl.F_GETFD)
+    fcntl.fcntl(lock_file, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return lock_file
+
+
+def _import_locked(repo_path):
+    try:
+        lock_file = open(_import_file(repo_path, ImportJob.LOCK_FILE), 'a')
+    except IOError:
+        return False
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+    return False
+
+
+class ImportJob(object):
+    """
+    Pipes `svnrdump dump` of a remote repository into `svnadmin load` in a
+    background thread and tracks the loaded revisions.
+
+    The state of the latest job is kept in the `db` directory of the
+    repository, so that every process serving the repository can report and
+    cancel it. A running job holds the import lock of the repository.
+    """
+
+    STATE_FILE = 'rc-import.json'
+    CANCEL_FILE = 'rc-import.cancel'
+    LOCK_FILE = 'rc-import.lock'
+
+    ACTIVE = ('pending', 'running')
+
+    # Minimal number of seconds between two stores of the progress
+    STORE_INTERVAL = 1
+
+    _committed_re = re.compile(r'^------- Committed (?:revision|new rev) (\d+)')
+
+    # Jobs running in this process, terminated when it exits
+    _running = set()
+    _running_lock = threading.Lock()
+
+    def __init__(self, repo_path, src_url, start_rev, lock_file=None):
+        self.id = uuid.uuid4().hex
+        self.repo_path = repo_path
+        self.src_url = src_url
+        self.start_rev = start_rev
+        self.state = 'pending'
+        self.loaded_revision = start_rev - 1
+        self.total_revisions = None
+        self.error = None
+        self.reason = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._lock_file = lock_file
+        self._processes = []
+        self._stored = 0
+        self._thread = threading.Thread(
+            target=self._run, name='svn-import-%s' % self.id)
+        self._thread.daemon = True
+
+    @classmethod
+    def read_state(cls, repo_path):
+        try:
+            with open(_import_file(repo_path, cls.STATE_FILE), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    @classmethod
+    def job_status(cls, repo_path, job_id):
+        """
+        Returns the stored status of the job `job_id` of `repo_path`.
+
+        A job which is still active according to its state, but no longer
+        holds the lock, was interrupted, e.g. by a restart of its process.
+        """
+        state = cls.read_state(repo_path)
+        if state is None or state['id'] != job_id:
+            raise KeyError('Unknown import job %s' % (job_id, ))
+        state.pop('pids', None)
+        if state['state'] in cls.ACTIVE and not _import_locked(repo_path):
+            state['state'] = 'failed'
+            state['error'] = 'The import was interrupted.'
+        return state
+
+    @classmethod
+    def cancel_job(cls, repo_path, job_id):
+        """
+        Cancels the job `job_id` of `repo_path` from any process.
+        """
+        state = cls.read_state(repo_path)
+        status = cls.job_status(repo_path, job_id)
+        if status['state'] in cls.ACTIVE:
+            _write_file(_import_file(repo_path, cls.CANCEL_FILE), job_id)
+            for pid in state.get('pids', []):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        return cls.job_status(repo_path, job_id)
+
+    @classmethod
+    def cancel_running(cls):
+        with cls._running_lock:
+            jobs = list(cls._running)
+        for job in jobs:
+            job.cancel()
+
+    def start(self):
+        self.state = 'running'
+        self._store()
+        with self._running_lock:
+            self._running.add(self)
+        self._thread.start()
+
+    def is_running(self):
+        return self.state in self.ACTIVE
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+
+    def cancel(self):
+        """
+        Terminates the processes of this job.
+        """
+        with self._lock:
+            self._cancelled.set()
+            for process in self._processes:
+                if process.poll() is None:
+                    process.terminate()
+
+    def status(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'src_url': self.src_url,
+            'start_revision': self.start_rev,
+            'loaded_revision': self.loaded_revision,
+            'total_revisions': self.total_revisions,
+            'error': self.error,
+            'reason': self.reason,
+        }
+
+    def _cancel_requested(self):
+        if self._cancelled.is_set():
+            return True
+        try:
+            with open(_import_file(self.repo_path, self.CANCEL_FILE)) as f:
+                return f.read() == self.id
+        except IOError:
+            return False
+
+    def _store(self, force=True):
+        now = time.time()
+        if not force and now - self._stored < self.STORE_INTERVAL:
+            return
+        self._stored = now
+        state = self.status()
+        state['pids'] = [
+            process.pid for process in self._processes
+            if process.poll() is None]
+        try:
+            _write_file(
+                _import_file(self.repo_path, self.STATE_FILE),
+                json.dumps(state))
+        except (IOError, OSError):
+            log.warning('Cannot store the state of import job %s', self.id,
+                        exc_info=True)
+
+    def _run(self):
+        try:
+            self.total_revisions = self._remote_head()
+            if (self.total_revisions is not None and
+                    self.start_rev > self.total_revisions):
+                self.state = 'done'
+                return
+            self._load()
+        except Exception as e:
+            log.exception('Import of %s failed', self.src_url)
+            self.error = str(e)
+            self.state = 'failed'
+        finally:
+            self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._processes = []
+        self._store()
+        if self._cancel_requested():
+            try:
+                os.remove(_import_file(self.repo_path, self.CANCEL_FILE))
+            except OSError:
+                pass
+        with self._running_lock:
+            self._running.discard(self)
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+    def _remote_head(self):
+        """
+        Returns the youngest revision of the remote repository, `None` if it
+        cannot be determined.
+        """
+        try:
+            output = subprocess.check_output(
+                ['svn', 'info', '--non-interactive', '--show-item',
+                 'revision', self.src_url], stderr=subprocess.STDOUT)
+            return int(output.strip())
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            log.debug('Cannot determine the head of %s', self.src_url)
+            return None
+
+    def _load(self):
+        dump_cmd = ['svnrdump', 'dump', '--non-interactive', '--quiet']
+        if self.start_rev > 1:
+            dump_cmd += ['--incremental', '-r', '%d:HEAD' % self.start_rev]
+        dump_cmd.append(self.src_url)
+        dump_errors = tempfile.TemporaryFile()
+        load_errors = tempfile.TemporaryFile()
+
+        with self._lock:
+            if self._cancel_requested():
+                self.state = 'cancelled'
+                return
+            rdump = subprocess.Popen(
+                dump_cmd, stdout=subprocess.PIPE, stderr=dump_errors)
+            load = subprocess.Popen(
+                ['svnadmin', 'load', self.repo_path], stdin=rdump.stdout,
+                stdout=subprocess.PIPE, stderr=load_errors,
+                preexec_fn=self._inherit_lock)
+            # svnrdump gets SIGPIPE if svnadmin exits early
+            rdump.stdout.close()
+            self._processes = [rdump, load]
+        # The pids are stored before checking again, so that a cancellation
+        # from another process either sees them or is seen here
+        self._store()
+        if self._cancel_requested():
+            self.cancel()
+
+        for line in iter(load.stdout.readline, ''):
+            match = self._committed_re.match(line)
+            if match:
+                self.loaded_revision = int(match.group(1))
+                self._store(force=False)
+        load.wait()
+        rdump.wait()
+
+        if self._cancel_requested():
+            self.state = 'cancelled'
+        elif rdump.returncode != 0:
+            dump_errors.seek(0)
+            errors = dump_errors.read()
+            log.error('svnrdump dump failed: statuscode %s: message: %s',
+                      rdump.returncode, errors)
+            self.error = (
+                'Failed to dump the remote repository from %s.' %
+                self.src_url)
+            self.reason = _dump_failure_reason(errors)
+            self.state = 'failed'
+        elif load.returncode != 0:
+            load_errors.seek(0)
+            log.error('svnadmin load failed: statuscode %s: message: %s',
+                      load.returncode, load_errors.read())
+            self.error = (
+                'Failed to load the dump of remote repository from %s.' %
+                self.src_url)
+            self.state = 'failed'
+        else:
+            self.state = 'done'
+
+    def _inherit_lock(self):
+        # Runs in the child, so that the repository stays locked while
+        # `svnadmin load` runs, even if it outlives this process
+        if self._lock_file is not None:
+            fcntl.fcntl(self._lock_file, fcntl.F_SETFD, 0)
+
+
+atexit.register(ImportJob.cancel_running)
+
 
 class SvnDiffer(object):
     """
@@ -385,14 +1262,23 @@ class SvnDiffer(object):
                 (self.src_kind, self.tgt_kind))
 
     def generate_diff(self):
-        buf = StringIO.StringIO()
+        return ''.join(self.generate_diff_stream())
+
+    def generate_diff_stream(self):
+        """
+        Yields the diff node by node, reading the content of a node only
+        when its diff is generated.
+        """
         if self.tgt_kind == svn.core.svn_node_dir:
-            self._generate_dir_diff(buf)
+            nodes = self._dir_diff_nodes()
         else:
-            self._generate_file_diff(buf)
-        return buf.getvalue()
+            nodes = [self._file_diff_node()]
+        for node in nodes:
+            buf = StringIO.StringIO()
+            self._generate_node_diff(buf, *node)
+            yield buf.getvalue()
 
-    def _generate_dir_diff(self, buf):
+    def _dir_diff_nodes(self):
         editor = DiffChangeEditor()
         editor_ptr, editor_baton = svn.delta.make_editor(editor)
         svn.repos.dir_delta2(
@@ -409,11 +1295,11 @@ class SvnDiffer(object):
             False,  # ignore_ancestry
         )
 
-        for path, __, change in sorted(editor.changes):
-            self._generate_node_diff(
-                buf, change, path, self.tgt_path, path, self.src_path)
+        return [
+            (change, path, self.tgt_path, path, self.src_path)
+            for path, __, change in sorted(editor.changes)]
 
-    def _generate_file_diff(self, buf):
+    def _file_diff_node(self):
             change = None
             if self.src_kind == svn.core.svn_node_none:
                 change = "add"
@@ -421,8 +1307,7 @@ class SvnDiffer(object):
                 change = "delete"
             tgt_base, tgt_path = vcspath.split(self.tgt_path)
             src_base, src_path = vcspath.split(self.src_path)
-            self._generate_node_diff(
-                buf, change, tgt_path, tgt_base, src_path, src_base)
+            return (change, tgt_path, tgt_base, src_path, src_base)
 
     def _generate_node_diff(
             self, buf, change, tgt_path, tgt_base, src_path, src_base):
@@ -521,18 +1406,24 @@ class TxnNodeProcessor(object):
     It encapsulates the knowledge of how to add, update or remove
     a node for a given transaction root. The purpose is to support the method
     `SvnRemote.commit`.
+
+    Directories which are known to exist are collected in `known_dirs`, so
+    that processors of the same transaction check every directory once.
     """
 
-    def __init__(self, node, txn_root):
+    def __init__(self, node, txn_root, known_dirs=None):
         assert isinstance(node['path'], str)
 
         self.node = node
         self.txn_root = txn_root
+        self.known_dirs = set() if known_dirs is None else known_dirs
 
-    def update(self):
+    def update(self, chunks=None):
         self._ensure_parent_dirs()
         self._add_file_if_node_does_not_exist()
-        self._update_file_content()
+        if chunks is None:
+            chunks = [self.node['content']]
+        self._update_file_content(chunks)
         self._update_file_properties()
 
     def remove(self):
@@ -542,7 +1433,8 @@ class TxnNodeProcessor(object):
     def _ensure_parent_dirs(self):
         curdir = vcspath.dirname(self.node['path'])
         dirs_to_create = []
-        while not self._svn_path_exists(curdir):
+        while (curdir not in self.known_dirs and
+               not self._svn_path_exists(curdir)):
             dirs_to_create.append(curdir)
             curdir = vcspath.dirname(curdir)
 
@@ -550,6 +1442,11 @@ class TxnNodeProcessor(object):
             log.debug('Creating missing directory "%s"', curdir)
             svn.fs.make_dir(self.txn_root, curdir)
 
+        curdir = vcspath.dirname(self.node['path'])
+        while curdir not in self.known_dirs:
+            self.known_dirs.add(curdir)
+            curdir = vcspath.dirname(curdir)
+
     def _svn_path_exists(self, path):
         path_status = svn.fs.check_path(self.txn_root, path)
         return path_status != svn.core.svn_node_none
@@ -559,11 +1456,14 @@ class TxnNodeProcessor(object):
         if kind == svn.core.svn_node_none:
             svn.fs.make_file(self.txn_root, self.node['path'])
 
-    def _update_file_content(self):
-        assert isinstance(self.node['content'], str)
-        handler, baton = svn.fs.apply_textdelta(
-            self.txn_root, self.node['path'], None, None)
-        svn.delta.svn_txdelta_send_string(self.node['content'], handler, baton)
+    def _update_file_content(self, chunks):
+        # The filesystem stores the text as a delta against the previous
+        # version of the file on its own.
+        stream = svn.fs.apply_text(self.txn_root, self.node['path'], None)
+        for chunk in chunks:
+            assert isinstance(chunk, str)
+            svn.core.svn_stream_write(stream, chunk)
+        svn.core.svn_stream_close(stream)
 
     def _update_file_properties(self):
         properties = self.node.get('properties', {})
@@ -14,7 +14,11 @@
 #
 # Author: Christopher Lenz <cmlenz@gmx.de>
 
-import difflib
+from bisect import bisect_left
+
+# Minimal number of edits after which the diff of a range of lines without
+# unique lines switches to a faster but not minimal split
+MYERS_MIN_COST = 64
 
 
 def get_filtered_hunks(fromlines, tolines, context=None,
@@ -24,6 +28,8 @@ def get_filtered_hunks(fromlines, tolines, context=None,
     opcodes, grouped according to the ``context`` and ``ignore_*``
     parameters.
 
+    The opcodes are computed by `get_opcodes`.
+
     :param fromlines: list of lines corresponding to the old content
     :param tolines: list of lines corresponding to the new content
     :param ignore_blank_lines: differences about empty lines only are ignored
@@ -34,8 +40,7 @@ def get_filtered_hunks(fromlines, tolines, context=None,
     :return: generator of grouped `difflib.SequenceMatcher` opcodes
 
     If none of the ``ignore_*`` parameters is `True`, there's nothing
-    to filter out the results will come straight from the
-    SequenceMatcher.
+    to filter out the results will come straight from `get_opcodes`.
     """
     hunks = get_hunks(fromlines, tolines, context)
     if ignore_space_changes or ignore_case or ignore_blank_lines:
@@ -50,11 +55,278 @@ def get_hunks(fromlines, tolines, context=None):
 
     See `get_filtered_hunks` for the parameter descriptions.
     """
-    matcher = difflib.SequenceMatcher(None, fromlines, tolines)
+    opcodes = get_opcodes(fromlines, tolines)
     if context is None:
-        return (hunk for hunk in [matcher.get_opcodes()])
+        return (hunk for hunk in [opcodes])
     else:
-        return matcher.get_grouped_opcodes(context)
+        return group_opcodes(opcodes, context)
+
+
+def get_opcodes(fromlines, tolines):
+    """Return the differences as `difflib.SequenceMatcher` style opcodes.
+
+    The lines are compared by their number in a table of distinct lines.
+    After the common prefix and suffix are removed, lines which occur
+    exactly once on both sides are matched (patience diff). The gaps between
+    them are diffed with the linear space variant of Myers' algorithm.
+    """
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in fromlines]
+    b = [ids.setdefault(line, len(ids)) for line in tolines]
+
+    blocks = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = _trim_region(a, b, regions.pop(), blocks)
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = _unique_anchors(a, alo, ahi, b, blo, bhi)
+        if not anchors:
+            _myers_blocks(a, alo, ahi, b, blo, bhi, blocks)
+            continue
+        for i, j in anchors:
+            blocks.append((i, j, 1))
+            regions.append((alo, i, blo, j))
+            alo, blo = i + 1, j + 1
+        regions.append((alo, ahi, blo, bhi))
+
+    return _blocks_to_opcodes(blocks, len(a), len(b))
+
+
+def group_opcodes(opcodes, n=3):
+    """Isolate change clusters by eliminating ranges with no changes.
+
+    Works like `difflib.SequenceMatcher.get_grouped_opcodes`.
+    """
+    codes = list(opcodes)
+    if not codes:
+        codes = [("equal", 0, 1, 0, 1)]
+    # Fixup leading and trailing groups if they show no changes.
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    nn = n + n
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # End the current group and start a new one whenever
+        # there is a large range with no changes.
+        if tag == 'equal' and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _trim_region(a, b, region, blocks):
+    """Record the common prefix and suffix of `region` as matching blocks
+    and return the remaining region.
+    """
+    alo, ahi, blo, bhi = region
+    start = alo
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        alo += 1
+        blo += 1
+    if alo > start:
+        blocks.append((start, blo - (alo - start), alo - start))
+    end = ahi
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+    if ahi < end:
+        blocks.append((ahi, bhi, end - ahi))
+    return alo, ahi, blo, bhi
+
+
+def _unique_anchors(a, alo, ahi, b, blo, bhi):
+    """Return the longest increasing sequence of `(i, j)` pairs of lines
+    which occur exactly once in both ranges.
+    """
+    counts = {}
+    for i in xrange(alo, ahi):
+        entry = counts.get(a[i])
+        if entry is None:
+            counts[a[i]] = [1, i, 0, 0]
+        else:
+            entry[0] += 1
+    for j in xrange(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None and entry[0] == 1:
+            entry[2] += 1
+            entry[3] = j
+    pairs = sorted(
+        (entry[1], entry[3]) for entry in counts.itervalues()
+        if entry[0] == 1 and entry[2] == 1)
+    if not pairs:
+        return []
+
+    # patience sorting: `tails[k]` is the smallest `j` ending an increasing
+    # sequence of length `k + 1`
+    tails = []
+    tail_indices = []
+    previous = [None] * len(pairs)
+    for index, (i, j) in enumerate(pairs):
+        k = bisect_left(tails, j)
+        if k:
+            previous[index] = tail_indices[k - 1]
+        if k == len(tails):
+            tails.append(j)
+            tail_indices.append(index)
+        else:
+            tails[k] = j
+            tail_indices[k] = index
+
+    anchors = []
+    index = tail_indices[-1]
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _myers_blocks(a, alo, ahi, b, blo, bhi, blocks):
+    """Record the matching blocks of a shortest edit script of the ranges.
+
+    The ranges are split at the middle of the edit path until they only
+    consist of insertions or deletions, which keeps the memory linear.
+    """
+    regions = [(alo, ahi, blo, bhi)]
+    while regions:
+        alo, ahi, blo, bhi = _trim_region(a, b, regions.pop(), blocks)
+        if alo == ahi or blo == bhi:
+            continue
+        split = _middle_split(a, alo, ahi, b, blo, bhi)
+        if split is None:
+            continue
+        x, y = split
+        regions.append((alo, x, blo, y))
+        regions.append((x, ahi, y, bhi))
+
+
+def _middle_split(a, alo, ahi, b, blo, bhi):
+    """Return a point in the middle of a shortest edit path of the ranges.
+
+    Follows the bisection of Myers' "An O(ND) Difference Algorithm and Its
+    Variations", searching forward and backward at the same time. Like
+    xdiff, the search gives up after `MYERS_MIN_COST` or the square root of
+    the size edits and splits at the furthest forward point instead, which
+    bounds the time for very different inputs.
+    """
+    n = ahi - alo
+    m = bhi - blo
+    max_d = (n + m + 1) // 2
+    max_cost = max(MYERS_MIN_COST, int((n + m) ** 0.5))
+    # diagonals beyond the cost limit are never reached
+    v_offset = min(max_d, max_cost + 1)
+    v_length = 2 * v_offset + 2
+    v1 = [-1] * v_length
+    v2 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2[v_offset + 1] = 0
+    delta = n - m
+    # the paths overlap first in the forward search if delta is odd
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+    for d in xrange(max_d):
+        if d > max_cost:
+            return _furthest_split(v1, v_offset, d, n, m, alo, blo)
+        for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and
+                            v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                    if x1 >= n - v2[k2_offset]:
+                        return alo + x1, blo + y1
+
+        for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and
+                            v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while (x2 < n and y2 < m and
+                   a[ahi - x2 - 1] == b[bhi - y2 - 1]):
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = v_offset + x1 - k1_offset
+                    if x1 >= n - x2:
+                        return alo + x1, blo + y1
+    return None
+
+
+def _furthest_split(v1, v_offset, d, n, m, alo, blo):
+    best = None
+    for k in xrange(-d + 1, d, 2):
+        x = v1[v_offset + k]
+        y = x - k
+        if 0 <= x <= n and 0 <= y <= m and 0 < x + y < n + m:
+            if best is None or x + y > best[0] + best[1]:
+                best = (x, y)
+    if best is None:
+        return None
+    return alo + best[0], blo + best[1]
+
+
+def _blocks_to_opcodes(blocks, n, m):
+    blocks.sort()
+    merged = []
+    for i, j, size in blocks:
+        if merged:
+            last_i, last_j, last_size = merged[-1]
+            if last_i + last_size == i and last_j + last_size == j:
+                merged[-1] = (last_i, last_j, last_size + size)
+                continue
+        merged.append((i, j, size))
+    merged.append((n, m, 0))
+
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in merged:
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
 
 
 def filter_ignorable_lines(hunks, fromlines, tolines, context,